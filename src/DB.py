@@ -4,30 +4,88 @@ from __future__ import print_function
 
 import os
 
+import numpy as np
 import pandas as pd
 
 
 class Database(object):
+    ''' the images under DB_dir, cataloged in DB_csv with the class, size and mtime of every image
 
-    def __init__(self, DB_dir, DB_csv):
+        The catalog is diffed against DB_dir when a Database is made, images added, modified or
+        removed since are in self.changes, and the extractors only recompute those.
+    '''
+
+    columns = ['img', 'cls', 'size', 'mtime']
+
+    def __init__(self, DB_dir, DB_csv, refresh=True):
+        '''
+          arguments
+            DB_dir : directory of the images, an image is in the class of its directory
+            DB_csv : catalog of the images, made on first use
+            refresh: diff the catalog against DB_dir and update it, an existing catalog is kept as is if False
+        '''
         self.DB_dir = DB_dir
         self.DB_csv = DB_csv
-        self._gen_csv()
-        self.data = pd.read_csv(DB_csv)
+        self.changes = None
+        self.data = pd.read_csv(DB_csv) if os.path.exists(DB_csv) else pd.DataFrame(columns=self.columns)
+        if not os.path.exists(DB_csv) or (refresh and os.path.isdir(DB_dir)):
+            self.refresh()
         self.classes = set(self.data["cls"])
 
-    def _gen_csv(self):
-        if os.path.exists(self.DB_csv):
-            return
-        with open(self.DB_csv, 'w', encoding='UTF-8') as f:
-            f.write("img,cls")
-            for root, _, files in os.walk(self.DB_dir, topdown=False):
-                cls = root.split('/')[-1]
-                for name in files:
-                    if not name.endswith('.jpg'):
-                        continue
-                    img = os.path.join(root, name)
-                    f.write("\n{},{}".format(img, cls))
+    def _scan(self):
+        ''' the catalog of the images under DB_dir, as a DataFrame '''
+        rows = []
+        for root, _, files in os.walk(self.DB_dir, topdown=False):
+            cls = root.split('/')[-1]
+            for name in files:
+                if not name.endswith('.jpg'):
+                    continue
+                img = os.path.join(root, name)
+                st = os.stat(img)
+                rows.append((img, cls, st.st_size, st.st_mtime_ns))
+        return pd.DataFrame(rows, columns=self.columns)
+
+    def diff(self, scan=None):
+        ''' images added, modified or removed under DB_dir since the catalog was written
+
+          return
+            {'added': [<path_to_img>], 'modified': [<path_to_img>], 'removed': [<path_to_img>]}
+        '''
+        scan = self._scan() if scan is None else scan
+        both = scan.merge(self.data.reindex(columns=self.columns), on='img', how='outer',
+                          suffixes=('', '_old'), indicator=True)
+        kept = both[both._merge == 'both']
+        modified = (kept['size'] != kept['size_old']) | (kept['mtime'] != kept['mtime_old'])
+        return {
+            'added':    list(both.img[both._merge == 'left_only']),
+            'modified': list(kept.img[modified]),
+            'removed':  list(both.img[both._merge == 'right_only']),
+        }
+
+    def refresh(self):
+        ''' update the catalog to the images under DB_dir, kept images keep their order, new ones come last
+
+          return
+            the changes, see diff()
+        '''
+        scan = self._scan()
+        self.changes = self.diff(scan)
+        if os.path.exists(self.DB_csv) and not any(self.changes.values()):
+            return self.changes
+        kept = self.data.img[self.data.img.isin(scan.img)]
+        self.data = pd.concat([scan.set_index('img').loc[kept].reset_index(),
+                               scan[~scan.img.isin(self.data.img)]], ignore_index=True)
+        tmp = '%s.tmp%d' % (self.DB_csv, os.getpid())
+        self.data.to_csv(tmp, index=False, encoding='UTF-8')
+        os.replace(tmp, self.DB_csv)
+        return self.changes
+
+    def stamps(self):
+        ''' (size, mtime in ns) of every image, a numpy array with size N * 2 '''
+        if 'size' not in self.data or 'mtime' not in self.data:  # a catalog made without stamps
+            stats = [os.stat(img) for img in self.data.img]
+            return np.array([(st.st_size, st.st_mtime_ns) for st in stats], dtype=np.int64).reshape(-1, 2)
+        return self.data[['size', 'mtime']].values.astype(np.int64)
 
     def __len__(self):
         return len(self.data)
@@ -46,6 +104,7 @@ if __name__ == "__main__":
     classesTrain = dbTrain.get_class()
     print("DB length:", len(dbTrain))
     print(classesTrain)
+    print("changes since last run:", {k: len(v) for k, v in dbTrain.changes.items()})
 
     dbVal = Database(DB_dir="CorelDBDataSet/val",
                      DB_csv="CorelDBDataSetVal.csv")
@@ -4,13 +4,13 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from DB import Database
+from store import SegmentedStore
+from parallel import HistogramPool, extract_histograms
+from batching import Decoded, read_rgb, reduce_image, scaled_cache, to_gray
 
 from skimage.feature import hog
-from skimage import color
 
-from six.moves import cPickle
 import numpy as np
-import scipy.misc
 import os
 
 n_bin    = 10
@@ -19,7 +19,9 @@ n_orient = 8
 p_p_c    = (2, 2)
 c_p_b    = (1, 1)
 h_type   = 'region'
+decode_scale = 1  # images are decoded at 1/decode_scale of their size, see batching.read_rgb()
 d_type   = 'd1'
+region_mode = 'whole'  # 'whole' computes HOG once on the whole image, 'crop' calls hog() on every region
 
 depth    = 5
 
@@ -73,7 +75,7 @@ class HOG(object):
     ''' count img histogram
   
       arguments
-        input    : a path to a image or a numpy.ndarray
+        input    : a path to a image, a numpy.ndarray or a Decoded
         n_bin    : number of bins of histogram
         type     : 'global' means count the histogram for whole image
                    'region' means count the histogram for regions in images, then concatanate all of them
@@ -86,11 +88,16 @@ class HOG(object):
         type == 'region'
           a numpy array with size n_bin * n_slice * n_slice
     '''
-    if isinstance(input, np.ndarray):  # examinate input type
-      img = input.copy()
+    if isinstance(input, Decoded):  # examinate input type
+      img = input.at(decode_scale).gray
+    elif isinstance(input, np.ndarray):
+      img = to_gray(reduce_image(input, decode_scale))
     else:
-      img = scipy.misc.imread(input, mode='RGB')
-    height, width, channel = img.shape
+      img = to_gray(read_rgb(input, decode_scale))
+    height, width = img.shape[:2]  # regions are cut from the grayscale image, see to_gray()
+  
+    if region_mode == 'whole':
+      return self.batch_histogram(img[np.newaxis], n_bin=n_bin, type=type, n_slice=n_slice, normalize=normalize)[0]
   
     if type == 'global':
       hist = self._HOG(img, n_bin)
@@ -111,7 +118,7 @@ class HOG(object):
     return hist.flatten()
 
   def _HOG(self, img, n_bin, normalize=True):
-    image = color.rgb2gray(img)
+    image = to_gray(img)
     fd = hog(image, orientations=n_orient, pixels_per_cell=p_p_c, cells_per_block=c_p_b)
     bins = np.linspace(0, np.max(fd), n_bin+1, endpoint=True)
     hist, _ = np.histogram(fd, bins=bins)
@@ -121,35 +128,145 @@ class HOG(object):
   
     return hist
 
-  def make_samples(self, db, verbose=True):
+  def batch_histogram(self, imgs, n_bin=n_bin, type=h_type, n_slice=n_slice, normalize=True):
+    ''' histogram() of a batch of same-shaped images, HOG is computed once on every whole image
+        and regions gather the blocks lying inside them
+  
+      arguments
+        imgs: a numpy.ndarray with size N * height * width * channel, or N * height * width in grayscale
+  
+      return
+        a numpy array with size N * len(histogram())
+    '''
+    N, height, width = imgs.shape[:3]
+    images = np.stack([to_gray(img) for img in imgs])
+    blocks = self._blocks(self._cell_hist(images))  # shape=(N, n_blocks_row, n_blocks_col, R)
+  
+    if type == 'global':
+      hist = np.array([self._value_hist(fd, n_bin) for fd in blocks])
+  
+    elif type == 'region':
+      hist = np.zeros((N, n_slice, n_slice, n_bin))
+      h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
+      w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
+  
+      # pixel extent of every block
+      b_row = np.arange(blocks.shape[1]) * p_p_c[0]
+      b_col = np.arange(blocks.shape[2]) * p_p_c[1]
+      for hs in range(len(h_silce)-1):
+        rows = np.flatnonzero((b_row >= h_silce[hs]) & (b_row + c_p_b[0] * p_p_c[0] <= h_silce[hs+1]))
+        for ws in range(len(w_slice)-1):
+          cols = np.flatnonzero((b_col >= w_slice[ws]) & (b_col + c_p_b[1] * p_p_c[1] <= w_slice[ws+1]))
+          for idx in range(N):
+            hist[idx, hs, ws] = self._value_hist(blocks[idx][np.ix_(rows, cols)], n_bin)
+  
+    hist = hist.reshape(N, -1)
+    if normalize:
+      hist /= np.sum(hist, axis=1, keepdims=True)
+  
+    return hist
+  
+  def _cell_hist(self, images):
+    ''' orientation histograms of the cells, same as skimage.feature.hog for a batch of grayscale images
+  
+      return
+        a numpy array with size N * n_cells_row * n_cells_col * n_orient
+    '''
+    N, s_row, s_col = images.shape
+    c_row, c_col = p_p_c
+    n_cells_row, n_cells_col = s_row // c_row, s_col // c_col
+  
+    g_row = np.zeros(images.shape)
+    g_col = np.zeros(images.shape)
+    g_row[:, 1:-1, :] = images[:, 2:, :] - images[:, :-2, :]
+    g_col[:, :, 1:-1] = images[:, :, 2:] - images[:, :, :-2]
+    magnitude = np.hypot(g_col, g_row)
+    orientation = np.rad2deg(np.arctan2(g_row, g_col)) % 180
+  
+    # orientation bin of every pixel, orientations rounded to 180 fall in no bin as in skimage
+    bounds = 180. / n_orient * np.arange(n_orient + 1)
+    o_bin = np.searchsorted(bounds, orientation, side='right') - 1
+    magnitude[o_bin >= n_orient] = 0
+    o_bin = np.minimum(o_bin, n_orient - 1)
+  
+    # cell of every pixel, pixels beyond the last full cell are dropped
+    magnitude = magnitude[:, :n_cells_row * c_row, :n_cells_col * c_col]
+    o_bin = o_bin[:, :n_cells_row * c_row, :n_cells_col * c_col]
+    r_cell = np.arange(n_cells_row * c_row) // c_row
+    c_cell = np.arange(n_cells_col * c_col) // c_col
+    cell = (np.arange(N)[:, np.newaxis, np.newaxis] * n_cells_row + r_cell[np.newaxis, :, np.newaxis]) * n_cells_col \
+           + c_cell[np.newaxis, np.newaxis, :]
+  
+    hist = np.bincount((cell * n_orient + o_bin).ravel(), weights=magnitude.ravel(),
+                       minlength=N * n_cells_row * n_cells_col * n_orient)
+    return hist.reshape(N, n_cells_row, n_cells_col, n_orient) / (c_row * c_col)
+  
+  def _blocks(self, cell_hist, eps=1e-5):
+    ''' L2-Hys normalized blocks of cells, same as skimage.feature.hog
+  
+      return
+        a numpy array with size N * n_blocks_row * n_blocks_col * (b_row * b_col * n_orient)
+    '''
+    N, n_cells_row, n_cells_col, _ = cell_hist.shape
+    b_row, b_col = c_p_b
+    n_blocks_row, n_blocks_col = n_cells_row - b_row + 1, n_cells_col - b_col + 1
+  
+    blocks = np.stack([
+      np.stack([cell_hist[:, r:r + n_blocks_row, c:c + n_blocks_col] for c in range(b_col)], axis=3)
+      for r in range(b_row)], axis=3)  # shape=(N, n_blocks_row, n_blocks_col, b_row, b_col, n_orient)
+    blocks = blocks.reshape(N, n_blocks_row, n_blocks_col, -1)
+  
+    blocks = blocks / np.sqrt(np.sum(blocks ** 2, axis=3, keepdims=True) + eps ** 2)
+    blocks = np.minimum(blocks, 0.2)
+    blocks = blocks / np.sqrt(np.sum(blocks ** 2, axis=3, keepdims=True) + eps ** 2)
+    return blocks
+  
+  def _value_hist(self, fd, n_bin, normalize=True):
+    ''' the histogram of descriptor values of _HOG() '''
+    if fd.size == 0:
+      return np.zeros(n_bin)
+    bins = np.linspace(0, np.max(fd), n_bin+1, endpoint=True)
+    hist, _ = np.histogram(fd, bins=bins)
+  
+    if normalize:
+      hist = np.array(hist) / np.sum(hist)
+  
+    return hist
+  
+  def feature(self, input):
+    ''' the histogram of a image as make_samples() stores it, with the configs of the module '''
+    hist = self.histogram(input, type=h_type, n_slice=n_slice)
+    return hist / np.sum(hist)  # normalize
+
+  def sample_store(self):
+    ''' the store of the samples, with the configs of the module '''
     if h_type == 'global':
       sample_cache = "HOG-{}-n_bin{}-n_orient{}-ppc{}-cpb{}".format(h_type, n_bin, n_orient, p_p_c, c_p_b)
     elif h_type == 'region':
-      sample_cache = "HOG-{}-n_bin{}-n_slice{}-n_orient{}-ppc{}-cpb{}".format(h_type, n_bin, n_slice, n_orient, p_p_c, c_p_b)
-  
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
+      sample_cache = "HOG-{}-{}-n_bin{}-n_slice{}-n_orient{}-ppc{}-cpb{}".format(h_type, region_mode, n_bin, n_slice, n_orient, p_p_c, c_p_b)
+
+    config = {'extractor': 'HOG', 'h_type': h_type, 'region_mode': region_mode, 'n_bin': n_bin, 'n_slice': n_slice,
+              'n_orient': n_orient, 'p_p_c': p_p_c, 'c_p_b': c_p_b}
+    sample_cache, config = scaled_cache(sample_cache, config, decode_scale)
+    return SegmentedStore(os.path.join(cache_dir, sample_cache), config)
+
+  def make_samples(self, db, verbose=True):
+    cache = self.sample_store()
+    sample_cache = os.path.basename(cache.path)
+    pool = HistogramPool(self, type=h_type, n_slice=n_slice)  # started once, for all the checkpoints
+
+    def compute(data):
       if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.histogram(d_img, type=h_type, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-
-    return samples
+        print("Counting histogram..., config=%s, distance=%s, depth=%s, %d images" % (sample_cache, d_type, depth, len(data)))
+      return extract_histograms(self, data, verbose=verbose, pool=pool)
+
+    with pool:
+      changes = cache.update(db, compute)
+    if verbose:
+      print("Using cache..., config=%s, distance=%s, depth=%s, %d added, %d changed, %d removed, %d quarantined" % (
+        sample_cache, d_type, depth, changes['added'], changes['changed'], changes['removed'],
+        changes['quarantined']))
+    return cache.samples(db)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+from skimage import color
+
+# configs of the image decoding
+scales      = (1, 2, 4, 8)  # decode scales, 1/2, 1/4 and 1/8 are done by the JPEG decoder on its DCT blocks
+cache_bytes = 256 * 2**20   # decoded images kept by read_rgb() in the main process, 0 disables the cache,
+                            # the pool workers of parallel.py and gabor.py run without it
+
+
+def to_bgr(img, means):
+  ''' a RGB image with values in 0-255, as the CNN extractors expect it
+
+    arguments
+      img  : a numpy array with size height * width * 3
+      means: mean of three channels in the order of BGR
+
+    return
+      a numpy array with size 3 * height * width
+  '''
+  img = img[:, :, ::-1]  # switch to BGR
+  img = np.transpose(img, (2, 0, 1)) / 255.
+  img[0] -= means[0]  # reduce B's mean
+  img[1] -= means[1]  # reduce G's mean
+  img[2] -= means[2]  # reduce R's mean
+  return img
+
+
+def to_gray(img):
+  ''' a RGB image in grayscale as skimage.color.rgb2gray makes it, a grayscale image is returned as is
+
+    rgb2gray works pixel by pixel, so regions of the grayscale image are the grayscale of the regions
+  '''
+  return img if img.ndim == 2 else color.rgb2gray(img)
+
+
+class ImageCache(object):
+  ''' a LRU of decoded images bounded by their bytes, shared by the threads of a process '''
+
+  def __init__(self, max_bytes=cache_bytes):
+    self.max_bytes = max_bytes
+    self.nbytes    = 0
+    self.hits      = 0
+    self.misses    = 0
+    self._images   = OrderedDict()
+    self._lock     = threading.Lock()
+
+  def __len__(self):
+    return len(self._images)
+
+  def get(self, key):
+    with self._lock:
+      img = self._images.get(key)
+      if img is None:
+        self.misses += 1
+        return None
+      self._images.move_to_end(key)  # most recently used
+      self.hits += 1
+      return img
+
+  def put(self, key, img):
+    if img.nbytes > self.max_bytes:
+      return
+    with self._lock:
+      if key in self._images:
+        return
+      self._images[key] = img
+      self.nbytes += img.nbytes
+      while self.nbytes > self.max_bytes:
+        _, old = self._images.popitem(last=False)  # least recently used
+        self.nbytes -= old.nbytes
+
+  def clear(self):
+    with self._lock:
+      self._images.clear()
+      self.nbytes = 0
+
+
+image_cache = ImageCache()
+
+
+def reduce_image(img, scale):
+  ''' a image at 1/scale of its size, every pixel is the mean of a scale * scale block
+
+    arguments
+      img  : a uint8 numpy array with size height * width (* 3), or a float grayscale image
+      scale: one of scales
+
+    return
+      a numpy array with size ceil(height / scale) * ceil(width / scale) (* 3)
+  '''
+  assert scale in scales, "scale should be one of %s" % (scales,)
+  if scale == 1:
+    return img
+  if img.dtype == np.uint8:
+    return np.asarray(Image.fromarray(img).reduce(scale))
+  return np.asarray(Image.fromarray(img.astype(np.float32), mode='F').reduce(scale)).astype(img.dtype)
+
+
+def read_rgb(path, scale=1):
+  ''' decode a image file to a RGB image at 1/scale of its size, through image_cache
+
+    A JPEG is decoded at 1/2, 1/4 or 1/8 scale by its decoder, without decoding the full image first.
+    Other formats are decoded, then reduced, see reduce_image(). The image is read-only, as it is shared.
+
+    arguments
+      path : a path to a image
+      scale: one of scales
+
+    return
+      a uint8 numpy array with size ceil(height / scale) * ceil(width / scale) * 3
+  '''
+  assert scale in scales, "scale should be one of %s" % (scales,)
+  stat = os.stat(path)
+  key = (path, scale, stat.st_mtime_ns, stat.st_size)  # a changed file is decoded again
+  img = image_cache.get(key) if image_cache.max_bytes > 0 else None
+  if img is not None:
+    return img
+
+  with Image.open(path) as im:
+    width, height = im.size
+    size = (-(-width // scale), -(-height // scale))
+    if scale > 1:
+      im.draft('RGB', size)  # a JPEG is decoded at the scale, other formats ignore it
+    im = im.convert('RGB')
+    if im.size != size:
+      im = im.reduce(scale)
+    img = np.asarray(im)
+  img.flags.writeable = False
+  if image_cache.max_bytes > 0:
+    image_cache.put(key, img)
+  return img
+
+
+def scaled_cache(sample_cache, config, scale):
+  ''' the name and config of a sample cache of images decoded at 1/scale, see read_rgb()
+
+    they are unchanged at full scale, so the caches made before decode scales stay valid
+  '''
+  if scale == 1:
+    return sample_cache, config
+  return '{}-scale{}'.format(sample_cache, scale), dict(config, decode_scale=scale)
+
+
+class Decoded(object):
+  ''' a image decoded once, the intermediates shared by the extractors are computed on first use
+      and kept, every extractor accepts a Decoded as input
+
+      rgb       : a uint8 numpy array with size height * width * 3
+      gray      : a float numpy array with size height * width, see to_gray()
+      bgr(means): the CNN input, see to_bgr()
+      at(scale) : the Decoded of the image at 1/scale of its size
+
+      All of them are read-only, as they are shared.
+  '''
+
+  def __init__(self, input, scale=1):
+    '''
+      arguments
+        input: a path to a image, or a RGB image as a numpy array
+        scale: one of scales, the image is decoded at 1/scale of its size, see read_rgb()
+    '''
+    if isinstance(input, np.ndarray):
+      self.path, self.rgb = None, reduce_image(input[:, :, :3], scale)
+    else:
+      self.path, self.rgb = input, read_rgb(input, scale)
+    self.rgb.flags.writeable = False
+    self.scale   = scale
+    self._source = input
+    self._gray   = None
+    self._bgr    = {}
+    self._scaled = {}
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state['_gray'], state['_bgr'] = None, {}  # computed again rather than pickled
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.rgb.flags.writeable = False
+
+  @property
+  def gray(self):
+    if self._gray is None:
+      self._gray = to_gray(self.rgb)
+      self._gray.flags.writeable = False
+    return self._gray
+
+  def bgr(self, means):
+    key = tuple(means)
+    if key not in self._bgr:
+      self._bgr[key] = to_bgr(self.rgb, means)
+      self._bgr[key].flags.writeable = False
+    return self._bgr[key]
+
+  def at(self, scale):
+    ''' the image at 1/scale of its full size, decoded from the file by read_rgb() if there is one '''
+    if scale == self.scale:
+      return self
+    if scale not in self._scaled:
+      self._scaled[scale] = Decoded(self._source, scale)
+    return self._scaled[scale]
+
+
+def load_bgr(input, means, scale=1):
+  ''' read a image as the CNN extractors expect it, see to_bgr()
+
+    arguments
+      input: a path to a image, a RGB image as a numpy array or a Decoded
+      means: mean of three channels in the order of BGR
+      scale: one of scales, the image is read at 1/scale of its size
+  '''
+  if isinstance(input, Decoded):
+    return input.at(scale).bgr(means)
+  if isinstance(input, np.ndarray):
+    return to_bgr(reduce_image(input[:, :, :3], scale), means)
+  return to_bgr(read_rgb(input, scale), means)
+
+
+class BatchLoader(object):
+  ''' decode images in background threads and group them into batches of same-shaped images
+
+      Iterating yields (indexes, batch) where batch is a numpy array with size N * C * H * W
+      and indexes are the positions of its images in paths. Batches come as soon as a shape
+      bucket is full, so they are not in the order of paths. Images whose load_fn raised are
+      left out and listed in failed as (index, path, exception).
+  '''
+
+  def __init__(self, paths, load_fn, batch_size=16, n_worker=4, prefetch=64):
+    '''
+      arguments
+        paths     : a list of paths to images
+        load_fn   : a function reading a path into a numpy array with size C * H * W
+        batch_size: max number of images in a batch
+        n_worker  : number of decoding threads
+        prefetch  : max number of images decoded ahead
+    '''
+    self.paths      = paths
+    self.load_fn    = load_fn
+    self.batch_size = batch_size
+    self.n_worker   = n_worker
+    self.prefetch   = max(prefetch, 1)
+    self.failed     = []
+
+  def __iter__(self):
+    buckets = {}  # shape -> [(index, image)]
+    todo = iter(enumerate(self.paths))
+    with ThreadPoolExecutor(max_workers=self.n_worker) as executor:
+      pending = deque()  # bounded queue of decodes in flight
+      for idx, path in todo:
+        pending.append((idx, path, executor.submit(self.load_fn, path)))
+        if len(pending) >= self.prefetch:
+          break
+      while pending:
+        idx, path, future = pending.popleft()
+        nxt = next(todo, None)
+        if nxt is not None:
+          pending.append((nxt[0], nxt[1], executor.submit(self.load_fn, nxt[1])))
+        try:
+          img = future.result()
+        except Exception as e:
+          self.failed.append((idx, path, e))
+          continue
+        bucket = buckets.setdefault(img.shape, [])
+        bucket.append((idx, img))
+        if len(bucket) >= self.batch_size:
+          yield self._batch(buckets.pop(img.shape))
+    for bucket in buckets.values():
+      yield self._batch(bucket)
+
+  def _batch(self, bucket):
+    idxs = [idx for idx, _ in bucket]
+    return idxs, np.stack([img for _, img in bucket])
@@ -0,0 +1,699 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import itertools
+import multiprocessing
+import sys
+import time
+
+import imageio
+import numpy as np
+
+from color import Color
+from evaluate import distance, distance_matrix, evaluate, rank
+from edge import Edge, edge_kernels
+from gabor import Gabor
+import HOG
+import daisy
+
+# Corel images are 384x256 (landscape) or 256x384 (portrait)
+img_shape = (256, 384, 3)
+repeat = 3  # timings keep the best of N runs
+
+
+def _load(path=None):
+    if path is None:
+        rng = np.random.RandomState(0)
+        return rng.randint(0, 256, size=img_shape).astype(np.uint8)
+    return imageio.imread(path)
+
+
+def _timeit(fn, *args, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, ret
+
+
+def _legacy_color_hist(img, n_bin, type, n_slice):
+    ''' the per-pixel Color histogram, kept as a reference for the benchmarks '''
+    def count(input):
+        img = input.copy()
+        bins_idx = {key: idx for idx, key in enumerate(itertools.product(
+            np.arange(n_bin), repeat=channel))}
+        hist = np.zeros(n_bin ** channel)
+        for idx in range(len(bins) - 1):
+            img[(input >= bins[idx]) & (input < bins[idx + 1])] = idx
+        height, width, _ = img.shape
+        for h in range(height):
+            for w in range(width):
+                hist[bins_idx[tuple(img[h, w])]] += 1
+        return hist
+
+    height, width, channel = img.shape
+    bins = np.linspace(0, 256, n_bin + 1, endpoint=True)
+    if type == 'global':
+        hist = count(img)
+    elif type == 'region':
+        hist = np.zeros((n_slice, n_slice, n_bin ** channel))
+        h_silce = np.around(np.linspace(0, height, n_slice + 1, endpoint=True)).astype(int)
+        w_slice = np.around(np.linspace(0, width, n_slice + 1, endpoint=True)).astype(int)
+        for hs in range(len(h_silce) - 1):
+            for ws in range(len(w_slice) - 1):
+                hist[hs][ws] = count(img[h_silce[hs]:h_silce[hs + 1], w_slice[ws]:w_slice[ws + 1]])
+    hist /= np.sum(hist)
+    return hist.flatten()
+
+
+def _legacy_edge_conv(img, stride, kernels):
+    ''' the per-window Edge._conv, kept as a reference for the benchmarks '''
+    H, W, C = img.shape
+    conv_kernels = np.tile(np.expand_dims(kernels, axis=3), (1, 1, 1, C))
+    sh, sw = stride
+    kn, kh, kw, kc = conv_kernels.shape
+    hh = int((H - kh) / sh + 1)
+    ww = int((W - kw) / sw + 1)
+    hist = np.zeros(kn)
+    for idx, k in enumerate(conv_kernels):
+        for h in range(hh):
+            for w in range(ww):
+                hist[idx] += np.sum(img[h * sh:h * sh + kh, w * sw:w * sw + kw] * k)
+    hist /= np.sum(hist)
+    return hist
+
+
+def bench_color(img, n_bin=12, n_slice=3):
+    ''' time Color.histogram against the per-pixel reference, for both histogram types '''
+    color = Color()
+    for h_type in ['global', 'region']:
+        t_old, old = _timeit(_legacy_color_hist, img, n_bin, h_type, n_slice)
+        t_new, new = _timeit(color.histogram, img, n_bin=n_bin, type=h_type, n_slice=n_slice)
+        assert np.array_equal(old, new), "histograms differ for type %s" % h_type
+        print("color, {}, n_bin{}, n_slice{}: loop {:.4f}s, bincount {:.4f}s, speedup x{:.1f}".format(
+            h_type, n_bin, n_slice, t_old, t_new, t_old / t_new))
+
+
+def bench_edge(img, strides=((1, 1), (2, 2))):
+    ''' time Edge._conv on the whole image against the per-window reference '''
+    edge = Edge()
+    for stride in strides:
+        t_old, old = _timeit(_legacy_edge_conv, img, stride, edge_kernels)
+        t_new, new = _timeit(edge._conv, img, stride, edge_kernels)
+        assert np.allclose(old, new), "edge histograms differ for stride %s" % (stride,)
+        print("edge, stride{}: loop {:.4f}s, strided sums {:.4f}s, speedup x{:.1f}".format(
+            stride, t_old, t_new, t_old / t_new))
+
+
+def bench_sweep(img, n_slices=(2, 3, 4, 5, 6, 8, 10)):
+    ''' time a full n_slice sweep from one integral histogram against one histogram() call per n_slice '''
+    for name, f in [('color', Color()), ('edge', Edge())]:
+        t_one, _ = _timeit(lambda: [f.histogram(img, type='region', n_slice=n) for n in n_slices])
+        t_sweep, hists = _timeit(f.region_histograms, img, n_slices)
+        for n in n_slices:
+            assert np.allclose(hists[n], f.histogram(img, type='region', n_slice=n)), "sweep differs for n_slice %d" % n
+        print("{}, n_slice sweep {}: per config {:.4f}s, integral {:.4f}s, speedup x{:.1f}".format(
+            name, list(n_slices), t_one, t_sweep, t_one / t_sweep))
+
+
+def bench_gabor(img, crop=(64, 96)):
+    ''' time the FFT filter bank against spatial convolutions, on a crop as the spatial mode is slow '''
+    img = img[:crop[0], :crop[1]]
+    spatial, fft = Gabor(n_worker=1, conv_mode='spatial'), Gabor(n_worker=1, conv_mode='fft')
+    t_old, old = _timeit(spatial.gabor_histogram, img, type='global')
+    fft.gabor_histogram(img, type='global')  # kernel spectra are cached per image shape
+    t_new, new = _timeit(fft.gabor_histogram, img, type='global')
+    assert np.allclose(old, new), "gabor histograms differ"
+    print("gabor, global, {}x{}: spatial {:.4f}s, fft {:.4f}s, speedup x{:.1f}".format(
+        crop[0], crop[1], t_old, t_new, t_old / t_new))
+
+
+def bench_gabor_pool(img, n_img=8, n_workers=None):
+    ''' images/sec of Gabor.histograms() with a persistent pool of growing size '''
+    if n_workers is None:
+        n_workers = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+    imgs = [img] * n_img
+    for n in n_workers:
+        gabor = Gabor(n_worker=n, chunk_size=max(1, n_img // (2 * n)))
+        if n > 1:
+            gabor.get_pool()  # the pool is persistent, do not time its start
+        t, _ = _timeit(gabor.histograms, imgs)
+        gabor.close()
+        print("gabor, {} workers: {:.2f} images/s".format(n, n_img / t))
+
+
+def bench_parallel(img, n_img=64, n_workers=None):
+    ''' images/sec of Color, Edge, HOG and Daisy through the process-parallel driver, with a growing pool '''
+    import parallel
+    if n_workers is None:
+        n_workers = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+    imgs = [img] * n_img
+    for name, f in [('color', Color()), ('edge', Edge()), ('hog', HOG.HOG()), ('daisy', daisy.Daisy())]:
+        rates = []
+        for n in n_workers:  # the pool start is timed, make_samples starts one for its whole cache.update()
+            t, _ = _timeit(lambda: list(parallel.imap_histograms(f, imgs, n_worker=n, chunk_size=max(1, n_img // (4 * n)))))
+            rates.append(n_img / t)
+        print("{}, parallel: {}, x{:.1f} on {} workers".format(
+            name, ", ".join("{} workers {:.1f} images/s".format(n, r) for n, r in zip(n_workers, rates)),
+            rates[-1] / rates[0], n_workers[-1]))
+
+
+def bench_hog(img, n_img=8):
+    ''' time HOG region histograms from one whole-image pass against one hog() call per region '''
+    hog, mode = HOG.HOG(), HOG.region_mode
+    try:
+        HOG.region_mode = 'crop'
+        t_old, _ = _timeit(hog.histogram, img, type='region')
+        HOG.region_mode = 'whole'
+        t_new, _ = _timeit(hog.histogram, img, type='region')
+        t_batch, _ = _timeit(hog.batch_histogram, np.stack([img] * n_img), type='region')
+    finally:
+        HOG.region_mode = mode
+    print("hog, region, n_slice{}: crop {:.4f}s, whole {:.4f}s, speedup x{:.1f}, batch of {} {:.4f}s/image".format(
+        HOG.n_slice, t_old, t_new, t_old / t_new, n_img, t_batch / n_img))
+
+
+def bench_daisy(img, n_slices=(2, 4, 8)):
+    ''' time Daisy region histograms pooled from one dense daisy against one daisy() call per region '''
+    dsy, mode = daisy.Daisy(), daisy.region_mode
+    try:
+        for n in n_slices:
+            daisy.region_mode = 'crop'
+            t_old, _ = _timeit(dsy.histogram, img, type='region', n_slice=n)
+            daisy.region_mode = 'whole'
+            t_new, _ = _timeit(dsy.histogram, img, type='region', n_slice=n)
+            print("daisy, region, n_slice{}: crop {:.4f}s, whole {:.4f}s, speedup x{:.1f}".format(
+                n, t_old, t_new, t_old / t_new))
+    finally:
+        daisy.region_mode = mode
+
+
+def bench_cold_start(models=('resnet18', 'resnet34', 'resnet50', 'resnet101', 'resnet152',
+                             'vgg11', 'vgg13', 'vgg16', 'vgg19')):
+    ''' seconds from nothing to a first forward pass, with weights of the model store
+
+        eager: layers initialized, then the whole checkpoint read and copied in, as before the store
+        store: layers built on the meta device, then the memory-mapped checkpoint assigned
+        the store file is in the page cache after the first run, which is the case on a warm node
+    '''
+    import torch
+    import model_store
+    from resnet import ResidualNet
+    from vggnet import VGGNet
+
+    x = torch.from_numpy(np.random.RandomState(0).rand(1, 3, 224, 224)).float()
+
+    def build(model, pretrained):
+        if model.startswith('resnet'):
+            return ResidualNet(model=model, pretrained=pretrained)
+        return VGGNet(model=model, pretrained=pretrained)
+
+    def eager(model):
+        net = build(model, False)
+        net.load_state_dict(torch.load(model_store.weights_path(model), map_location='cpu', weights_only=True))
+        with torch.no_grad():
+            return net.eval()(x)
+
+    def store(model):
+        net = build(model, True)
+        with torch.no_grad():
+            return net.eval()(x)
+
+    for model in models:
+        if not model_store.has_weights(model):
+            print("{}: not in the model store, skipped".format(model))
+            continue
+        t_old, old = _timeit(eager, model)
+        t_new, new = _timeit(store, model)
+        assert all(torch.allclose(old[k], new[k]) for k in old), "outputs differ for %s" % model
+        print("{}, cold start: eager {:.3f}s, store {:.3f}s, speedup x{:.1f}".format(model, t_old, t_new, t_old / t_new))
+
+
+def _vgg_peak(model, heads, n_img):
+    import resource
+    import torch
+    from vggnet import VGGNet
+
+    x = torch.from_numpy(np.random.RandomState(0).rand(1, 3, img_shape[0], img_shape[1])).float()
+    net = VGGNet(model=model, heads=heads).eval()
+    with torch.no_grad():
+        net(x)
+        start = time.perf_counter()
+        for _ in range(n_img):
+            net(x)
+    return (time.perf_counter() - start) / n_img, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def bench_vgg_heads(model='vgg19', n_img=8):
+    ''' per-image latency and peak RSS of a VGG built for every head against one built for 'avg' only,
+        each in a fresh process '''
+    ctx = multiprocessing.get_context('spawn')
+    for heads in [None, ['avg']]:
+        with ctx.Pool(1) as pool:
+            latency, rss = pool.apply(_vgg_peak, (model, heads, n_img))
+        print("{}, heads {}: {:.4f}s/image, peak RSS {:.0f}MB".format(model, heads or 'all', latency, rss))
+
+
+def bench_predict(n_img=32):
+    ''' images/s of evaluation_CNN classifying the CorelDB test split, the former per-image loop
+        rebuilding both models for each image against the load-once Predictor '''
+    import evaluation_CNN as cnn
+    from DB import Database
+
+    paths = list(Database(DB_dir="CorelDBDataSet/test", DB_csv="CorelDBDataSetTest.csv").get_data().img)
+
+    def legacy(paths):
+        class_dictionary = np.load(cnn.class_indices_path, allow_pickle=True).item()
+        for image_path in paths:
+            image = np.expand_dims(cnn.load_image(image_path), axis=0)
+            model = cnn.applications.VGG16(include_top=False, weights='imagenet')
+            bottleneck_prediction = model.predict(image)
+            model = cnn.top_model(bottleneck_prediction.shape[1:], len(class_dictionary))
+            model.load_weights(cnn.top_model_weights_path)
+            model.predict(bottleneck_prediction)
+
+    start = time.perf_counter()
+    legacy(paths[:n_img])  # the loop is slow, it only runs on the first n_img images
+    t_old = (time.perf_counter() - start) / min(n_img, len(paths))
+    start = time.perf_counter()
+    predictor = cnn.Predictor()
+    t_build = time.perf_counter() - start
+    start = time.perf_counter()
+    predictor.predict_paths(paths)
+    t_new = (time.perf_counter() - start) / len(paths)
+    print("predict, {} test images: loop {:.2f} images/s, predictor {:.2f} images/s (built in {:.2f}s), speedup x{:.1f}".format(
+        len(paths), 1 / t_old, 1 / t_new, t_build, t_old / t_new))
+
+
+class _StubKeras(object):
+    ''' a stand-in for the keras and matplotlib modules evaluation_CNN imports, to run its code paths without them
+
+        VGG16 keeps a 2 * 3 * 3 corner of every image as its bottleneck, the top model is a fixed
+        random linear layer followed by a softmax
+    '''
+
+    names = ['keras', 'keras.applications', 'keras.layers', 'keras.models', 'keras.preprocessing',
+             'keras.preprocessing.image', 'keras.utils', 'keras.utils.np_utils', 'matplotlib', 'matplotlib.pyplot']
+
+    def __enter__(self):
+        import types
+        from PIL import Image
+
+        class VGG16(object):
+            output_shape = (None, 2, 3, 3)
+
+            def __init__(self, include_top=False, weights=None):
+                pass
+
+            def predict_on_batch(self, images):
+                return np.asarray(images, dtype=np.float32)[:, :2, :3].copy()
+
+        class Layer(object):
+            def __init__(self, units=None, activation=None, input_shape=None):
+                self.units, self.input_shape = units, input_shape
+
+        class Sequential(object):
+            def __init__(self):
+                self.layers = []
+
+            def add(self, layer):
+                self.layers.append(layer)
+
+            def load_weights(self, path):
+                n_in = int(np.prod(self.layers[0].input_shape))
+                self.w = np.random.RandomState(0).randn(n_in, self.layers[-1].units)
+
+            def predict_on_batch(self, x):
+                z = np.asarray(x).reshape(len(x), -1).dot(self.w)
+                z = np.exp(z - z.max(axis=1, keepdims=True))
+                return z / z.sum(axis=1, keepdims=True)
+
+        def load_img(path, target_size):
+            return Image.open(path).convert('RGB').resize(target_size[::-1])
+
+        modules = {name: types.ModuleType(name) for name in self.names}  # the plots are not stubbed
+        modules['matplotlib'].pyplot = modules['matplotlib.pyplot']
+        modules['keras.applications'].VGG16 = VGG16
+        for name in ['Dropout', 'Flatten', 'Dense']:
+            setattr(modules['keras.layers'], name, Layer)
+        modules['keras.models'].Sequential = Sequential
+        image = modules['keras.preprocessing.image']
+        image.ImageDataGenerator, image.load_img = object, load_img
+        image.img_to_array = lambda img: np.asarray(img, dtype=np.float32)
+        modules['keras.utils.np_utils'].to_categorical = lambda y, num_classes: np.eye(num_classes)[y]
+
+        self.saved = {name: sys.modules.get(name) for name in self.names + ['evaluation_CNN']}
+        sys.modules.update(modules)
+        sys.modules.pop('evaluation_CNN', None)
+        import evaluation_CNN
+        return evaluation_CNN
+
+    def __exit__(self, *exc):
+        for name, module in self.saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+
+def smoke_predict(n_img=10, path='cache/smoke_predict'):
+    ''' run evaluation_CNN.Predictor and predict() with Keras stubbed, see _StubKeras: the batches,
+        the order of the predictions, the unreadable images and the csv written '''
+    import os
+    import shutil
+    import pandas as pd
+
+    cwd = os.getcwd()
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        rng = np.random.RandomState(0)
+        for idx in range(n_img):
+            out = os.path.join(path, 'CorelDBDataSet', 'test', 'c%d' % (idx % 3))
+            if not os.path.isdir(out):
+                os.makedirs(out)
+            imageio.imwrite(os.path.join(out, '%d.jpg' % idx), rng.randint(0, 256, (60 + idx, 90, 3)).astype(np.uint8))
+        with open(os.path.join(path, 'CorelDBDataSet', 'test', 'c0', 'broken.jpg'), 'wb') as f:
+            f.write(b'not a jpeg')
+        with _StubKeras() as cnn:
+            os.chdir(path)  # predict() reads the test split and writes into cache/ of the working directory
+            os.makedirs('cache')
+            np.save(cnn.class_indices_path, {'c0': 0, 'c1': 1, 'c2': 2})
+            predictor = cnn.Predictor()
+            labels, probabilities = cnn.predict(predictor)
+            results = pd.read_csv(cnn.predictions_path)
+            paths = list(results.img)
+            ok = [p for p in paths if not p.endswith('broken.jpg')]
+            one_by_one = [predictor.predict_batch([p]) for p in ok]
+        assert list(labels[[paths.index(p) for p in ok]]) == [l[0] for l, _ in one_by_one], "labels out of order"
+        assert np.allclose(probabilities[[paths.index(p) for p in ok]], np.concatenate([p for _, p in one_by_one]))
+        assert labels[paths.index([p for p in paths if p.endswith('broken.jpg')][0])] is None
+        assert list(results.columns[-3:]) == ['p_c0', 'p_c1', 'p_c2'] and len(results) == n_img + 1
+        print("predict, stubbed keras: {} images and 1 unreadable, batched labels and probabilities match "
+              "one by one, {} written".format(n_img, cnn.predictions_path))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def smoke_bottleneck(n_img=37, crash_at=1, path='cache/smoke_bottleneck'):
+    ''' run evaluation_CNN._save_bottleneck and load_bottleneck with Keras stubbed, see _StubKeras:
+        an extraction that crashes after crash_at batches resumes from there, a rerun with other
+        images starts over and incomplete features are refused '''
+    import os
+    import shutil
+
+    class Generator(object):  # the batches of flow_from_directory, with class_mode None
+        def __init__(self, images, filenames, batch_size):
+            self.images, self.filenames, self.batch_size = images, filenames, batch_size
+
+        def __getitem__(self, idx):
+            return self.images[idx * self.batch_size:(idx + 1) * self.batch_size]
+
+    class Model(object):
+        def __init__(self, backbone, crash_at=None):
+            self.backbone, self.crash_at, self.calls = backbone, crash_at, 0
+            self.output_shape = backbone.output_shape
+
+        def predict_on_batch(self, batch):
+            if self.calls == self.crash_at:
+                raise KeyboardInterrupt("crash")
+            self.calls += 1
+            return self.backbone.predict_on_batch(batch)
+
+    cwd = os.getcwd()
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(os.path.join(path, 'cache'))
+    try:
+        with _StubKeras() as cnn:
+            os.chdir(path)  # the features are written into cache/ of the working directory
+            images = np.random.RandomState(0).rand(n_img, 8, 8, 3).astype(np.float32)
+            filenames = ['c%d/%d.jpg' % (idx % 3, idx) for idx in range(n_img)]
+            generator = Generator(images, filenames, cnn.batch_size)
+            backbone = cnn.applications.VGG16()
+            n_batch = -(-n_img // cnn.batch_size)
+            try:
+                cnn._save_bottleneck(Model(backbone, crash_at), generator, 'smoke')
+            except KeyboardInterrupt:
+                pass
+            try:
+                cnn.load_bottleneck('smoke')
+                refused = False
+            except AssertionError:
+                refused = True
+            assert refused, "incomplete features were loaded"
+            resumed = Model(backbone)
+            cnn._save_bottleneck(resumed, generator, 'smoke')
+            features = cnn.load_bottleneck('smoke')
+            assert resumed.calls == n_batch - crash_at, "resumed from batch %d" % (n_batch - resumed.calls)
+            assert isinstance(features, np.memmap) and np.array_equal(features, backbone.predict_on_batch(images))
+            del features
+            again = Model(backbone)
+            cnn._save_bottleneck(again, Generator(images[::-1].copy(), filenames[::-1], cnn.batch_size), 'smoke')
+            assert again.calls == n_batch, "other images did not start over"
+            assert np.array_equal(cnn.load_bottleneck('smoke'), backbone.predict_on_batch(images[::-1]))
+        print("bottleneck, stubbed keras: {} images in {} batches, crash after {} resumed with {} batches, "
+              "other images start over, incomplete features refused".format(
+                  n_img, n_batch, crash_at, n_batch - crash_at))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def bench_distance(n_query=64, n_sample=5000, dim=512, d_types=('d1', 'd2', 'd3', 'd4', 'd5', 'd6', 'cosine')):
+    ''' time distance_matrix() against one distance() call per pair, on random histograms '''
+    rng = np.random.RandomState(0)
+    samples = rng.rand(n_sample, dim)
+    samples /= samples.sum(axis=1, keepdims=True)
+    queries = samples[:n_query]
+    tied = np.round(rng.rand(n_sample, dim) * 4) / 4 + 0.05  # rounded histograms, many distances are tied
+    tied /= tied.sum(axis=1, keepdims=True)
+    tied[n_sample // 2:] = tied[:n_sample - n_sample // 2]
+    for d_type in d_types:
+        t_old, old = _timeit(lambda: [[distance(q, x, d_type) for x in samples] for q in queries[:4]])
+        t_old *= n_query / 4.  # the pairwise loop only runs on a few queries
+        t_new, new = _timeit(distance_matrix, queries, samples, d_type)
+        assert np.allclose(old, new[:4], rtol=1e-12, atol=1e-12), "distances differ for %s" % d_type
+        old = [[distance(q, x, d_type) for x in tied] for q in tied[:4]]
+        assert np.array_equal(rank(np.array(old)), rank(distance_matrix(tied[:4], tied, d_type))), \
+            "tied distances are ranked differently for %s" % d_type
+        for scale in (1e-3, 1e3):  # ties are relative to the distances, whatever the scale of the features
+            scaled = distance_matrix(queries * scale, samples * scale, d_type)
+            assert np.array_equal(rank(scaled, k=100), np.argsort(scaled, axis=1, kind='stable')[:, :100]), \
+                "distances at scale %g are not ranked by distance for %s" % (scale, d_type)
+        print("distance, {}, {}x{}x{}: pairwise {:.3f}s, matrix {:.4f}s, speedup x{:.1f}".format(
+            d_type, n_query, n_sample, dim, t_old, t_new, t_old / t_new))
+
+
+def bench_hnsw(sizes=(20000, 100000), dim=512, d_types=('d1',), ef_searches=(10, 40, 80)):
+    ''' recall and latency of the HNSW index against exact search as the index grows, on clustered random
+        descriptors, see hnsw.recall_report() '''
+    import hnsw
+
+    rng = np.random.RandomState(0)
+    for n_sample in sizes:
+        centers = rng.randn(n_sample // 100, dim)
+        X = centers[rng.randint(len(centers), size=n_sample)] + 0.5 * rng.randn(n_sample, dim)
+        samples = [{'img': str(i), 'cls': 'class0', 'hist': x} for i, x in enumerate(X)]
+        for d_type in d_types:
+            hnsw.recall_report(samples, d_type=d_type, ef_searches=ef_searches, name='hnsw, %s, %d' % (d_type, n_sample))
+
+
+def bench_store(n_sample=10000, dim=512, path='cache/bench_store'):
+    ''' time loading samples from the columnar store against unpickling a list of sample dicts '''
+    import os
+    from six.moves import cPickle
+    import store
+
+    rng = np.random.RandomState(0)
+    samples = [{'img': 'image/%d.jpg' % i, 'cls': 'class%d' % (i % 10), 'hist': rng.rand(dim)}
+               for i in range(n_sample)]
+    cPickle.dump(samples, open(path + '.pkl', "wb"))
+    store.save_samples(path, samples)
+    t_old, _ = _timeit(lambda: cPickle.load(open(path + '.pkl', "rb")))
+    t_new, _ = _timeit(store.load_samples, path)
+    t_matrix, _ = _timeit(lambda: store.FeatureStore(path).features())
+    print("store, {}x{}: pickle {:.4f}s, store samples {:.4f}s, store matrix {:.5f}s, speedup x{:.1f}".format(
+        n_sample, dim, t_old, t_new, t_matrix, t_old / t_new))
+    os.remove(path + '.pkl')
+    os.remove(path)
+
+
+def bench_incremental(img, n_img=400, fraction=0.01, path='cache/bench_incremental'):
+    ''' time a full build of the Color samples against an update after adding fraction of new images '''
+    import os
+    import shutil
+    import color
+    from DB import Database
+
+    rng = np.random.RandomState(0)
+    shutil.rmtree(path, ignore_errors=True)
+    n_new = max(1, int(n_img * fraction))
+
+    def write(i):
+        cls_dir = os.path.join(path, 'db', 'class%d' % (i % 10))
+        if not os.path.isdir(cls_dir):
+            os.makedirs(cls_dir)
+        noise = rng.randint(0, 16, img.shape)
+        imageio.imwrite(os.path.join(cls_dir, '%d.jpg' % i), np.clip(img + noise, 0, 255).astype(np.uint8))
+
+    for i in range(n_img - n_new):
+        write(i)
+    cache_dir, color.cache_dir = color.cache_dir, path
+    try:
+        start = time.time()
+        color.Color().make_samples(Database(os.path.join(path, 'db'), os.path.join(path, 'db.csv')), verbose=False)
+        t_full = time.time() - start
+        for i in range(n_img - n_new, n_img):
+            write(i)
+        start = time.time()
+        samples = color.Color().make_samples(Database(os.path.join(path, 'db'), os.path.join(path, 'db.csv')), verbose=False)
+        t_update = time.time() - start
+    finally:
+        color.cache_dir = cache_dir
+        shutil.rmtree(path, ignore_errors=True)
+    print("incremental, {} + {} images: full build {:.2f}s, update {:.3f}s ({:.1%} of full), {} samples".format(
+        n_img - n_new, n_new, t_full, t_update, t_update / t_full, len(samples)))
+
+
+def bench_pipeline(img, n_img=32, methods=('color', 'daisy', 'edge', 'hog', 'gabor'), path='cache/bench_pipeline'):
+    ''' time the make_samples() of every extractor in turn against one Pipeline pass decoding every image once '''
+    import os
+    import shutil
+    from DB import Database
+    from pipeline import Pipeline
+    from retriever import extractors, make_extractor
+
+    rng = np.random.RandomState(0)
+    shutil.rmtree(path, ignore_errors=True)
+    for i in range(n_img):
+        cls_dir = os.path.join(path, 'db', 'class%d' % (i % 4))
+        if not os.path.isdir(cls_dir):
+            os.makedirs(cls_dir)
+        noise = rng.randint(0, 16, img.shape)
+        imageio.imwrite(os.path.join(cls_dir, '%d.jpg' % i), np.clip(img + noise, 0, 255).astype(np.uint8))
+    db = Database(os.path.join(path, 'db'), os.path.join(path, 'db.csv'))
+    cache_dirs = {method: extractors[method].cache_dir for method in methods}
+    try:
+        for method in methods:
+            extractors[method].cache_dir = os.path.join(path, 'one_by_one')
+        if not os.path.isdir(os.path.join(path, 'one_by_one')):
+            os.makedirs(os.path.join(path, 'one_by_one'))
+        start = time.time()
+        for method in methods:
+            make_extractor(method).make_samples(db, verbose=False)
+        t_old = time.time() - start
+        for method in methods:
+            extractors[method].cache_dir = os.path.join(path, 'pipeline')
+        if not os.path.isdir(os.path.join(path, 'pipeline')):
+            os.makedirs(os.path.join(path, 'pipeline'))
+        start = time.time()
+        Pipeline(methods).make_samples(db, verbose=False)
+        t_new = time.time() - start
+    finally:
+        for method in methods:
+            extractors[method].cache_dir = cache_dirs[method]
+        shutil.rmtree(path, ignore_errors=True)
+    print("pipeline, {}, {} images: one by one {:.2f}s ({} decodes), one pass {:.2f}s ({} decodes), speedup x{:.2f}".format(
+        ",".join(methods), n_img, t_old, n_img * len(methods), t_new, n_img, t_old / t_new))
+
+
+def bench_decode(img, n_img=32, path='cache/bench_decode.jpg'):
+    ''' images/s of read_rgb() at every decode scale, the JPEG decoder scales on its DCT blocks,
+        against reads served by the decoded-image cache '''
+    import os
+    import batching
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    imageio.imwrite(path, img[:, :, :3].astype(np.uint8))
+    max_bytes = batching.image_cache.max_bytes
+    try:
+        batching.image_cache.max_bytes = 0  # every read decodes
+        rates = []
+        for scale in batching.scales:
+            t, out = _timeit(lambda: [batching.read_rgb(path, scale) for _ in range(n_img)])
+            rates.append(n_img / t)
+            print("decode, scale 1/{}: {}x{}, {:.1f} images/s, x{:.1f} of full scale".format(
+                scale, out[0].shape[1], out[0].shape[0], rates[-1], rates[-1] / rates[0]))
+        batching.image_cache.max_bytes = max_bytes
+        batching.image_cache.clear()
+        t, _ = _timeit(lambda: [batching.read_rgb(path) for _ in range(n_img)])
+        print("decode, cached: {:.1f} images/s, x{:.1f} of full scale".format(n_img / t, n_img / t / rates[0]))
+    finally:
+        batching.image_cache.max_bytes = max_bytes
+        batching.image_cache.clear()
+        os.remove(path)
+
+
+def _MMAP(APs):
+    return np.mean([np.mean(cls_APs) for cls_APs in APs.values()])
+
+
+def compare_precisions(db, f_class, precisions=('fp32', 'bf16', 'int8-dynamic', 'int8-static'),
+                       depths=(1, 5, 30), d_type='d1'):
+    ''' images/s of a CNN extractor in each precision and its MMAP change against fp32
+
+      arguments
+        db        : an instance of class Database
+        f_class   : ResNetFeat or VGGNetFeat
+        precisions: precisions to compare, see precision.precisions
+        depths    : retrieved depths the MMAP is computed at
+        d_type    : distance type
+    '''
+    data, MMAPs = db.get_data(), {}
+    for prec in precisions:
+        f = f_class(precision=prec)
+        if f.precision != prec:
+            print("{}, {}: not supported by this CPU, skipped".format(f_class.__name__, prec))
+            continue
+        model = f.build_model(db)
+        samples = f.extract(model, data, verbose=False)
+        samples = [{'img': s['img'], 'cls': s['cls'], 'hist': s['feats'][f.pick_layer]} for s in samples]
+        MMAPs[prec] = [_MMAP(evaluate(db, lambda db: samples, depth=d, d_type=d_type)) for d in depths]
+        print("{}, {}: {:.2f} images/s, {}".format(f_class.__name__, prec, f.throughput, ", ".join(
+            "depth{} MMAP {:.4f} ({:+.4f})".format(d, m, m - MMAPs[precisions[0]][i])
+            for i, (d, m) in enumerate(zip(depths, MMAPs[prec])))))
+    return MMAPs
+
+
+def compare_hog_modes(db, depths=(1, 5, 30), d_type='d1'):
+    ''' MMAP of the HOG region samples of the whole-image pass against the per-region hog() calls
+
+      arguments
+        db    : an instance of class Database
+        depths: retrieved depths the MMAP is computed at
+        d_type: distance type
+    '''
+    mode, MMAPs = HOG.region_mode, {}
+    try:
+        for m in ('crop', 'whole'):
+            HOG.region_mode = m  # a cache of its own, see HOG.sample_store()
+            samples = HOG.HOG().make_samples(db, verbose=False)
+            MMAPs[m] = [_MMAP(evaluate(db, lambda db: samples, depth=d, d_type=d_type)) for d in depths]
+    finally:
+        HOG.region_mode = mode
+    print("hog, region, n_slice{}: {}".format(HOG.n_slice, ", ".join(
+        "depth{} MMAP crop {:.4f}, whole {:.4f} ({:+.4f})".format(d, c, w, w - c)
+        for d, c, w in zip(depths, MMAPs['crop'], MMAPs['whole']))))
+    return MMAPs
+
+
+if __name__ == "__main__":
+    img = _load(sys.argv[1] if len(sys.argv) > 1 else None)
+    print("image shape:", img.shape)
+
+    bench_color(img)
+    bench_edge(img)
+    bench_sweep(img)
+    bench_hog(img)
+    bench_daisy(img)
+    bench_gabor(img)
+    bench_gabor_pool(img)
+    bench_parallel(img)
+    bench_pipeline(img)
+    bench_decode(img)
+    smoke_predict()
+    smoke_bottleneck()
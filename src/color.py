@@ -2,20 +2,22 @@
 
 from __future__ import print_function
 
-import itertools
 import os
 
-import imageio
 import numpy as np
-from six.moves import cPickle
 
 from DB import Database
+from store import SegmentedStore
+from parallel import HistogramPool, extract_histograms
+from batching import Decoded, read_rgb, reduce_image, scaled_cache
+from integral import IntegralHistogram, slice_bounds
 from evaluate_classification import evaluate_class
 
 # configs for histogram
 n_bin = 12  # histogram bins
 n_slice = 3  # slice image
 h_type = 'region'  # global or region
+decode_scale = 1  # images are decoded at 1/decode_scale of their size, see batching.read_rgb()
 d_type = 'd1'  # distance type
 
 depth = 3  # retrieved depth, set to None will count the ap for whole database
@@ -70,7 +72,7 @@ class Color(object):
         ''' count img color histogram
 
           arguments
-            input    : a path to a image or a numpy.ndarray
+            input    : a path to a image, a numpy.ndarray or a Decoded
             n_bin    : number of bins for each channel
             type     : 'global' means count the histogram for whole image
                        'region' means count the histogram for regions in images, then concatanate all of them
@@ -83,11 +85,12 @@ class Color(object):
             type == 'region'
               a numpy array with size n_slice * n_slice * (n_bin ** channel)
         '''
-        global hist
-        if isinstance(input, np.ndarray):  # examinate input type
-            img = input.copy()
+        if isinstance(input, Decoded):  # examinate input type
+            img = input.at(decode_scale).rgb
+        elif isinstance(input, np.ndarray):
+            img = reduce_image(input, decode_scale).copy()
         else:
-            img = imageio.imread(input)
+            img = read_rgb(input, decode_scale)
         height, width, channel = img.shape
         # slice bins equally for each channel
         bins = np.linspace(0, 256, n_bin + 1, endpoint=True)
@@ -96,81 +99,146 @@ class Color(object):
             hist = self._count_hist(img, n_bin, bins, channel)
 
         elif type == 'region':
-            hist = np.zeros((n_slice, n_slice, n_bin ** channel))
-            h_silce = np.around(np.linspace(
-                0, height, n_slice + 1, endpoint=True)).astype(int)
-            w_slice = np.around(np.linspace(
-                0, width, n_slice + 1, endpoint=True)).astype(int)
-
-            for hs in range(len(h_silce) - 1):
-                for ws in range(len(w_slice) - 1):
-                    # slice img to regions
-                    img_r = img[h_silce[hs]:h_silce[hs + 1],
-                                w_slice[ws]:w_slice[ws + 1]]
-                    hist[hs][ws] = self._count_hist(
-                        img_r, n_bin, bins, channel)
+            table = self.integral_histogram(img, n_bin, bins, channel, [n_slice])
+            hist = table.grid(slice_bounds(height, n_slice),
+                              slice_bounds(width, n_slice)).astype(np.float64)
 
         if normalize:
             hist /= np.sum(hist)
 
         return hist.flatten()
 
+    def _bin_index(self, input, n_bin, bins, channel):
+        ''' map every pixel to its joint bin, bins are ordered like itertools.product(range(n_bin), repeat=channel)
+
+          return
+            a numpy array with size height * width
+        '''
+        if input.dtype == np.uint8:
+            # look up table of the 256 possible values
+            lut = np.searchsorted(bins, np.arange(256), side='right') - 1
+            idx = lut[input]
+        else:
+            idx = np.searchsorted(bins, input, side='right') - 1
+        b_idx = np.zeros(input.shape[:2], dtype=np.int64)
+        for c in range(channel):
+            b_idx = b_idx * n_bin + idx[:, :, c]
+
+        return b_idx
+
     def _count_hist(self, input, n_bin, bins, channel):
-        img = input.copy()
-        bins_idx = {key: idx for idx, key in enumerate(itertools.product(
-            np.arange(n_bin), repeat=channel))}  # permutation of bins
-        hist = np.zeros(n_bin ** channel)
-
-        # cluster every pixels
-        for idx in range(len(bins) - 1):
-            img[(input >= bins[idx]) & (input < bins[idx + 1])] = idx
-        # add pixels into bins
+        b_idx = self._bin_index(input, n_bin, bins, channel)
+        hist = np.bincount(b_idx.ravel(), minlength=n_bin ** channel)
+
+        return hist.astype(np.float64)
+
+    def integral_histogram(self, img, n_bin, bins, channel, n_slices):
+        ''' integral histogram of img, kept at the region borders of every n_slice in n_slices '''
         height, width, _ = img.shape
-        for h in range(height):
-            for w in range(width):
-                b_idx = bins_idx[tuple(img[h, w])]
-                hist[b_idx] += 1
+        h_cuts = np.concatenate([slice_bounds(height, n) for n in n_slices])
+        w_cuts = np.concatenate([slice_bounds(width, n) for n in n_slices])
+        b_idx = self._bin_index(img, n_bin, bins, channel)
 
-        return hist
+        return IntegralHistogram.from_bins(b_idx, n_bin ** channel, h_cuts, w_cuts)
+
+    def region_histograms(self, input, n_slices, n_bin=n_bin, normalize=True):
+        ''' count region histograms of img for several n_slice in one pass
+
+          arguments
+            input    : a path to a image or a numpy.ndarray
+            n_slices : a list of n_slice, see histogram()
+            n_bin    : number of bins for each channel
+            normalize: normalize output histograms
+
+          return
+            a dict {n_slice: histogram(input, n_bin, type='region', n_slice)}
+        '''
+        if isinstance(input, Decoded):  # examinate input type
+            img = input.at(decode_scale).rgb
+        elif isinstance(input, np.ndarray):
+            img = reduce_image(input, decode_scale)
+        else:
+            img = read_rgb(input, decode_scale)
+        height, width, channel = img.shape
+        bins = np.linspace(0, 256, n_bin + 1, endpoint=True)
+
+        table = self.integral_histogram(img, n_bin, bins, channel, n_slices)
+        hists = {}
+        for n in n_slices:
+            hist = table.grid(slice_bounds(height, n), slice_bounds(width, n)).astype(np.float64)
+            if normalize:
+                hist /= np.sum(hist)
+            hists[n] = hist.flatten()
+
+        return hists
+
+    def _sample_cache(self, type, n_bin, n_slice):
+        if type == 'global':
+            return "histogram_cache-{}-n_bin{}".format(type, n_bin)
+        elif type == 'region':
+            return "histogram_cache-{}-n_bin{}-n_slice{}".format(type, n_bin, n_slice)
+
+    def feature(self, input):
+        ''' the histogram of a image as make_samples() stores it, with the configs of the module '''
+        return self.histogram(input, type=h_type, n_bin=n_bin, n_slice=n_slice)
+
+    def sample_store(self):
+        ''' the store of the samples, with the configs of the module '''
+        sample_cache, config = scaled_cache(self._sample_cache(h_type, n_bin, n_slice),
+                                            {'extractor': 'color', 'h_type': h_type, 'n_bin': n_bin, 'n_slice': n_slice},
+                                            decode_scale)
+        return SegmentedStore(os.path.join(cache_dir, sample_cache), config)
 
     def make_samples(self, db, verbose=True):
-        global sample_cache
-        if h_type == 'global':
-            sample_cache = "histogram_cache-{}-n_bin{}".format(h_type, n_bin)
-        elif h_type == 'region':
-            sample_cache = "histogram_cache-{}-n_bin{}-n_slice{}".format(
-                h_type, n_bin, n_slice)
-
-        try:
-            samples = cPickle.load(
-                open(os.path.join(cache_dir, sample_cache), "rb", True))
-            if verbose:
-                print("Using cache..., config=%s, distance=%s, depth=%s" %
-                      (sample_cache, d_type, depth))
-        except:
+        cache = self.sample_store()
+        sample_cache = os.path.basename(cache.path)
+        pool = HistogramPool(self, type=h_type, n_bin=n_bin, n_slice=n_slice)  # started once, for all the checkpoints
+
+        def compute(data):
             if verbose:
-                print("Counting histogram..., config=%s, distance=%s, depth=%s" % (
-                    sample_cache, d_type, depth))
-            samples = []
-            data = db.get_data()
-            for d in data.itertuples():
-                d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-                d_hist = self.histogram(
-                    d_img, type=h_type, n_bin=n_bin, n_slice=n_slice)
-                samples.append({
+                print("Counting histogram..., config=%s, distance=%s, depth=%s, %d images" % (
+                    sample_cache, d_type, depth, len(data)))
+            return extract_histograms(self, data, normalize=False, verbose=verbose, pool=pool)
+
+        with pool:
+            changes = cache.update(db, compute)
+        if verbose:
+            print("Using cache..., config=%s, distance=%s, depth=%s, %d added, %d changed, %d removed, %d quarantined" % (
+                sample_cache, d_type, depth, changes['added'], changes['changed'], changes['removed'],
+                changes['quarantined']))
+        return cache.samples(db)
+
+    def make_sweep_samples(self, db, n_slices, verbose=True):
+        ''' make the region samples of several n_slice, reading every image once
+
+          return
+            a dict {n_slice: samples}
+        '''
+        caches = {n: scaled_cache(self._sample_cache('region', n_bin, n),
+                                  {'extractor': 'color', 'h_type': 'region', 'n_bin': n_bin, 'n_slice': n},
+                                  decode_scale) for n in n_slices}
+        if verbose:
+            print("Counting histograms..., configs=%s" % ", ".join(name for name, _ in caches.values()))
+
+        samples = {n: [] for n in n_slices}
+        data = db.get_data()
+        for d in data.itertuples():
+            d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
+            d_hists = self.region_histograms(d_img, n_slices, n_bin=n_bin)
+            for n in n_slices:
+                samples[n].append({
                     'img': d_img,
                     'cls': d_cls,
-                    'hist': d_hist
+                    'hist': d_hists[n]
                 })
-            cPickle.dump(samples, open(os.path.join(
-                cache_dir, sample_cache), "wb", True))
+        for n in n_slices:
+            cache = SegmentedStore(os.path.join(cache_dir, caches[n][0]), caches[n][1])
+            cache.write(db, {'hist': np.array([sample['hist'] for sample in samples[n]])}, list(data.img))
 
         return samples
 
 
 if __name__ == "__main__":
-    print("Pensez à supprimer le dossier cache dans le cas où vous utilisez des nouvelles données.\n")
-
     dbTrain = Database(DB_dir="CorelDBDataSet/train",
                        DB_csv="CorelDBDataSetTrain.csv")
                        
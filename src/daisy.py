@@ -5,13 +5,13 @@ from __future__ import print_function
 from evaluate import evaluate_class
 from evaluate_classification import evaluate_class
 from DB import Database
+from store import SegmentedStore
+from parallel import HistogramPool, extract_histograms
+from batching import Decoded, read_rgb, reduce_image, scaled_cache, to_gray
 
 from skimage.feature import daisy
-from skimage import color
 
-from six.moves import cPickle
 import numpy as np
-import imageio
 import math
 
 import os
@@ -23,7 +23,11 @@ radius = 15
 rings = 2
 histograms = 6
 h_type = 'region'
+decode_scale = 1  # images are decoded at 1/decode_scale of their size, see batching.read_rgb()
 d_type = 'd1'
+region_mode = 'crop'   # 'crop' runs daisy on every region, 'whole' pools regions from one dense daisy of the image,
+                       # it changes the region features and only gains from n_slice 4: x0.9 at n_slice 2,
+                       # x1.2 at 4, x1.5 at 8, see bench_daisy()
 
 depth = 3
 
@@ -62,7 +66,7 @@ class Daisy(object):
         ''' count img histogram
 
           arguments
-            input    : a path to a image or a numpy.ndarray
+            input    : a path to a image, a numpy.ndarray or a Decoded
             type     : 'global' means count the histogram for whole image
                        'region' means count the histogram for regions in images, then concatanate all of them
             n_slice  : work when type equals to 'region', height & width will equally sliced into N slices
@@ -76,11 +80,13 @@ class Daisy(object):
 
             #R = (rings * histograms + 1) * n_orient#
         '''
-        if isinstance(input, np.ndarray):  # examinate input type
-            img = input.copy()
+        if isinstance(input, Decoded):  # examinate input type
+            img = input.at(decode_scale).gray
+        elif isinstance(input, np.ndarray):
+            img = to_gray(reduce_image(input, decode_scale))
         else:
-            img = imageio.imread(input)
-        height, width, channel = img.shape
+            img = to_gray(read_rgb(input, decode_scale))
+        height, width = img.shape[:2]  # regions are cut from the grayscale image, see to_gray()
 
         P = math.ceil((height - radius * 2) / step)
         Q = math.ceil((width - radius * 2) / step)
@@ -96,12 +102,15 @@ class Daisy(object):
             w_slice = np.around(np.linspace(
                 0, width, n_slice + 1, endpoint=True)).astype(int)
 
-            for hs in range(len(h_silce) - 1):
-                for ws in range(len(w_slice) - 1):
-                    # slice img to regions
-                    img_r = img[h_silce[hs]:h_silce[hs + 1],
-                                w_slice[ws]:w_slice[ws + 1]]
-                    hist[hs][ws] = self._daisy(img_r)
+            if region_mode == 'whole':
+                hist = self._region_daisy(img, h_silce, w_slice)
+            else:
+                for hs in range(len(h_silce) - 1):
+                    for ws in range(len(w_slice) - 1):
+                        # slice img to regions
+                        img_r = img[h_silce[hs]:h_silce[hs + 1],
+                                    w_slice[ws]:w_slice[ws + 1]]
+                        hist[hs][ws] = self._daisy(img_r)
 
         if normalize:
             hist /= np.sum(hist)
@@ -109,7 +118,7 @@ class Daisy(object):
         return hist.flatten()
 
     def _daisy(self, img, normalize=True):
-        image = color.rgb2gray(img)
+        image = to_gray(img)
         descs = daisy(image, step=step, radius=radius, rings=rings,
                       histograms=histograms, orientations=n_orient)
         descs = descs.reshape(-1, R)  # shape=(N, R)
@@ -120,48 +129,78 @@ class Daisy(object):
 
         return hist
 
-    def make_samples(self, db, verbose=True):
+    def _region_daisy(self, img, h_slice, w_slice, normalize=True):
+        ''' mean-pool the descriptors of one dense daisy of img into the regions holding their centers
+
+          return
+            a numpy array with size (len(h_slice) - 1) * (len(w_slice) - 1) * R
+        '''
+        image = to_gray(img)
+        descs = daisy(image, step=step, radius=radius, rings=rings,
+                      histograms=histograms, orientations=n_orient)  # shape=(P, Q, R)
+        P, Q, _ = descs.shape
+        n_h, n_w = len(h_slice) - 1, len(w_slice) - 1
+
+        # descriptors are centered on a grid starting at radius
+        h_idx = np.searchsorted(h_slice, radius + step * np.arange(P), side='right') - 1
+        w_idx = np.searchsorted(w_slice, radius + step * np.arange(Q), side='right') - 1
+        region = (h_idx[:, np.newaxis] * n_w + w_idx[np.newaxis, :]).ravel()
+
+        count = np.bincount(region, minlength=n_h * n_w)
+        hist = np.zeros((n_h * n_w, R))
+        np.add.at(hist, region, descs.reshape(-1, R))
+        filled = count > 0  # regions without descriptor stay zero
+        hist[filled] /= count[filled, np.newaxis]
+
+        if normalize:
+            hist[filled] /= np.sum(hist[filled], axis=1, keepdims=True)
+
+        return hist.reshape(n_h, n_w, R)
+
+    def feature(self, input):
+        ''' the histogram of a image as make_samples() stores it, with the configs of the module '''
+        hist = self.histogram(input, type=h_type, n_slice=n_slice)
+        return hist / np.sum(hist)  # normalize
+
+    def sample_store(self):
+        ''' the store of the samples, with the configs of the module '''
         if h_type == 'global':
             sample_cache = "daisy-{}-n_orient{}-step{}-radius{}-rings{}-histograms{}".format(h_type, n_orient, step,
                                                                                              radius, rings, histograms)
         elif h_type == 'region':
-            sample_cache = "daisy-{}-n_slice{}-n_orient{}-step{}-radius{}-rings{}-histograms{}".format(h_type, n_slice,
-                                                                                                       n_orient, step,
-                                                                                                       radius, rings,
-                                                                                                       histograms)
-
-        try:
-            samples = cPickle.load(
-                open(os.path.join(cache_dir, sample_cache), "rb", True))
-            for sample in samples:
-                sample['hist'] /= np.sum(sample['hist'])  # normalize
-            if verbose:
-                print("Using cache..., config=%s, distance=%s, depth=%s" %
-                      (sample_cache, d_type, depth))
-        except:
-            if verbose:
-                print("Counting histogram..., config=%s, distance=%s, depth=%s" % (
-                    sample_cache, d_type, depth))
+            sample_cache = "daisy-{}-{}-n_slice{}-n_orient{}-step{}-radius{}-rings{}-histograms{}".format(h_type,
+                                                                                                          region_mode,
+                                                                                                          n_slice,
+                                                                                                          n_orient, step,
+                                                                                                          radius, rings,
+                                                                                                          histograms)
+
+        config = {'extractor': 'daisy', 'h_type': h_type, 'region_mode': region_mode, 'n_slice': n_slice,
+                  'n_orient': n_orient, 'step': step, 'radius': radius, 'rings': rings, 'histograms': histograms}
+        sample_cache, config = scaled_cache(sample_cache, config, decode_scale)
+        return SegmentedStore(os.path.join(cache_dir, sample_cache), config)
 
-            samples = []
-            data = db.get_data()
-            for d in data.itertuples():
-                d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-                d_hist = self.histogram(d_img, type=h_type, n_slice=n_slice)
-                samples.append({
-                    'img': d_img,
-                    'cls': d_cls,
-                    'hist': d_hist
-                })
-            cPickle.dump(samples, open(os.path.join(
-                cache_dir, sample_cache), "wb", True))
+    def make_samples(self, db, verbose=True):
+        cache = self.sample_store()
+        sample_cache = os.path.basename(cache.path)
+        pool = HistogramPool(self, type=h_type, n_slice=n_slice)  # started once, for all the checkpoints
+
+        def compute(data):
+            if verbose:
+                print("Counting histogram..., config=%s, distance=%s, depth=%s, %d images" % (
+                    sample_cache, d_type, depth, len(data)))
+            return extract_histograms(self, data, verbose=verbose, pool=pool)
 
-        return samples
+        with pool:
+            changes = cache.update(db, compute)
+        if verbose:
+            print("Using cache..., config=%s, distance=%s, depth=%s, %d added, %d changed, %d removed, %d quarantined" % (
+                sample_cache, d_type, depth, changes['added'], changes['changed'], changes['removed'],
+                changes['quarantined']))
+        return cache.samples(db)
 
 
 if __name__ == "__main__":
-    print("Pensez à supprimer le dossier cache dans le cas où vous utilisez des nouvelles données.\n")
-
     dbTrain = Database(DB_dir="CorelDBDataSet/train",
                        DB_csv="CorelDBDataSetTrain.csv")
 
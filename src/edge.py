@@ -4,10 +4,12 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from DB import Database
+from store import SegmentedStore
+from parallel import HistogramPool, extract_histograms
+from batching import Decoded, read_rgb, reduce_image, scaled_cache
+from integral import IntegralHistogram, slice_bounds
 
-from six.moves import cPickle
 import numpy as np
-import scipy.misc
 from math import sqrt
 import os
 
@@ -15,6 +17,7 @@ import os
 stride = (1, 1)
 n_slice  = 10
 h_type   = 'region'
+decode_scale = 1  # images are decoded at 1/decode_scale of their size, see batching.read_rgb()
 d_type   = 'cosine'
 
 depth    = 5
@@ -88,7 +91,7 @@ class Edge(object):
     ''' count img histogram
   
       arguments
-        input    : a path to a image or a numpy.ndarray
+        input    : a path to a image, a numpy.ndarray or a Decoded
         stride   : stride of edge kernel
         type     : 'global' means count the histogram for whole image
                    'region' means count the histogram for regions in images, then concatanate all of them
@@ -101,24 +104,21 @@ class Edge(object):
         type == 'region'
           a numpy array with size len(edge_kernels) * n_slice * n_slice
     '''
-    if isinstance(input, np.ndarray):  # examinate input type
-      img = input.copy()
+    if isinstance(input, Decoded):  # examinate input type
+      img = input.at(decode_scale).rgb
+    elif isinstance(input, np.ndarray):
+      img = reduce_image(input, decode_scale).copy()
     else:
-      img = scipy.misc.imread(input, mode='RGB')
+      img = read_rgb(input, decode_scale)
     height, width, channel = img.shape
   
     if type == 'global':
       hist = self._conv(img, stride=stride, kernels=edge_kernels)
   
     elif type == 'region':
-      hist = np.zeros((n_slice, n_slice, edge_kernels.shape[0]))
-      h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
-      w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
-  
-      for hs in range(len(h_silce)-1):
-        for ws in range(len(w_slice)-1):
-          img_r = img[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
-          hist[hs][ws] = self._conv(img_r, stride=stride, kernels=edge_kernels)
+      tables = self._integral(img, stride=stride)
+      hist = self._region_conv(tables, stride=stride, kernels=edge_kernels,
+                               h_slice=slice_bounds(height, n_slice), w_slice=slice_bounds(width, n_slice))
   
     if normalize:
       hist /= np.sum(hist)
@@ -128,26 +128,24 @@ class Edge(object):
   
   def _conv(self, img, stride, kernels, normalize=True):
     H, W, C = img.shape
-    conv_kernels = np.expand_dims(kernels, axis=3)
-    conv_kernels = np.tile(conv_kernels, (1, 1, 1, C))
-    assert list(conv_kernels.shape) == list(kernels.shape) + [C]  # check kernels size
-  
     sh, sw = stride
-    kn, kh, kw, kc = conv_kernels.shape
+    kn, kh, kw = kernels.shape
   
     hh = int((H - kh) / sh + 1)
     ww = int((W - kw) / sw + 1)
   
-    hist = np.zeros(kn)
+    # kernels are the same for every channel, so convolve the sum of channels
+    g = np.sum(img, axis=2, dtype=np.float64)
   
-    for idx, k in enumerate(conv_kernels):
-      for h in range(hh):
-        hs = int(h*sh)
-        he = int(h*sh + kh)
-        for w in range(ww):
-          ws = w*sw
-          we = w*sw + kw
-          hist[idx] += np.sum(img[hs:he, ws:we] * k)  # element-wise product
+    # sums[i, j] is the sum of the pixels under kernel cell (i, j) over all windows,
+    # one strided slice of the whole image per kernel cell
+    sums = np.zeros((kh, kw))
+    if hh > 0 and ww > 0:
+      for i in range(kh):
+        for j in range(kw):
+          sums[i, j] = np.sum(g[i:i + sh*hh:sh, j:j + sw*ww:sw])
+  
+    hist = np.tensordot(kernels, sums, axes=([1, 2], [0, 1]))  # all kernels at once
   
     if normalize:
       hist /= np.sum(hist)
@@ -155,33 +153,154 @@ class Edge(object):
     return hist
   
   
+  def _integral(self, img, stride):
+    ''' summed-area tables of img summed over channels, one per stride phase
+  
+      return
+        a dict {(row phase, column phase): IntegralHistogram}
+    '''
+    sh, sw = stride
+    g = np.sum(img, axis=2, dtype=np.float64)  # kernels are the same for every channel
+    return {(p, q): IntegralHistogram.from_values(g[p::sh, q::sw, np.newaxis])
+            for p in range(sh) for q in range(sw)}
+  
+  
+  def _region_conv(self, tables, stride, kernels, h_slice, w_slice, normalize=True):
+    ''' same as _conv on every region between the borders, from the tables of _integral()
+  
+      return
+        a numpy array with size (len(h_slice)-1) * (len(w_slice)-1) * len(kernels)
+    '''
+    sh, sw = stride
+    kn, kh, kw = kernels.shape
+  
+    # number of windows in every region, as in _conv
+    hh = np.maximum((np.diff(h_slice) - kh) // sh + 1, 0)
+    ww = np.maximum((np.diff(w_slice) - kw) // sw + 1, 0)
+  
+    # sums[r, c, i, j] is the sum of the pixels under kernel cell (i, j) over all windows of region (r, c),
+    # these pixels sit on one stride phase so every sum is 4 lookups in its table
+    sums = np.zeros((len(hh), len(ww), kh, kw))
+    for i in range(kh):
+      for j in range(kw):
+        hs, ws = h_slice[:-1] + i, w_slice[:-1] + j
+        for (p, q), table in tables.items():
+          rows, cols = np.flatnonzero(hs % sh == p), np.flatnonzero(ws % sw == q)
+          if len(rows) == 0 or len(cols) == 0:
+            continue
+          n_rows, n_cols = len(table.h_cuts) - 1, len(table.w_cuts) - 1
+          r0 = np.minimum(hs[rows] // sh, n_rows)
+          c0 = np.minimum(ws[cols] // sw, n_cols)
+          sums[rows[:, np.newaxis], cols[np.newaxis, :], i, j] = table.sum(
+            r0[:, np.newaxis], r0[:, np.newaxis] + hh[rows, np.newaxis],
+            c0[np.newaxis, :], c0[np.newaxis, :] + ww[np.newaxis, cols])[..., 0]
+  
+    hist = np.tensordot(sums, kernels, axes=([2, 3], [1, 2]))
+  
+    if normalize:
+      hist /= np.sum(hist, axis=2, keepdims=True)
+  
+    return hist
+  
+  
+  def region_histograms(self, input, n_slices, stride=(2, 2), normalize=True):
+    ''' count region histograms of img for several n_slice in one pass
+  
+      arguments
+        input    : a path to a image, a numpy.ndarray or a Decoded
+        n_slices : a list of n_slice, see histogram()
+        stride   : stride of edge kernel
+        normalize: normalize output histograms
+  
+      return
+        a dict {n_slice: histogram(input, stride, type='region', n_slice)}
+    '''
+    if isinstance(input, Decoded):  # examinate input type
+      img = input.at(decode_scale).rgb
+    elif isinstance(input, np.ndarray):
+      img = reduce_image(input, decode_scale)
+    else:
+      img = read_rgb(input, decode_scale)
+    height, width, channel = img.shape
+  
+    tables = self._integral(img, stride=stride)
+    hists = {}
+    for n in n_slices:
+      hist = self._region_conv(tables, stride=stride, kernels=edge_kernels,
+                               h_slice=slice_bounds(height, n), w_slice=slice_bounds(width, n))
+      if normalize:
+        hist /= np.sum(hist)
+      hists[n] = hist.flatten()
+  
+    return hists
+  
+  
+  def _sample_cache(self, type, stride, n_slice):
+    if type == 'global':
+      return "edge-{}-stride{}".format(type, stride)
+    elif type == 'region':
+      return "edge-{}-stride{}-n_slice{}".format(type, stride, n_slice)
+  
+  
+  def feature(self, input):
+    ''' the histogram of a image as make_samples() stores it, with the configs of the module '''
+    hist = self.histogram(input, type=h_type, n_slice=n_slice)
+    return hist / np.sum(hist)  # normalize
+  
+  
+  def sample_store(self):
+    ''' the store of the samples, with the configs of the module '''
+    sample_cache, config = scaled_cache(self._sample_cache(h_type, stride, n_slice),
+                                        {'extractor': 'edge', 'h_type': h_type, 'stride': stride, 'n_slice': n_slice},
+                                        decode_scale)
+    return SegmentedStore(os.path.join(cache_dir, sample_cache), config)
+  
+  
   def make_samples(self, db, verbose=True):
-    if h_type == 'global':
-      sample_cache = "edge-{}-stride{}".format(h_type, stride)
-    elif h_type == 'region':
-      sample_cache = "edge-{}-stride{}-n_slice{}".format(h_type, stride, n_slice)
-  
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
+    cache = self.sample_store()
+    sample_cache = os.path.basename(cache.path)
+    pool = HistogramPool(self, type=h_type, n_slice=n_slice)  # started once, for all the checkpoints
+
+    def compute(data):
       if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-  
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.histogram(d_img, type=h_type, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
+        print("Counting histogram..., config=%s, distance=%s, depth=%s, %d images" % (sample_cache, d_type, depth, len(data)))
+      return extract_histograms(self, data, verbose=verbose, pool=pool)
+
+    with pool:
+      changes = cache.update(db, compute)
+    if verbose:
+      print("Using cache..., config=%s, distance=%s, depth=%s, %d added, %d changed, %d removed, %d quarantined" % (
+        sample_cache, d_type, depth, changes['added'], changes['changed'], changes['removed'],
+        changes['quarantined']))
+    return cache.samples(db)
+  
+  
+  def make_sweep_samples(self, db, n_slices, verbose=True):
+    ''' make the region samples of several n_slice, reading every image once
+  
+      return
+        a dict {n_slice: samples}
+    '''
+    caches = {n: scaled_cache(self._sample_cache('region', stride, n),
+                              {'extractor': 'edge', 'h_type': 'region', 'stride': stride, 'n_slice': n},
+                              decode_scale) for n in n_slices}
+    if verbose:
+      print("Counting histograms..., configs=%s" % ", ".join(name for name, _ in caches.values()))
+  
+    samples = {n: [] for n in n_slices}
+    data = db.get_data()
+    for d in data.itertuples():
+      d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
+      d_hists = self.region_histograms(d_img, n_slices)
+      for n in n_slices:
+        samples[n].append({
+                           'img':  d_img, 
+                           'cls':  d_cls, 
+                           'hist': d_hists[n]
+                         })
+    for n in n_slices:
+      cache = SegmentedStore(os.path.join(cache_dir, caches[n][0]), caches[n][1])
+      cache.write(db, {'hist': np.array([sample['hist'] for sample in samples[n]])}, list(data.img))
   
     return samples
 
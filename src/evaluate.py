@@ -5,6 +5,14 @@ from __future__ import print_function
 from scipy import spatial
 import numpy as np
 
+# tiles of the distance matrix, bounds the memory of distance_matrix() whatever the database size
+row_tile  = 256    # queries per tile
+col_tile  = 8192   # database samples per tile
+elem_tile = 2**22  # max elements of the query x sample x dimension temporaries of d4, d5
+
+tie_decimals = 9  # distances equal to this many decimals of the range of their row are ties,
+                  # ranked by sample index, see rank()
+
 
 class Evaluation(object):
 
@@ -13,6 +21,13 @@ class Evaluation(object):
 
 
 def distance(v1, v2, d_type='d1'):
+    ''' distance between two vectors, see distance_matrix() for many at once
+
+      d3: histogram intersection, 1 - sum(min(v1, v2))
+      d4: chi-square, sum((v1 - v2) ** 2 / (v1 + v2))
+      d5: Jensen-Shannon divergence
+      d6: Hellinger distance
+    '''
     assert v1.shape == v2.shape, "shape of two vectors need to be same!"
 
     if d_type == 'd1':
@@ -22,13 +37,14 @@ def distance(v1, v2, d_type='d1'):
     elif d_type == 'd2-norm':
         return 2 - 2 * np.dot(v1, v2)
     elif d_type == 'd3':
-        pass
+        return 1 - np.sum(np.minimum(v1, v2))
     elif d_type == 'd4':
-        pass
+        s = v1 + v2
+        return np.sum(np.divide((v1 - v2) ** 2, s, out=np.zeros_like(s, dtype=float), where=s > 0))
     elif d_type == 'd5':
-        pass
+        return 0.5 * (_xlogx(v1).sum() + _xlogx(v2).sum()) - _xlogx((v1 + v2) / 2.).sum()
     elif d_type == 'd6':
-        pass
+        return np.sqrt(max(0.5 * np.sum((np.sqrt(v1) - np.sqrt(v2)) ** 2), 0.))
     elif d_type == 'd7':
         return 2 - 2 * np.dot(v1, v2)
     elif d_type == 'd8':
@@ -39,6 +55,116 @@ def distance(v1, v2, d_type='d1'):
         return np.sum((v1 - v2) ** 2)
 
 
+def _xlogx(x):
+    return x * np.log(np.where(x > 0, x, 1))
+
+
+def _distance_tile(q, x, d_type, q_sums=None, x_sums=None):
+    ''' distances between the rows of q and the rows of x, q_sums / x_sums are per-row precomputations '''
+    if d_type == 'd1':
+        return spatial.distance.cdist(q, x, 'cityblock')
+    elif d_type in ('d2', 'square'):  # |q|^2 + |x|^2 - 2 q.x
+        return np.maximum(q_sums[:, None] + x_sums[None, :] - 2 * np.dot(q, x.T), 0)
+    elif d_type in ('d2-norm', 'd7', 'd8'):
+        return 2 - 2 * np.dot(q, x.T)
+    elif d_type == 'd3':  # sum(min(q, x)) = (sum(q) + sum(x) - |q - x|_1) / 2
+        return 1 - (q_sums[:, None] + x_sums[None, :] - spatial.distance.cdist(q, x, 'cityblock')) / 2.
+    elif d_type == 'd4':
+        return _broadcast_tile(q, x, lambda a, b: np.divide((a - b) ** 2, a + b, out=np.zeros(np.broadcast(a, b).shape),
+                                                            where=(a + b) > 0).sum(axis=-1))
+    elif d_type == 'd5':  # (sum q log q + sum x log x) / 2 - sum m log m, m = (q + x) / 2
+        return 0.5 * (q_sums[:, None] + x_sums[None, :]) - _broadcast_tile(q, x, lambda a, b: _xlogx((a + b) / 2.).sum(axis=-1))
+    elif d_type == 'd6':  # sqrt(0.5) |sqrt q - sqrt x|, a BLAS product would lose the small distances to cancellation
+        return spatial.distance.cdist(np.sqrt(q), np.sqrt(x), 'euclidean') * np.sqrt(0.5)
+    elif d_type == 'cosine':
+        return 1 - np.dot(q, x.T) / np.outer(q_sums, x_sums)
+    raise ValueError("unknown distance type %s" % d_type)
+
+
+def _broadcast_tile(q, x, fn):
+    ''' fn(q[:, None], x[None]) computed on column chunks, so the temporaries stay under elem_tile elements '''
+    step = max(1, elem_tile // max(1, q.shape[0] * q.shape[1]))
+    return np.concatenate([fn(q[:, None], x[None, i:i + step]) for i in range(0, len(x), step)], axis=1)
+
+
+def _row_sums(x, d_type):
+    if d_type in ('d2', 'square'):
+        return np.einsum('ij,ij->i', x, x)
+    elif d_type == 'd3':
+        return x.sum(axis=1)
+    elif d_type == 'd5':
+        return _xlogx(x).sum(axis=1)
+    elif d_type == 'cosine':
+        return np.sqrt(np.einsum('ij,ij->i', x, x))
+    return None
+
+
+def distance_matrix(queries, samples, d_type='d1'):
+    ''' distances between every query and every sample, d_type as in distance()
+
+      arguments
+        queries: a numpy array with size Q * D
+        samples: a numpy array with size N * D
+        d_type : distance type
+
+      return
+        a numpy array with size Q * N, computed by tiles of row_tile * col_tile,
+        with BLAS matrix products for d2, d2-norm, cosine and square. The order of the sums differs
+        from distance(), tied distances may differ in their last bits, see rank()
+    '''
+    queries = np.asarray(queries, dtype=np.float64)
+    samples = np.asarray(samples, dtype=np.float64)
+    assert queries.shape[1:] == samples.shape[1:], "shape of two vectors need to be same!"
+    q_sums, x_sums = _row_sums(queries, d_type), _row_sums(samples, d_type)
+    dists = np.empty((len(queries), len(samples)))
+    for i in range(0, len(queries), row_tile):
+        for j in range(0, len(samples), col_tile):
+            dists[i:i + row_tile, j:j + col_tile] = _distance_tile(
+                queries[i:i + row_tile], samples[j:j + col_tile], d_type,
+                None if q_sums is None else q_sums[i:i + row_tile],
+                None if x_sums is None else x_sums[j:j + col_tile])
+    return dists
+
+
+def rank(dists, k=None):
+    ''' the samples sorted by distance, ties broken by sample index
+
+      Distances are compared rounded to tie_decimals of the range of the finite distances of their row,
+      so that tied samples are ranked the same way whatever the summation order that computed their
+      distances, e.g. distance_matrix() and distance(), and the ties depend neither on the scale of the
+      features nor on an offset of the distances, e.g. d3 close to 1.
+
+      arguments
+        dists: a numpy array with size N, or Q * N
+        k    : only the first k samples, selected with argpartition instead of a full sort, all if None
+
+      return
+        a numpy array of sample indexes with size k (or N), or Q * k
+    '''
+    dists = np.asarray(dists, dtype=np.float64)
+    finite = np.isfinite(dists)
+    low = np.min(np.where(finite, dists, np.inf), axis=-1, keepdims=True, initial=np.inf)
+    span = np.max(np.where(finite, dists, -np.inf), axis=-1, keepdims=True, initial=-np.inf) - low
+    low, span = np.where(np.isfinite(low), low, 0), np.where(np.isfinite(span) & (span > 0), span, 1)
+    keys = np.round((dists - low) / span, tie_decimals)
+    n = keys.shape[-1]
+    if k is None or k >= n:
+        return np.argsort(keys, axis=-1, kind='stable')
+    kth = np.partition(keys, k - 1, axis=-1)[..., k - 1:k]
+    m = int((keys <= kth).sum(axis=-1).max())  # the candidates hold every sample tied with the k-th
+    if m < n:
+        candidates = np.argpartition(keys, m - 1, axis=-1)[..., :m]
+    else:
+        candidates = np.broadcast_to(np.arange(n), keys.shape)
+    order = np.lexsort((candidates, np.take_along_axis(keys, candidates, axis=-1)), axis=-1)
+    return np.take_along_axis(candidates, order, axis=-1)[..., :k]
+
+
+def features(samples):
+    ''' the histograms of samples stacked into a numpy array with size N * D '''
+    return np.array([sample['hist'] for sample in samples], dtype=np.float64)
+
+
 def AP(label, results, sort=True):
     ''' infer a query, return it's ap
 
@@ -89,22 +215,84 @@ def infer(query, samples=None, db=None, sample_db_fn=None, depth=None, d_type='d
     if db:
         samples = sample_db_fn(db)
 
-    q_img, q_cls, q_hist = query['img'], query['cls'], query['hist']
+    dists = distance_matrix(query['hist'][None], features(samples), d_type=d_type)[0]
+    return _infer_row(query, dists, samples, depth)
+
+
+def _infer_row(query, dists, samples, depth=None):
+    ''' the ap and results of a query from its distances to every sample '''
+    results = _results(query, dists, samples, rank(dists, depth + 1 if depth else None), depth)
+    if depth and len(results) < depth < len(samples):  # the query image is in samples more than once
+        results = _results(query, dists, samples, rank(dists), depth)
+    ap = AP(query['cls'], results, sort=False)
+
+    return ap, results
+
+
+def _results(query, dists, samples, order, depth=None):
     results = []
-    for idx, sample in enumerate(samples):
-        s_img, s_cls, s_hist = sample['img'], sample['cls'], sample['hist']
-        if q_img == s_img:
+    for idx in order:
+        if samples[idx]['img'] == query['img']:
             continue
         results.append({
-            'dis': distance(q_hist, s_hist, d_type=d_type),
-            'cls': s_cls
+            'dis': dists[idx],
+            'cls': samples[idx]['cls']
         })
-    results = sorted(results, key=lambda x: x['dis'])
-    if depth and depth <= len(results):
-        results = results[:depth]
-    ap = AP(q_cls, results, sort=False)
+        if depth and len(results) == depth:
+            break
+    return results
+
+
+def _evaluate_samples(samples, classes, depths, d_type):
+    ''' the APs of every sample queried against the others, at every depth of depths
+
+      Each query is ranked once, the AP at a depth is read from its cumulative hits over the ranking.
+      Queries are processed by blocks of row_tile, with class and image codes instead of dicts.
+      When every depth is finite, only the top of the ranking is selected, see rank().
+    '''
+    ret = {d: {c: [] for c in classes} for d in depths}
+    if not samples:
+        return ret
+    X = features(samples)
+    cls_names, cls_codes = np.unique([sample['cls'] for sample in samples], return_inverse=True)
+    _, img_codes = np.unique([sample['img'] for sample in samples], return_inverse=True)
+    top = max(depths) + np.bincount(img_codes).max() if all(depths) else None  # the query is left out of its results
+    for start in range(0, len(samples), row_tile):
+        rows = np.arange(start, min(start + row_tile, len(samples)))
+        order = rank(distance_matrix(X[rows], X, d_type=d_type), top)
+        valid = img_codes[order] != img_codes[rows][:, None]  # a query is not its own result
+        hits = valid & (cls_codes[order] == cls_codes[rows][:, None])
+        position = np.cumsum(valid, axis=1)  # 1-based rank of the results among the valid ones
+        precision = np.where(hits, np.cumsum(hits, axis=1) / np.maximum(position, 1.), 0.)
+        for d in depths:
+            within = hits if not d else hits & (position <= d)
+            n_hit = within.sum(axis=1)
+            APs = np.where(within, precision, 0.).sum(axis=1) / np.maximum(n_hit, 1)
+            for q, ap in zip(rows, APs):
+                ret[d][cls_names[cls_codes[q]]].append(ap)
+    return ret
 
-    return ap, results
+
+def evaluate_depths(db, f_class=None, f_instance=None, depths=(None,), d_type='d1'):
+    ''' infer the whole database once for several depths
+
+      arguments
+        db        : an instance of class Database
+        f_class   : a class that generate features, needs to implement make_samples method
+        f_instance: an instance of such a class
+        depths    : retrieved depths, None is equal to database size
+        d_type    : distance type
+
+      return
+        {depth: <what evaluate_class returns at depth>}
+    '''
+    assert f_class or f_instance, "needs to give class_name or an instance of class"
+
+    if f_class:
+        f = f_class()
+    elif f_instance:
+        f = f_instance
+    return _evaluate_samples(f.make_samples(db), db.get_class(), depths, d_type)
 
 
 def evaluate(db, sample_db_fn, depth=None, d_type='d1'):
@@ -116,15 +304,7 @@ def evaluate(db, sample_db_fn, depth=None, d_type='d1'):
         depth       : retrieved depth during inference, the default depth is equal to database size
         d_type      : distance type
     '''
-    classes = db.get_class()
-    ret = {c: [] for c in classes}
-
-    samples = sample_db_fn(db)
-    for query in samples:
-        ap, _ = infer(query, samples=samples, depth=depth, d_type=d_type)
-        ret[query['cls']].append(ap)
-
-    return ret
+    return _evaluate_samples(sample_db_fn(db), db.get_class(), [depth], d_type)[depth]
 
 
 def evaluate_class(db, f_class=None, f_instance=None, depth=None, d_type='d1'):
@@ -138,17 +318,9 @@ def evaluate_class(db, f_class=None, f_instance=None, depth=None, d_type='d1'):
     '''
     assert f_class or f_instance, "needs to give class_name or an instance of class"
 
-    classes = db.get_class()
-    ret = {c: [] for c in classes}
-
     if f_class:
         f = f_class()
     elif f_instance:
         f = f_instance
-    samples = f.make_samples(db)
-    for query in samples:
-        ap, _ = infer(query, samples=samples, depth=depth, d_type=d_type)
-        ret[query['cls']].append(ap)
-
-    return ret
+    return _evaluate_samples(f.make_samples(db), db.get_class(), [depth], d_type)[depth]
 
@@ -2,10 +2,11 @@
 
 from __future__ import print_function
 
-from scipy import spatial
 import numpy as np
 import pandas as pd
 
+from evaluate import distance_matrix, features, rank, row_tile
+
 
 class EvaluateClassification(object):
 
@@ -13,43 +14,6 @@ class EvaluateClassification(object):
         raise NotImplementedError("Needs to implemented this method")
 
 
-def distance(v1, v2, d_type='d1'):
-    ''' Calculates the distance between two vectors according to a distance type.
-        arguments
-            v1     : The first vector used to calculate distance
-            v2     : The second vector used to calculate distance
-            d_type : The type of distance to be calculated
-
-        return
-            The distance between two vectors, depending on the type of distance selected
-
-    '''
-    assert v1.shape == v2.shape, "shape of two vectors need to be same!"
-
-    if d_type == 'd1':
-        return np.sum(np.absolute(v1 - v2))
-    elif d_type == 'd2':
-        return np.sum((v1 - v2) ** 2)
-    elif d_type == 'd2-norm':
-        return 2 - 2 * np.dot(v1, v2)
-    elif d_type == 'd3':
-        pass
-    elif d_type == 'd4':
-        pass
-    elif d_type == 'd5':
-        pass
-    elif d_type == 'd6':
-        pass
-    elif d_type == 'd7':
-        return 2 - 2 * np.dot(v1, v2)
-    elif d_type == 'd8':
-        return 2 - 2 * np.dot(v1, v2)
-    elif d_type == 'cosine':
-        return spatial.distance.cosine(v1, v2)
-    elif d_type == 'square':
-        return np.sum((v1 - v2) ** 2)
-
-
 def weightDistance(results):
     ''' Calculate a weight corresponding to the calculation of the average distance for each class.
     argument
@@ -95,20 +59,32 @@ def infer(query, samples=None, db=None, sample_db_fn=None, depth=None, d_type='d
     if db:
         samples = sample_db_fn(db)
 
-    q_img, q_hist = query['img'], query['hist']
-    results = []
-    for _, sample in enumerate(samples):
-        s_img, s_cls, s_hist = sample['img'], sample['cls'], sample['hist']
-        if q_img == s_img:
-            continue
-        results.append({
-            'dis': distance(q_hist, s_hist, d_type=d_type),
-            'cls': s_cls
-        })
-    results = sorted(results, key=lambda x: x['dis'])
-    if depth and depth <= len(results):
-        results = results[:depth]
-    weightedDistance = sorted(weightDistance(results), key=lambda x: x['averageClassDistance'])
+    dists = distance_matrix(query['hist'][None], features(samples), d_type=d_type)[0]
+    return _infer_row(query, dists, samples, depth)
+
+
+def _codes(samples):
+    ''' (class names, class code of every sample, image of every sample) '''
+    cls_names, cls_codes = np.unique([sample['cls'] for sample in samples], return_inverse=True)
+    return cls_names, cls_codes, np.array([sample['img'] for sample in samples], dtype=object)
+
+
+def _infer_row(query, dists, samples, depth=None, codes=None):
+    ''' The weighted distance of a query from its distances to every sample, as weightDistance() computes it
+        on the results within depth. codes are the _codes() of samples, computed if None.
+    '''
+    cls_names, cls_codes, imgs = _codes(samples) if codes is None else codes
+    others = imgs != query['img']  # a query is not its own result
+    if depth:
+        order = rank(dists, depth + len(imgs) - np.count_nonzero(others))
+        results = order[others[order]][:depth]
+    else:
+        results = np.flatnonzero(others)  # every sample, their order does not change the averages
+    counts = np.bincount(cls_codes[results], minlength=len(cls_names))
+    sums = np.bincount(cls_codes[results], weights=dists[results], minlength=len(cls_names))
+    present = np.flatnonzero(counts)  # in the order of class names, as groupby gives them
+    weightedDistance = sorted([{'cls': cls_names[c], 'averageClassDistance': sums[c] / counts[c]} for c in present],
+                              key=lambda x: x['averageClassDistance'])
 
     return weightedDistance
 
@@ -133,10 +109,15 @@ def evaluate_class(db, f_class=None, f_instance=None, depth=None, d_type='d1'):
     elif f_instance:
         f = f_instance
     samples = f.make_samples(db)
+    X = features(samples)
+    codes = _codes(samples)
     ok = 0
-    for query in samples:
-        result = infer(query, samples=samples, depth=depth, d_type=d_type)
-        if (query['cls'] == result[0]['cls']):
-            ok += 1
+    for start in range(0, len(samples), row_tile):
+        dists = distance_matrix(X[start:start + row_tile], X, d_type=d_type)
+        for i, row in enumerate(dists):
+            query = samples[start + i]
+            result = _infer_row(query, row, samples, depth, codes)
+            if (query['cls'] == result[0]['cls']):
+                ok += 1
 
     return ok, len(samples)
@@ -10,8 +10,10 @@ https://blog.keras.io/building-powerful-image-classification-models-using-very-l
 https://www.codesofinterest.com/2017/08/bottleneck-features-multi-class-classification-keras.html
 '''
 
+import json
 import math
 import os
+import time
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -22,6 +24,7 @@ from keras.preprocessing.image import ImageDataGenerator, img_to_array, load_img
 from keras.utils.np_utils import to_categorical
 
 from DB import Database
+from batching import BatchLoader
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'  # Only for MacOS 12.0 and higher
 
@@ -39,52 +42,99 @@ validation_data_dir = 'CorelDBDataSet/val'
 epochs = 30
 # batch size used by flow_from_directory and predict_generator
 batch_size = 16
+# image decoding threads and images decoded ahead of the predictions
+n_worker = 4
+prefetch = 64
+
+class_indices_path = 'cache/class_indices.npy'
+predictions_path = 'cache/predictions.csv'
+
+
+def _load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _save_manifest(manifest, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)  # the manifest is either the previous or the new one, never partly written
+
+
+def bottleneck_path(name):
+    return 'cache/bottleneck_features_%s.npy' % name
+
+
+def _save_bottleneck(model, generator, name):
+    ''' Write the bottleneck features of the images of generator into a preallocated .npy file, batch by batch.
+    The manifest next to it records the batches done, so an interrupted extraction resumes from the last one.
+    '''
+    path = bottleneck_path(name)
+    manifest_path = path + '.json'
+    nb_samples = len(generator.filenames)
+    shape = [nb_samples] + list(model.output_shape[1:])
+    nb_batches = int(math.ceil(nb_samples / batch_size))
+
+    manifest = _load_manifest(manifest_path)
+    if (manifest is None or not os.path.exists(path) or manifest['shape'] != shape
+            or manifest['batch_size'] != batch_size or manifest['filenames'] != generator.filenames):
+        manifest = {'shape': shape, 'batch_size': batch_size, 'filenames': generator.filenames, 'done_batches': 0}
+        features = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=tuple(shape))
+        _save_manifest(manifest, manifest_path)
+    else:
+        features = np.load(path, mmap_mode='r+')
+        print("[INFO] {}: resuming from batch {}/{}".format(name, manifest['done_batches'], nb_batches))
+
+    for idx in range(manifest['done_batches'], nb_batches):
+        features[idx * batch_size:(idx + 1) * batch_size] = model.predict_on_batch(generator[idx])
+        features.flush()
+        manifest['done_batches'] = idx + 1
+        _save_manifest(manifest, manifest_path)
+    del features
+
+
+def load_bottleneck(name):
+    ''' The bottleneck features saved by save_bottleneck_features, memory-mapped. '''
+    path = bottleneck_path(name)
+    manifest = _load_manifest(path + '.json')
+    assert manifest is not None and manifest['done_batches'] * manifest['batch_size'] >= manifest['shape'][0], \
+        "bottleneck features %s are incomplete, rerun save_bottleneck_features()" % name
+    return np.load(path, mmap_mode='r')
 
 
 def save_bottleneck_features():
     ''' Save the bottleneck features from the VGG16 model.
     In this function, we create the VGG16 model without the top model (fully-connected layers).
+    The features are streamed to disk, a rerun after a crash resumes where it stopped.
     '''
     # build the VGG16 network
     model = applications.VGG16(include_top=False, weights='imagenet')
 
     datagen = ImageDataGenerator(rescale=1. / 255)
 
-    generator = datagen.flow_from_directory(
-        train_data_dir,
-        target_size=(img_width, img_height),
-        batch_size=batch_size,
-        class_mode=None,
-        shuffle=False)
-
-    nb_train_samples = len(generator.filenames)
-    num_classes = len(generator.class_indices)
-
-    predict_size_train = int(math.ceil(nb_train_samples / batch_size))
-
-    bottleneck_features_train = model.predict_generator(
-        generator, predict_size_train)
-
-    np.save('cache/bottleneck_features_train.npy',
-            bottleneck_features_train)
-
-    generator = datagen.flow_from_directory(
-        validation_data_dir,
-        target_size=(img_width, img_height),
-        batch_size=batch_size,
-        class_mode=None,
-        shuffle=False)
-
-    nb_validation_samples = len(generator.filenames)
+    for data_dir, name in [(train_data_dir, 'train'), (validation_data_dir, 'validation')]:
+        generator = datagen.flow_from_directory(
+            data_dir,
+            target_size=(img_width, img_height),
+            batch_size=batch_size,
+            class_mode=None,
+            shuffle=False)
 
-    predict_size_validation = int(
-        math.ceil(nb_validation_samples / batch_size))
+        _save_bottleneck(model, generator, name)
 
-    bottleneck_features_validation = model.predict_generator(
-        generator, predict_size_validation)
 
-    np.save('cache/bottleneck_features_validation.npy',
-            bottleneck_features_validation)
+def top_model(input_shape, num_classes):
+    ''' The fully-connected classifier trained on the bottleneck features. '''
+    model = Sequential()
+    model.add(Flatten(input_shape=input_shape))
+    model.add(Dense(256, activation='relu'))
+    model.add(Dropout(0.5))
+    model.add(Dense(num_classes, activation='sigmoid'))
+    return model
 
 
 def train_top_model():
@@ -105,10 +155,10 @@ def train_top_model():
     num_classes = len(generator_top.class_indices)
 
     # save the class indices to use use later in predictions
-    np.save('cache/class_indices.npy', generator_top.class_indices)
+    np.save(class_indices_path, generator_top.class_indices)
 
     # load the bottleneck features saved earlier
-    train_data = np.load('cache/bottleneck_features_train.npy')
+    train_data = load_bottleneck('train')
 
     # get the class lebels for the training data, in the original order
     train_labels = generator_top.classes
@@ -125,17 +175,13 @@ def train_top_model():
 
     nb_validation_samples = len(generator_top.filenames)
 
-    validation_data = np.load('cache/bottleneck_features_validation.npy')
+    validation_data = load_bottleneck('validation')
 
     validation_labels = generator_top.classes
     validation_labels = to_categorical(
         validation_labels, num_classes=num_classes)
 
-    model = Sequential()
-    model.add(Flatten(input_shape=train_data.shape[1:]))
-    model.add(Dense(256, activation='relu'))
-    model.add(Dropout(0.5))
-    model.add(Dense(num_classes, activation='sigmoid'))
+    model = top_model(train_data.shape[1:], num_classes)
 
     model.compile(optimizer='rmsprop',
                   loss='categorical_crossentropy', metrics=['accuracy'])
@@ -180,59 +226,84 @@ def train_top_model():
     plt.show()
 
 
-def predict():
-    ''' Predict the class of an image.
-    We need to run it through the same pipeline as before (run the image through the pre-trained VGG16 model and then run the bottleneck prediction through the trained top model).
+def load_image(image_path):
+    ''' Read an image as VGG16 expects it, see Predictor. '''
+    image = load_img(image_path, target_size=(img_width, img_height))
+    # important! otherwise the predictions will be '0'
+    return img_to_array(image) / 255
+
+
+class Predictor(object):
+    ''' The pre-trained VGG16 and the trained top model, built once and reused for every batch of images.
     '''
-    # load the class_indices saved in the earlier step
-    class_dictionary = np.load(
-        'cache/class_indices.npy', allow_pickle=True).item()
 
-    num_classes = len(class_dictionary)
+    def __init__(self, weights_path=top_model_weights_path, class_indices_path=class_indices_path):
+        # load the class_indices saved by train_top_model
+        class_dictionary = np.load(class_indices_path, allow_pickle=True).item()
+        self.labels = np.array(sorted(class_dictionary, key=class_dictionary.get))  # class index -> label
+
+        self.backbone = applications.VGG16(include_top=False, weights='imagenet')
+        self.top_model = top_model(self.backbone.output_shape[1:], len(self.labels))
+        self.top_model.load_weights(weights_path)
+
+    def predict_batch(self, images):
+        ''' Classify a batch of images.
+
+        arguments
+          images: a list of paths, a list of arrays from load_image, or an array with size N * H * W * 3
+
+        return
+          labels       : an array with the predicted label of each image
+          probabilities: an array with size N * num_classes, the top model output
+        '''
+        if not isinstance(images, np.ndarray):
+            images = np.stack([load_image(i) if isinstance(i, str) else i for i in images])
+        bottleneck_prediction = self.backbone.predict_on_batch(images)
+        probabilities = np.asarray(self.top_model.predict_on_batch(bottleneck_prediction))
+        return self.labels[np.argmax(probabilities, axis=1)], probabilities
+
+    def predict_paths(self, paths, batch_size=batch_size, n_worker=n_worker, prefetch=prefetch):
+        ''' Classify images, decoded in background threads while the previous batch is predicted.
+
+        return
+          labels, probabilities as in predict_batch, in the order of paths.
+          Images which could not be read are labeled None, with probabilities of nan.
+        '''
+        labels = np.empty(len(paths), dtype=object)
+        probabilities = np.full((len(paths), len(self.labels)), np.nan)
+        loader = BatchLoader(list(paths), load_image, batch_size=batch_size, n_worker=n_worker, prefetch=prefetch)
+        for idxs, batch in loader:
+            labels[idxs], probabilities[idxs] = self.predict_batch(batch)
+        for idx, image_path, e in loader.failed:
+            print("[WARN] can not read {}: {}".format(image_path, e))
+        return labels, probabilities
+
+
+def predict(predictor=None):
+    ''' Predict the class of every image of the test split and write them to predictions_path.
+    The images run through the pre-trained VGG16 model and the bottleneck predictions through the trained top model, in batches.
+    '''
+    if predictor is None:
+        predictor = Predictor()
 
-    # add the path to your test image below
     dbTest = Database(DB_dir="CorelDBDataSet/test",
                       DB_csv="CorelDBDataSetTest.csv")
-
-    print("[INFO] loading and preprocessing image...")
-    for image_path in dbTest.get_data().img:
-        image = load_img(image_path, target_size=(img_width, img_height))
-        image = img_to_array(image)
-
-        # important! otherwise the predictions will be '0'
-        image = image / 255
-
-        image = np.expand_dims(image, axis=0)
-
-        # build the VGG16 network
-        model = applications.VGG16(include_top=False, weights='imagenet')
-
-        # get the bottleneck prediction from the pre-trained VGG16 model
-        bottleneck_prediction = model.predict(image)
-
-        # build top model
-        model = Sequential()
-        model.add(Flatten(input_shape=bottleneck_prediction.shape[1:]))
-        model.add(Dense(256, activation='relu'))
-        model.add(Dropout(0.5))
-        model.add(Dense(num_classes, activation='sigmoid'))
-
-        model.load_weights(top_model_weights_path)
-
-        # use the bottleneck prediction on the top model to get the final classification
-        class_predicted = model.predict_classes(bottleneck_prediction)
-
-        inID = class_predicted[0]
-
-        inv_map = {v: k for k, v in class_dictionary.items()}
-
-        label = inv_map[inID]
-
-        probabilities = model.predict_proba(bottleneck_prediction)[0][inID]
-
-        # get the predicted label
-        print("Image: {}, Predicted label: {}, Probability: {}".format(
-            image_path, label, probabilities))
+    data = dbTest.get_data()
+
+    print("[INFO] loading and preprocessing images...")
+    start = time.time()
+    labels, probabilities = predictor.predict_paths(data.img)
+    print("[INFO] {} images, {:.2f} images/s, accuracy: {:.2f}%".format(
+        len(data), len(data) / (time.time() - start), np.mean(labels == data.cls.values) * 100))
+
+    results = data.copy()
+    results['label'] = labels
+    results['probability'] = probabilities.max(axis=1)  # nan for the images which could not be read
+    for idx, label in enumerate(predictor.labels):
+        results['p_' + label] = probabilities[:, idx]
+    results.to_csv(predictions_path, index=False)
+
+    return labels, probabilities
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from evaluate_classification import evaluate_class
+from evaluate import evaluate_depths
 from DB import Database
 
 from color import Color
@@ -11,6 +12,7 @@ from daisy import Daisy
 from edge import Edge
 from gabor import Gabor
 from HOG import HOG
+from pipeline import Pipeline
 
 import numpy as np
 import itertools
@@ -39,19 +41,15 @@ class FeatureFusion(object):
             print("Use features {}".format(" & ".join(self.features)))
 
         if self.samples == None:
-            feats = []
-            for f_class in self.features:
-                feats.append(self._get_feat(db, f_class))
+            feats = self._get_feats(db, self.features)
             samples = self._concat_feat(db, feats)
             self.samples = samples  # cache the result
         return self.samples
 
-    def _get_feat(self, db, f_class):
-        if f_class == 'color':
-            f_c = Color()
-        elif f_class == 'daisy':
-            f_c = Daisy()
-        return f_c.make_samples(db, verbose=False)
+    def _get_feats(self, db, f_classes):
+        ''' the samples of every feature, made in one pass over the database, see Pipeline '''
+        samples = Pipeline(f_classes).make_samples(db, verbose=False)
+        return [samples[f_class] for f_class in f_classes]
 
     def _concat_feat(self, db, feats):
         samples = feats[0]
@@ -92,10 +90,11 @@ def evaluate_feats(db, N, feat_pools=feat_pools, d_type='d1', depths=[None, 300,
     combinations = itertools.combinations(feat_pools, N)
     for combination in combinations:
         fusion = FeatureFusion(features=list(combination))
+        depth_APs = evaluate_depths(db, f_instance=fusion, d_type=d_type, depths=depths)
         for d in depths:
-            APs = evaluate_class(db, f_instance=fusion, d_type=d_type, depth=d)
+            APs = depth_APs[d]
             cls_MAPs = []
-            for cls_APs in APs:
+            for cls_APs in APs.values():
                 MAP = np.mean(cls_APs)
                 cls_MAPs.append(MAP)
             r = "{},{},{},{}".format(
@@ -107,8 +106,6 @@ def evaluate_feats(db, N, feat_pools=feat_pools, d_type='d1', depths=[None, 300,
 
 
 if __name__ == "__main__":
-    print("Pensez à supprimer le dossier cache dans le cas où vous utilisez des nouvelles données.\n")
-
     dbTrain = Database(DB_dir="CorelDBDataSet/train",
                        DB_csv="CorelDBDataSetTrain.csv")
 
@@ -4,16 +4,19 @@ from __future__ import print_function
 
 from evaluate import *
 from DB import Database
+from store import SegmentedStore
+from parallel import cap_threads
+from batching import Decoded, image_cache, read_rgb, reduce_image, scaled_cache, to_gray
 
 from skimage.filters import gabor_kernel
-from skimage import color
 from scipy import ndimage as ndi
+from scipy import fft
 
+from collections import OrderedDict
+import hashlib
 import multiprocessing
 
-from six.moves import cPickle
 import numpy as np
-import scipy.misc
 import os
 
 
@@ -24,10 +27,17 @@ bandwidth = (0.3, 0.7, 1)
 
 n_slice  = 2
 h_type   = 'global'
+decode_scale = 1  # images are decoded at 1/decode_scale of their size, see batching.read_rgb()
+conv_mode = 'fft'  # 'fft' filters in the frequency domain, 'spatial' convolves every kernel with ndi.convolve
+fft_chunk = 8      # kernels filtered at once by the fft mode, bounds its temporaries
+spectra_shapes = 2  # image shapes whose kernel spectra the fft mode keeps, Corel has landscape and portrait images
 d_type   = 'cosine'
 
 depth    = 1
 
+n_worker   = multiprocessing.cpu_count()  # processes of the extraction pool, 1 extracts in the main process
+chunk_size = 8                            # images sent to a worker at once
+
 ''' MMAP
      depth
       depthNone, global-theta4-frequency(0.1, 0.5, 0.8)-sigma(1, 3, 5)-bandwidth(0.3, 0.7, 1), distance=cosine, MMAP 0.141136758233
@@ -50,6 +60,14 @@ depth    = 1
       gabor-global-theta4-frequency(0.1, 0.5, 1)-sigma(0.25, 1)-bandwidth(0.5, 1), distance=cosine, MMAP 0.120351804156
 '''
 
+class KernelBank(list):
+  ''' the kernels of make_gabor_kernel(), with the parameters they were made from '''
+
+  def __init__(self, kernels, params):
+    super(KernelBank, self).__init__(kernels)
+    self.params = params
+
+
 def make_gabor_kernel(theta, frequency, sigma, bandwidth):
   kernels = []
   for t in range(theta):
@@ -63,7 +81,7 @@ def make_gabor_kernel(theta, frequency, sigma, bandwidth):
         for b in bandwidth:
           kernel = gabor_kernel(f, theta=t, bandwidth=b)
           kernels.append(kernel)
-  return kernels
+  return KernelBank(kernels, (theta, tuple(frequency or ()), tuple(sigma or ()), tuple(bandwidth or ())))
 
 gabor_kernels = make_gabor_kernel(theta, frequency, sigma, bandwidth)
 if sigma and not bandwidth:
@@ -81,13 +99,89 @@ if not os.path.exists(cache_dir):
   os.makedirs(cache_dir)
 
 
-class Gabor(object):  
+def _init_worker(conv_mode=conv_mode):
+  global worker_gabor
+  cap_threads()  # one BLAS thread per worker
+  image_cache.max_bytes = 0  # a run reads every image once, a LRU per worker would only pin memory
+  worker_gabor = Gabor(n_worker=1, conv_mode=conv_mode)  # lives as long as the worker, with its caches
+
+
+def _try_histogram(gabor, path, type, n_slice):
+  ''' (histogram, None), or (None, error) if the image fails '''
+  try:
+    return gabor.gabor_histogram(path, type=type, n_slice=n_slice), None
+  except Exception as e:
+    return None, e
+
+
+def _histogram_chunk(args):
+  paths, type, n_slice = args
+  return [_try_histogram(worker_gabor, path, type, n_slice) for path in paths]
+
+
+class Gabor(object):
+
+  def __init__(self, n_worker=n_worker, chunk_size=chunk_size, conv_mode=conv_mode):
+    ''' arguments
+          n_worker  : processes of the extraction pool, the pool is started on first use and kept until close()
+          chunk_size: images sent to a worker at once
+          conv_mode : 'fft' or 'spatial', see _gabor()
+    '''
+    self.n_worker   = n_worker
+    self.chunk_size = chunk_size
+    self.conv_mode  = conv_mode
+    self.pool       = None
+    self.spectra    = OrderedDict()  # kernel spectra of the fft mode, for the last spectra_shapes image shapes
+  
+  
+  def get_pool(self):
+    if self.pool is None:  # the workers decode without image_cache, see _init_worker()
+      self.pool = multiprocessing.Pool(processes=self.n_worker, initializer=_init_worker, initargs=(self.conv_mode,))
+    return self.pool
+  
+  
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+  
+  
+  def histograms(self, inputs, type=h_type, n_slice=n_slice, pool=None, failed=None):
+    ''' gabor_histogram() of many images, chunks of images are spread over the pool
+  
+      arguments
+        inputs: a list of paths to images
+        pool  : a multiprocessing.Pool started with _init_worker, the pool of this instance if None
+        failed: a list, images that fail are appended to it as (path, error) and get None as histogram,
+                the first failure is raised if None
+  
+      return
+        a list of histograms in the order of inputs
+    '''
+    if pool is None and self.n_worker <= 1:
+      results = [_try_histogram(self, i, type, n_slice) for i in inputs]
+    else:
+      if pool is None:
+        pool = self.get_pool()
+      chunks = [(inputs[i:i+self.chunk_size], type, n_slice) for i in range(0, len(inputs), self.chunk_size)]
+      results = []
+      for chunk in pool.imap(_histogram_chunk, chunks):  # imap keeps the order of chunks
+        results.extend(chunk)
+  
+    for path, (_, error) in zip(inputs, results):
+      if error is not None:
+        if failed is None:
+          raise error
+        failed.append((path, error))
+    return [hist for hist, _ in results]
+  
   
   def gabor_histogram(self, input, type=h_type, n_slice=n_slice, normalize=True):
     ''' count img histogram
   
       arguments
-        input    : a path to a image or a numpy.ndarray
+        input    : a path to a image, a numpy.ndarray or a Decoded
         type     : 'global' means count the histogram for whole image
                    'region' means count the histogram for regions in images, then concatanate all of them
         n_slice  : work when type equals to 'region', height & width will equally sliced into N slices
@@ -99,24 +193,34 @@ class Gabor(object):
         type == 'region'
           a numpy array with size len(gabor_kernels) * n_slice * n_slice
     '''
-    if isinstance(input, np.ndarray):  # examinate input type
-      img = input.copy()
+    if isinstance(input, Decoded):  # examinate input type
+      img = input.at(decode_scale).gray
+    elif isinstance(input, np.ndarray):
+      img = to_gray(reduce_image(input, decode_scale))
     else:
-      img = scipy.misc.imread(input, mode='RGB')
-    height, width, channel = img.shape
+      img = to_gray(read_rgb(input, decode_scale))
+    height, width = img.shape[:2]  # regions are cut from the grayscale image, see to_gray()
   
     if type == 'global':
       hist = self._gabor(img, kernels=gabor_kernels)
   
     elif type == 'region':
-      hist = np.zeros((n_slice, n_slice, len(gabor_kernels)))
+      hist = np.zeros((n_slice, n_slice, 2 * len(gabor_kernels)))
       h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
       w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
   
-      for hs in range(len(h_silce)-1):
-        for ws in range(len(w_slice)-1):
-          img_r = img[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
-          hist[hs][ws] = self._gabor(img_r, kernels=gabor_kernels)
+      if self.conv_mode == 'fft':
+        # filter the whole image once, regions take their statistics from the response maps
+        regions = [(h_silce[hs], h_silce[hs+1], w_slice[ws], w_slice[ws+1])
+                   for hs in range(len(h_silce)-1) for ws in range(len(w_slice)-1)]
+        feats = self._bank_feats(img, gabor_kernels, regions)
+        for r, feat in enumerate(feats):
+          hist[r // n_slice][r % n_slice] = self._stats(feat)
+      else:
+        for hs in range(len(h_silce)-1):
+          for ws in range(len(w_slice)-1):
+            img_r = img[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
+            hist[hs][ws] = self._gabor(img_r, kernels=gabor_kernels)
   
     if normalize:
       hist /= np.sum(hist)
@@ -156,19 +260,92 @@ class Gabor(object):
     return feats
   
   
-  def _gabor(self, image, kernels=make_gabor_kernel(theta, frequency, sigma, bandwidth), normalize=True):
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+  def _spectra(self, shape, kernels):
+    ''' real FFT of the real and imaginary parts of every kernel, laid out for circular convolution
+        on an image of size shape, which is what ndi.convolve does with mode='wrap'
+  
+      return
+        a list of (index of the first kernel, spectra of the real parts, spectra of the imaginary parts)
+        for chunks of fft_chunk kernels, spectra are complex64 ndarrays whose shape is
+        (len(chunk), H, W // 2 + 1)
+    '''
+    params = getattr(kernels, 'params', None)
+    if params is None:  # kernels not made by make_gabor_kernel() are keyed on their values
+      digest = hashlib.sha1()
+      for kernel in kernels:
+        digest.update(np.ascontiguousarray(kernel).tobytes())
+      params = digest.hexdigest()
+    key = (shape, params)
+    if key in self.spectra:
+      self.spectra.move_to_end(key)  # most recently used
+      return self.spectra[key]
   
-    img = color.rgb2gray(image)
+    H, W = shape
+    chunks = []
+    for start in range(0, len(kernels), fft_chunk):
+      chunk = kernels[start:start+fft_chunk]
+      padded = np.zeros((2, len(chunk), H, W), dtype=np.float32)
+      for idx, kernel in enumerate(chunk):
+        kh, kw = kernel.shape
+        rows = (np.arange(kh) - kh // 2) % H  # kernel center goes to (0, 0),
+        cols = (np.arange(kw) - kw // 2) % W  # kernels larger than the image wrap around it
+        np.add.at(padded[0, idx], (rows[:, np.newaxis], cols[np.newaxis, :]), np.real(kernel))
+        np.add.at(padded[1, idx], (rows[:, np.newaxis], cols[np.newaxis, :]), np.imag(kernel))
+      spectra = fft.rfft2(padded)
+      chunks.append((start, spectra[0], spectra[1]))
+    self.spectra[key] = chunks
+    while len(self.spectra) > spectra_shapes:
+      self.spectra.popitem(last=False)  # least recently used
+    return chunks
+  
+  
+  def _power_bank(self, image, kernels):
+    ''' the filtered images of _power for all kernels, chunks of fft_chunk kernels are filtered
+        in one batched real FFT
+  
+      yields
+        (index of the first kernel of the chunk, a float32 ndarray whose shape is (len(chunk), ) + image.shape)
+    '''
+    image = ((image - image.mean()) / image.std()).astype(np.float32)  # Normalize images for better comparison.
+    f_image = fft.rfft2(image)
+    for start, real, imag in self._spectra(image.shape, kernels):
+      yield start, np.hypot(fft.irfft2(real * f_image, s=image.shape), fft.irfft2(imag * f_image, s=image.shape))
+  
+  
+  def _bank_feats(self, image, kernels, regions):
+    ''' mean and variance of the filtered images of _power_bank() in every region
+  
+      arguments
+        regions: a list of (top, bottom, left, right) of regions in image
+  
+      return
+        a ndarray whose shape is (len(regions), len(kernels), 2)
+    '''
+    feats = np.zeros((len(regions), len(kernels), 2))
+    for start, f_imgs in self._power_bank(image, kernels):
+      for r, (top, bottom, left, right) in enumerate(regions):
+        f_r = f_imgs[:, top:bottom, left:right]
+        feats[r, start:start+len(f_imgs), 0] = f_r.mean(axis=(1, 2), dtype=np.float64)
+        feats[r, start:start+len(f_imgs), 1] = f_r.var(axis=(1, 2), dtype=np.float64)
+    return feats
+  
+  
+  def _stats(self, feats, normalize=True):
+    ''' feats: a ndarray whose shape is (len(kernels), 2), see _bank_feats() '''
+    if normalize:
+      feats = feats / np.sum(feats, axis=0)
+  
+    return feats.T.flatten()
+  
+  
+  def _gabor(self, image, kernels=gabor_kernels, normalize=True):
+    img = to_gray(image)
+  
+    if self.conv_mode == 'fft':
+      return self._stats(self._bank_feats(img, kernels, [(0, img.shape[0], 0, img.shape[1])])[0], normalize=normalize)
   
-    results = []
     feat_fn = self._power
-    for kernel in kernels:
-      results.append(pool.apply_async(self._worker, (img, kernel, feat_fn)))
-    pool.close()
-    pool.join()
-    
-    hist = np.array([res.get() for res in results])
+    hist = np.array([self._worker(img, kernel, feat_fn) for kernel in kernels])
   
     if normalize:
       hist = hist / np.sum(hist, axis=0)
@@ -185,35 +362,51 @@ class Gabor(object):
     return ret
   
   
-  def make_samples(self, db, verbose=True):
+  def feature(self, input):
+    ''' the histogram of a image as make_samples() stores it, with the configs of the module '''
+    hist = self.gabor_histogram(input, type=h_type, n_slice=n_slice)
+    return hist / np.sum(hist)  # normalize
+  
+  
+  def sample_store(self):
+    ''' the store of the samples, with the configs of the module '''
     if h_type == 'global':
       sample_cache = "gabor-{}-theta{}-frequency{}-sigma{}-bandwidth{}".format(h_type, theta, frequency, sigma, bandwidth)
     elif h_type == 'region':
-      sample_cache = "gabor-{}-n_slice{}-theta{}-frequency{}-sigma{}-bandwidth{}".format(h_type, n_slice, theta, frequency, sigma, bandwidth)
+      sample_cache = "gabor-{}-n_slice{}-{}-theta{}-frequency{}-sigma{}-bandwidth{}".format(h_type, n_slice, self.conv_mode, theta, frequency, sigma, bandwidth)
+    config = {'extractor': 'gabor', 'h_type': h_type, 'n_slice': n_slice, 'conv_mode': self.conv_mode,
+              'theta': theta, 'frequency': frequency, 'sigma': sigma, 'bandwidth': bandwidth}
+    sample_cache, config = scaled_cache(sample_cache, config, decode_scale)
+    return SegmentedStore(os.path.join(cache_dir, sample_cache), config)
   
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
+  
+  def make_samples(self, db, verbose=True, pool=None):
+    cache = self.sample_store()
+    sample_cache = os.path.basename(cache.path)
+
+    def compute(data):
       if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-  
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.gabor_histogram(d_img, type=h_type, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
-    return samples
+        print("Counting histogram..., config=%s, distance=%s, depth=%s, %d images" % (sample_cache, d_type, depth, len(data)))
+      failed = []
+      d_hists = self.histograms(list(data.img), type=h_type, n_slice=n_slice, pool=pool, failed=failed)
+      done = [(d_img, d_hist / np.sum(d_hist)) for d_img, d_hist in zip(data.img, d_hists) if d_hist is not None]  # normalize
+      return [d_img for d_img, _ in done], {'hist': np.array([d_hist for _, d_hist in done])}, failed
+
+    own = pool is None and self.pool is None  # the pool started by this run, kept for all its checkpoints
+    try:
+      changes = cache.update(db, compute)
+    except BaseException:
+      if own and self.pool is not None:  # do not wait for the chunks of a failed run
+        self.pool.terminate()
+      raise
+    finally:
+      if own:
+        self.close()
+    if verbose:
+      print("Using cache..., config=%s, distance=%s, depth=%s, %d added, %d changed, %d removed, %d quarantined" % (
+        sample_cache, d_type, depth, changes['added'], changes['changed'], changes['removed'],
+        changes['quarantined']))
+    return cache.samples(db)
 
 
 if __name__ == "__main__":
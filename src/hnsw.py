@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from six.moves import cPickle
+import numpy as np
+import time
+
+from evaluate import AP, features
+from ivf import exact_search
+
+# configs of the index
+insert_batch  = 256      # samples searched at once by add(), then linked one by one
+visited_bytes = 1 << 25  # memory of the visited stamps of the queries searched at once
+expand        = 4        # nodes of every beam expanded by a step of the search
+
+
+class HNSWIndex(object):
+    ''' hierarchical navigable small-world graph (Malkov & Yashunin), for k-NN queries on CNN features
+
+        Every sample is a node of layer 0 and, with a probability decreasing exponentially,
+        of the layers above. A query greedily descends from the sparse top layer and searches
+        layer 0 with a beam of ef_search nodes. The queries are searched together, every step of
+        the search expands a few nodes of every beam in a few numpy calls, and add() searches the
+        insertion points of a batch of samples together.
+
+        Exact search (ivf.exact_search) stays faster on a few thousand samples, the index pays off
+        from about 10k samples, see recall_report().
+
+        index = HNSWIndex(dim=512, d_type='cosine')
+        index.add(X, cls, img)    # can be called again
+        ap, results = index.infer(query, depth=10)
+    '''
+
+    d_types = ('d1', 'd2', 'cosine')
+
+    def __init__(self, dim, d_type='d2', M=16, ef_construction=200, ef_search=64, seed=0):
+        '''
+          arguments
+            dim            : dimension of the samples
+            d_type         : distance type, one of d_types, see evaluate.distance()
+            M              : links per node on the upper layers, 2 * M on layer 0
+            ef_construction: beam width when inserting, higher builds a better graph, slower
+            ef_search      : beam width when querying, the default of search()
+        '''
+        assert d_type in self.d_types, "d_type should be one of %s" % (self.d_types,)
+        self.dim             = dim
+        self.d_type          = d_type
+        self.M               = M
+        self.ef_construction = ef_construction
+        self.ef_search       = ef_search
+        self.level_mult      = 1 / np.log(M)
+        self.rng             = np.random.RandomState(seed)
+
+        self.n        = 0
+        self.vectors  = np.zeros((0, dim), dtype=np.float32)  # normalized for cosine
+        self.levels   = np.zeros(0, dtype=np.int32)           # top layer of every node
+        self.links0   = np.zeros((0, 2 * M), dtype=np.int64)  # layer 0 neighbors, padded with -1
+        self.links    = []  # layers above 0, {node: numpy array of neighbors} per layer
+        self.entry    = -1
+        self.cls      = np.zeros(0, dtype=object)  # class and path of the samples, in the order of add()
+        self.img      = np.zeros(0, dtype=object)
+        self._stamps  = np.zeros((0, 0), dtype=np.uint16)  # visited stamps of the searches, see _visit()
+        self._stamp   = 0
+
+    def __len__(self):
+        return self.n
+
+    def _distances(self, q, ids):
+        ''' the distances of q to the nodes ids, or of every row of q to the node of ids at its position '''
+        v = self.vectors[ids]  # a copy, the differences are computed in place
+        if self.d_type == 'cosine':  # on normalized vectors
+            return 1 - (v.dot(q) if q.ndim == 1 else np.einsum('ij,ij->i', v, q))
+        v -= q
+        if self.d_type == 'd1':
+            return np.abs(v, out=v).sum(axis=1)
+        return np.einsum('ij,ij->i', v, v)
+
+    def _prepare(self, X):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        assert X.shape[1] == self.dim, "samples should have %d dimensions" % self.dim
+        if self.d_type == 'cosine':
+            norms = np.linalg.norm(X, axis=1, keepdims=True)
+            X = X / np.where(norms > 0, norms, 1)
+        return X
+
+    def _neighbors(self, node, layer):
+        if layer == 0:
+            links = self.links0[node]
+            return links[links >= 0]
+        return self.links[layer - 1][node]
+
+    def _links(self, nodes, layer):
+        ''' the neighbors of nodes as a matrix, padded with -1 '''
+        if layer == 0:
+            links = self.links0[nodes]
+            links[nodes < 0] = -1
+            return links
+        links = np.full((len(nodes), self.M), -1, dtype=np.int64)
+        for i, node in enumerate(nodes):
+            if node >= 0:
+                neighbors = self.links[layer - 1][node]
+                links[i, :len(neighbors)] = neighbors
+        return links
+
+    def _set_neighbors(self, node, layer, neighbors):
+        if layer == 0:
+            self.links0[node] = -1
+            self.links0[node, :len(neighbors)] = neighbors
+        else:
+            self.links[layer - 1][node] = np.asarray(neighbors, dtype=np.int64)
+
+    def _visit(self, n_query):
+        ''' the visited stamps of n_query queries and a new stamp, a node is visited by a search if its entry
+            holds the stamp of the search, so the stamps are reused without being cleared '''
+        stamps = self._stamps
+        if len(stamps) < n_query or stamps.shape[1] < len(self.vectors) or self._stamp == np.iinfo(stamps.dtype).max:
+            self._stamps = np.zeros((max(n_query, len(stamps)), len(self.vectors)), dtype=np.uint16)
+            self._stamp = 0
+        self._stamp += 1
+        return self._stamps[:n_query], self._stamp
+
+    def _greedy(self, Q, entries, layer):
+        ''' the greedy search of a upper layer, the search of a beam of one node: every query moves
+            to its closest neighbor as long as it is closer than the node of the query
+
+          arguments
+            Q      : prepared queries with size n_query * dim
+            entries: the node the search of every query starts from
+
+          return
+            the nodes reached, a numpy array with size n_query
+        '''
+        nodes = np.array(entries, dtype=np.int64)
+        dists = self._distances(Q, nodes)
+        active = np.arange(len(Q))
+        while len(active):
+            links = self._links(nodes[active], layer)
+            rows, cols = np.nonzero(links >= 0)
+            d = np.full(links.shape, np.inf, dtype=np.float32)
+            d[rows, cols] = self._distances(Q[active[rows]], links[rows, cols])
+            best = d.argmin(axis=1)
+            d = d[np.arange(len(active)), best]
+            closer = d < dists[active]
+            nodes[active[closer]], dists[active[closer]] = links[closer, best[closer]], d[closer]
+            active = active[closer]
+        return nodes
+
+    def _search_layer(self, Q, entries, ef, layer):
+        ''' the ef nodes of a layer closest to every query, by a best-first search of all the queries
+            at once: each step expands the expand closest nodes not expanded yet of every beam
+
+          arguments
+            Q      : prepared queries with size n_query * dim
+            entries: the nodes the search of every query starts from, n_query * k, padded with -1
+
+          return
+            dists, ids: numpy arrays with size n_query * ef, sorted ascending, padded with inf and -1
+        '''
+        step = max(1, visited_bytes // (2 * max(len(self.vectors), 1)))
+        if len(Q) > step:
+            parts = [self._search_layer(Q[i:i + step], entries[i:i + step], ef, layer) for i in range(0, len(Q), step)]
+            return np.concatenate([d for d, _ in parts]), np.concatenate([ids for _, ids in parts])
+        stamps, stamp = self._visit(len(Q))
+        rows = np.arange(len(Q))
+        dists = np.full((len(Q), ef), np.inf, dtype=np.float32)
+        ids = np.full((len(Q), ef), -1, dtype=np.int64)
+        expanded = np.ones((len(Q), ef), dtype=bool)
+        w = min(expand, ef)
+        active, new = rows, np.asarray(entries, dtype=np.int64)
+        while len(active):
+            # measure the new nodes of the active queries and merge them into their beams
+            at = np.broadcast_to(active[:, None], new.shape)
+            valid = new >= 0
+            valid[valid] = stamps[at[valid], new[valid]] != stamp
+            where = np.nonzero(valid)
+            _, first = np.unique(at[where] * len(self.vectors) + new[where], return_index=True)
+            where = where[0][first], where[1][first]  # a neighbor of several expanded nodes once
+            nodes = new[where]
+            stamps[active[where[0]], nodes] = stamp
+            # only the nodes not visited yet are measured, then packed at the start of their rows
+            counts = np.bincount(where[0], minlength=len(active))
+            cols = np.arange(len(nodes)) - np.repeat(np.cumsum(counts) - counts, counts)
+            new = np.full((len(active), counts.max(initial=0)), -1, dtype=np.int64)
+            d = np.full(new.shape, np.inf, dtype=np.float32)
+            new[where[0], cols] = nodes
+            d[where[0], cols] = self._distances(Q[active[where[0]]], nodes)
+            r = np.arange(len(active))[:, None]
+            d = np.concatenate([dists[active], d], axis=1)
+            i = np.concatenate([ids[active], new], axis=1)
+            x = np.concatenate([expanded[active], new < 0], axis=1)
+            if d.shape[1] > ef:
+                top = np.argpartition(d, ef - 1, axis=1)[:, :ef]
+                d, i, x = d[r, top], i[r, top], x[r, top]
+            dists[active], ids[active], expanded[active] = d, i, x
+
+            # expand the closest nodes not expanded yet, the search of a query ends once all its beam is
+            closest = np.where(x, np.inf, d)
+            picks = np.argpartition(closest, w - 1, axis=1)[:, :w] if w > 1 else np.argmin(closest, axis=1)[:, None]
+            ok = np.isfinite(closest[r, picks])
+            more = ok.any(axis=1)
+            active, picks, ok = active[more], picks[more], ok[more]
+            at = np.broadcast_to(active[:, None], picks.shape)
+            expanded[at[ok], picks[ok]] = True
+            links = self._links(np.where(ok, ids[at, picks], -1).ravel(), layer)
+            new = links.reshape(len(active), w * links.shape[1])
+        order = np.argsort(dists, axis=1, kind='stable')
+        return np.take_along_axis(dists, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def _select(self, dists, ids, m):
+        ''' the neighbor selection heuristic: keep a candidate only if it is closer to the node
+            than to every neighbor kept so far, so links point in diverse directions
+
+          arguments
+            dists, ids: the candidates and their distances to the node, sorted ascending
+        '''
+        dists, ids = np.asarray(dists), np.asarray(ids, dtype=np.int64)
+        left, selected = np.arange(len(ids)), []
+        while len(left) and len(selected) < m:
+            e = ids[left[0]]
+            selected.append(e)
+            left = left[1:]
+            left = left[dists[left] < self._distances(self.vectors[e], ids[left])]
+        return selected
+
+    def _grow(self, n_new):
+        cap = len(self.vectors)
+        if self.n + n_new <= cap:
+            return
+        cap = max(self.n + n_new, 2 * cap)
+        for name, fill in [('vectors', 0), ('levels', 0), ('links0', -1)]:
+            old = getattr(self, name)
+            new = np.full((cap,) + old.shape[1:], fill, dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def _insert(self, nodes, levels):
+        ''' insert a batch of nodes: the insertion points of all of them are searched at once
+            in the graph of the former nodes, then every node is linked, also to the nodes of
+            the batch inserted before it
+        '''
+        for node, level in zip(nodes, levels):
+            self.levels[node] = level
+            while len(self.links) < level:
+                self.links.append({})
+            for layer in range(1, level + 1):
+                self.links[layer - 1][node] = np.zeros(0, dtype=np.int64)
+        if self.entry < 0:
+            self.entry, nodes, levels = nodes[0], nodes[1:], levels[1:]  # a batch of one node
+            self.n = self.entry + 1
+            if not len(nodes):
+                return
+
+        Q = self.vectors[nodes]
+        found = [{} for _ in nodes]  # {layer: (dists, ids)} of every node
+        entries = np.full((len(nodes), 1), self.entry, dtype=np.int64)
+        for layer in range(self.levels[self.entry], -1, -1):  # greedy descent to the layer of the node
+            below = levels < layer
+            width = 1 if below.all() else self.ef_construction
+            out = np.full((len(nodes), width), -1, dtype=np.int64)
+            rows = np.flatnonzero(below)
+            if len(rows):
+                out[rows, 0] = self._greedy(Q[rows], entries[rows, 0], layer)
+            rows = np.flatnonzero(~below)
+            if len(rows):
+                d, ids = self._search_layer(Q[rows], entries[rows], self.ef_construction, layer)
+                out[rows] = ids
+                for row, d_row, ids_row in zip(rows, d, ids):
+                    found[row][layer] = d_row[ids_row >= 0], ids_row[ids_row >= 0]
+            entries = out
+
+        self.n = nodes[-1] + 1
+        for k, (node, level) in enumerate(zip(nodes, levels)):
+            q = self.vectors[node]
+            for layer in range(level, -1, -1):
+                d, ids = found[k].get(layer, (np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)))
+                before = nodes[:k][levels[:k] >= layer]
+                if len(before):
+                    d, ids = np.concatenate([d, self._distances(q, before)]), np.concatenate([ids, before])
+                    order = np.argsort(d, kind='stable')
+                    d, ids = d[order], ids[order]
+                m_max = 2 * self.M if layer == 0 else self.M
+                neighbors = self._select(d, ids, self.M)
+                self._set_neighbors(node, layer, neighbors)
+                for e in neighbors:  # links are both ways, a full neighbor list is shrunk
+                    links = np.append(self._neighbors(e, layer), node)
+                    if len(links) > m_max:
+                        d_e = self._distances(self.vectors[e], links)
+                        order = np.argsort(d_e, kind='stable')
+                        links = self._select(d_e[order], links[order], m_max)
+                    self._set_neighbors(e, layer, links)
+            if level > self.levels[self.entry]:
+                self.entry = node
+
+    def add(self, X, cls, img):
+        ''' insert samples into the graph, by batches of at most insert_batch samples
+            and of a quarter of the graph, so the first samples are inserted one by one
+
+          arguments
+            X  : a numpy array with size N * dim
+            cls: the class of every sample
+            img: the path of every sample
+        '''
+        X = self._prepare(X)
+        self._grow(len(X))
+        self.vectors[self.n:self.n + len(X)] = X
+        self.cls = np.concatenate([self.cls, np.asarray(list(cls), dtype=object)])
+        self.img = np.concatenate([self.img, np.asarray(list(img), dtype=object)])
+        levels = (-np.log(1 - self.rng.rand(len(X))) * self.level_mult).astype(np.int32)
+        start, end = self.n, self.n + len(X)
+        while self.n < end:
+            size = min(end - self.n, insert_batch, max(1, self.n // 4))
+            self._insert(np.arange(self.n, self.n + size), levels[self.n - start:self.n - start + size])
+        return self
+
+    def add_samples(self, samples):
+        ''' add samples as made by the extractors, see evaluate.infer() '''
+        return self.add(features(samples), [s['cls'] for s in samples], [s['img'] for s in samples])
+
+    def search(self, queries, depth=10, ef_search=None):
+        ''' approximate nearest samples of every query
+
+          return
+            dists: a numpy array with size Q * depth, sorted ascending, padded with inf
+            ids  : a numpy array with size Q * depth, positions in the order of add(), padded with -1
+        '''
+        ef = max(ef_search or self.ef_search, depth)
+        queries = self._prepare(queries)
+        dists = np.full((len(queries), depth), np.inf)
+        ids = np.full((len(queries), depth), -1, dtype=np.int64)
+        if self.entry < 0:
+            return dists, ids
+        entries = np.full(len(queries), self.entry, dtype=np.int64)
+        for layer in range(self.levels[self.entry], 0, -1):
+            entries = self._greedy(queries, entries, layer)
+        found_d, found = self._search_layer(queries, entries[:, None], ef, 0)
+        k = min(depth, ef)
+        dists[:, :k], ids[:, :k] = np.where(found[:, :k] >= 0, found_d[:, :k], np.inf), found[:, :k]
+        return dists, ids
+
+    def infer(self, query, depth=10, ef_search=None):
+        ''' infer a query as evaluate.infer() does, the query image itself is left out of the results
+
+          return
+            ap, results as a list of {'dis': <distance>, 'cls': <sample's class>}
+        '''
+        dists, ids = self.search(query['hist'][None], depth=depth + 1, ef_search=ef_search)
+        results = [{'dis': d, 'cls': self.cls[i]} for d, i in zip(dists[0], ids[0])
+                   if i >= 0 and self.img[i] != query['img']][:depth]
+        return AP(query['cls'], results, sort=False), results
+
+    def save(self, path):
+        state = dict(self.__dict__)
+        for name in ['vectors', 'levels', 'links0']:  # drop the spare capacity
+            state[name] = state[name][:self.n]
+        state['_stamps'], state['_stamp'] = np.zeros((0, 0), dtype=np.uint16), 0
+        with open(path, "wb") as f:
+            cPickle.dump(state, f)
+
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        with open(path, "rb") as f:
+            index.__dict__.update(cPickle.load(f))
+        return index
+
+
+def recall_report(samples, d_type='d2', M=16, ef_construction=200, ef_searches=(10, 20, 40, 80, 160),
+                  depth=10, n_query=200, name=''):
+    ''' recall@depth and per-query latency of HNSWIndex against exact search, for every ef_search,
+        the queries searched one by one, as interactive queries are, and all at once
+
+      arguments
+        samples: samples as made by the extractors, the index is built on all of them
+        n_query: number of samples used as queries
+
+      return
+        a list of (ef_search, recall, seconds per batched query, seconds per single query)
+    '''
+    X = features(samples)
+    index = HNSWIndex(X.shape[1], d_type=d_type, M=M, ef_construction=ef_construction)
+    start = time.time()
+    index.add(X, [s['cls'] for s in samples], [s['img'] for s in samples])
+    print("{}: {} samples, M {}, ef_construction {}, built in {:.2f}s, {:.2f}ms/insert".format(
+        name, len(X), M, ef_construction, time.time() - start, (time.time() - start) * 1000 / len(X)))
+
+    queries = X[np.random.RandomState(0).choice(len(X), min(n_query, len(X)), replace=False)]
+    start = time.time()
+    _, exact = exact_search(queries, X, depth=depth, d_type=d_type)
+    t_exact = (time.time() - start) / len(queries)
+    print("{}, exact: {:.3f}ms/query".format(name, t_exact * 1000))
+    report = []
+    for ef in ef_searches:
+        start = time.time()
+        _, ids = index.search(queries, depth=depth, ef_search=ef)
+        t = (time.time() - start) / len(queries)
+        start = time.time()
+        for q in queries:
+            index.search(q[None], depth=depth, ef_search=ef)
+        t_single = (time.time() - start) / len(queries)
+        recall = np.mean([len(set(a) & set(b)) / float(len(b)) for a, b in zip(ids, exact)])
+        print("{}, ef_search {}: recall@{} {:.3f}, {:.3f}ms/query batched, {:.3f}ms/query single{}".format(
+            name, ef, depth, recall, t * 1000, t_single * 1000, '' if t < t_exact else ', slower than exact search'))
+        report.append((ef, recall, t, t_single))
+    return report
+
+
+if __name__ == "__main__":
+    from DB import Database
+    from resnet import ResNetFeat
+    from vggnet import VGGNetFeat
+
+    db = Database(DB_dir="CorelDBDataSet/train", DB_csv="CorelDBDataSetTrain.csv")
+
+    # latency vs recall on the CNN descriptors
+    for name, f in [('resnet avg', ResNetFeat(pick_layer='avg')), ('vgg avg', VGGNetFeat(pick_layer='avg'))]:
+        samples = f.make_samples(db, verbose=False)
+        for d_type in HNSWIndex.d_types:
+            recall_report(samples, d_type=d_type, name='%s, %s' % (name, d_type))
@@ -2,69 +2,22 @@
 
 from __future__ import print_function
 
-from evaluate import infer
 from DB import Database
-
-from color import Color
-from daisy import Daisy
-from edge  import Edge
-from gabor import Gabor
-from HOG   import HOG
-from vggnet import VGGNetFeat
-from resnet import ResNetFeat
+from retriever import Retriever
+from pipeline import Pipeline
 
 depth = 5
 d_type = 'd1'
 query_idx = 0
 
 if __name__ == '__main__':
-  db = Database()
-
-  # retrieve by color
-  method = Color()
-  samples = method.make_samples(db)
-  query = samples[query_idx]
-  _, result = infer(query, samples=samples, depth=depth, d_type=d_type)
-  print(result)
-
-  # retrieve by daisy
-  method = Daisy()
-  samples = method.make_samples(db)
-  query = samples[query_idx]
-  _, result = infer(query, samples=samples, depth=depth, d_type=d_type)
-  print(result)
-
-  # retrieve by edge
-  method = Edge()
-  samples = method.make_samples(db)
-  query = samples[query_idx]
-  _, result = infer(query, samples=samples, depth=depth, d_type=d_type)
-  print(result)
-
-  # retrieve by gabor
-  method = Gabor()
-  samples = method.make_samples(db)
-  query = samples[query_idx]
-  _, result = infer(query, samples=samples, depth=depth, d_type=d_type)
-  print(result)
-
-  # retrieve by HOG
-  method = HOG()
-  samples = method.make_samples(db)
-  query = samples[query_idx]
-  _, result = infer(query, samples=samples, depth=depth, d_type=d_type)
-  print(result)
-
-  # retrieve by VGG
-  method = VGGNetFeat()
-  samples = method.make_samples(db)
-  query = samples[query_idx]
-  _, result = infer(query, samples=samples, depth=depth, d_type=d_type)
-  print(result)
-
-  # retrieve by resnet
-  method = ResNetFeat()
-  samples = method.make_samples(db)
-  query = samples[query_idx]
-  _, result = infer(query, samples=samples, depth=depth, d_type=d_type)
-  print(result)
+  db = Database(DB_dir="CorelDBDataSet/train", DB_csv="CorelDBDataSetTrain.csv")
+  query = db.get_data().img[query_idx]  # any image path or RGB array can be queried
+
+  # retrieve by color, daisy, edge, gabor, HOG, VGG and resnet
+  methods = ['color', 'daisy', 'edge', 'gabor', 'hog', 'vgg', 'resnet']
+  Pipeline(methods).make_samples(db)  # every image is decoded once for all the methods
+  for method in methods:
+    retriever = Retriever(db, method, d_type=d_type, depth=depth)  # keep it to answer more queries
+    result = retriever.query(query)
+    print(result)
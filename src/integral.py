@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import numpy as np
+
+
+def slice_bounds(length, n_slice):
+    ''' the borders used by the extractors to equally slice a side of length into n_slice parts '''
+    return np.around(np.linspace(0, length, n_slice + 1, endpoint=True)).astype(int)
+
+
+class IntegralHistogram(object):
+    ''' summed-area table of a per-pixel histogram
+
+        The table is only kept at the given cut positions: the sum over any
+        rectangle whose borders are cuts is then 4 lookups, whatever its size.
+        Cuts usually are the union of slice_bounds() for every n_slice of a sweep.
+    '''
+
+    def __init__(self, cells, h_cuts, w_cuts):
+        ''' arguments
+              cells : a numpy array with size (len(h_cuts) - 1) * (len(w_cuts) - 1) * n_bins,
+                      the histogram of every cell between two consecutive cuts
+              h_cuts: sorted cut positions along height, from 0 to height
+              w_cuts: sorted cut positions along width, from 0 to width
+        '''
+        self.h_cuts = np.asarray(h_cuts)
+        self.w_cuts = np.asarray(w_cuts)
+        n_h, n_w, n_bins = cells.shape
+        self.table = np.zeros((n_h + 1, n_w + 1, n_bins), dtype=cells.dtype)
+        self.table[1:, 1:] = np.cumsum(np.cumsum(cells, axis=0), axis=1)
+
+    @classmethod
+    def from_bins(cls, bin_map, n_bins, h_cuts=None, w_cuts=None):
+        ''' build the table from the bin index of every pixel
+
+          arguments
+            bin_map: a numpy array with size height * width holding bin indexes
+            n_bins : number of bins
+            h_cuts : positions along height the table is kept at, every row if None
+            w_cuts : positions along width the table is kept at, every column if None
+        '''
+        height, width = bin_map.shape
+        h_cuts = np.arange(height + 1) if h_cuts is None else np.unique(np.append(h_cuts, [0, height]))
+        w_cuts = np.arange(width + 1) if w_cuts is None else np.unique(np.append(w_cuts, [0, width]))
+        n_h, n_w = len(h_cuts) - 1, len(w_cuts) - 1
+
+        # cell of every pixel, every cell is counted in one bincount
+        h_cell = np.searchsorted(h_cuts, np.arange(height), side='right') - 1
+        w_cell = np.searchsorted(w_cuts, np.arange(width), side='right') - 1
+        cell = h_cell[:, np.newaxis] * n_w + w_cell[np.newaxis, :]
+        cells = np.bincount((cell * n_bins + bin_map).ravel(), minlength=n_h * n_w * n_bins)
+
+        return cls(cells.reshape(n_h, n_w, n_bins), h_cuts, w_cuts)
+
+    @classmethod
+    def from_values(cls, values):
+        ''' build the table at every pixel from per-pixel values with size height * width * n_bins '''
+        height, width, _ = values.shape
+        return cls(values, np.arange(height + 1), np.arange(width + 1))
+
+    def _index(self, cuts, pos):
+        idx = np.searchsorted(cuts, pos)
+        assert np.all(cuts[np.minimum(idx, len(cuts) - 1)] == pos), "position is not a cut of the table"
+        return idx
+
+    def sum(self, hs, he, ws, we):
+        ''' histogram of the rectangle [hs, he) * [ws, we), positions can be broadcastable arrays of cuts '''
+        i0, i1 = self._index(self.h_cuts, hs), self._index(self.h_cuts, he)
+        j0, j1 = self._index(self.w_cuts, ws), self._index(self.w_cuts, we)
+        t = self.table
+        return t[i1, j1] - t[i0, j1] - t[i1, j0] + t[i0, j0]
+
+    def grid(self, h_slice, w_slice):
+        ''' histograms of the regions between consecutive borders
+
+          return
+            a numpy array with size (len(h_slice) - 1) * (len(w_slice) - 1) * n_bins
+        '''
+        h_slice, w_slice = np.asarray(h_slice), np.asarray(w_slice)
+        return self.sum(h_slice[:-1, np.newaxis], h_slice[1:, np.newaxis],
+                        w_slice[np.newaxis, :-1], w_slice[np.newaxis, 1:])
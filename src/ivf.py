@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from six.moves import cPickle
+import numpy as np
+import time
+
+from evaluate import AP, distance_matrix, features
+
+# configs of the index
+add_batch = 8192  # samples assigned to their lists at once by add(), bounds its float64 temporaries
+
+
+class IVFIndex(object):
+    ''' inverted-file index: the samples are split into n_list lists by a k-means coarse quantizer,
+        a query only scans the nprobe lists whose centroids are the closest to it
+
+        index = IVFIndex(n_list=64, d_type='d1')
+        index.train(X)            # X can be a np.memmap, it is read by mini-batches
+        index.add(X, cls, img)    # can be called again, only the new samples are copied
+        ap, results = index.infer(query, depth=10)
+    '''
+
+    def __init__(self, n_list=64, d_type='d1', nprobe=8):
+        '''
+          arguments
+            n_list: number of lists of the coarse quantizer
+            d_type: distance type, see evaluate.distance()
+            nprobe: lists scanned by a query, the default of search()
+        '''
+        self.n_list    = n_list
+        self.d_type    = d_type
+        self.nprobe    = nprobe
+        self.centroids = None
+        self.counts    = None  # samples seen by every centroid during training
+        self.vectors   = [np.zeros((0, 0), dtype=np.float32)] * n_list  # float32 samples of every list,
+        self.ids       = [np.zeros(0, dtype=np.int64)] * n_list  # and their positions in the order of add(),
+        self.sizes     = np.zeros(n_list, dtype=np.int64)        # list l is vectors[l][:sizes[l]]
+        self.cls       = []  # class and path of the samples, in the order of add()
+        self.img       = []
+
+    def __len__(self):
+        return len(self.cls)
+
+    def train(self, X, batch_size=1024, n_iter=50, seed=0):
+        ''' fit the centroids with mini-batch k-means, can be called again on new data to refine them
+
+          arguments
+            X         : a numpy array or np.memmap with size N * D, only batch_size rows are read at once
+            batch_size: rows per k-means step
+            n_iter    : number of k-means steps
+        '''
+        rng = np.random.RandomState(seed)
+        n = len(X)
+        if self.centroids is None:
+            assert n >= self.n_list, "needs at least n_list samples to train"
+            self.centroids = np.array(X[np.sort(rng.choice(n, self.n_list, replace=False))], dtype=np.float64)
+            self.counts = np.zeros(self.n_list)
+        for _ in range(n_iter):
+            batch = np.asarray(X[np.sort(rng.choice(n, min(batch_size, n), replace=False))], dtype=np.float64)
+            assign = self._assign(batch)
+            # per-centroid learning rate 1 / count, as in Sculley's mini-batch k-means
+            self.counts += np.bincount(assign, minlength=self.n_list)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, batch)
+            n_new = np.bincount(assign, minlength=self.n_list)
+            seen = n_new > 0
+            rate = n_new[seen] / self.counts[seen]
+            self.centroids[seen] += rate[:, None] * (sums[seen] / n_new[seen, None] - self.centroids[seen])
+        return self
+
+    def _assign(self, X):
+        return np.argmin(distance_matrix(X, self.centroids, d_type=self.d_type), axis=1)
+
+    def _append(self, l, X, ids):
+        ''' append samples to list l, its arrays grow by doubling so adds copy the stored samples O(log N) times '''
+        size = self.sizes[l]
+        if size + len(X) > len(self.ids[l]):
+            cap = max(size + len(X), 2 * len(self.ids[l]))
+            vectors = np.empty((cap, X.shape[1]), dtype=np.float32)
+            if size:
+                vectors[:size] = self.vectors[l][:size]
+            self.vectors[l] = vectors
+            self.ids[l] = np.concatenate([self.ids[l][:size], np.zeros(cap - size, dtype=np.int64)])
+        self.vectors[l][size:size + len(X)] = X
+        self.ids[l][size:size + len(X)] = ids
+        self.sizes[l] += len(X)
+
+    def add(self, X, cls, img):
+        ''' add samples to the index, after train(), they are stored in float32
+
+          arguments
+            X  : a numpy array or np.memmap with size N * D, only add_batch rows are read at once
+            cls: the class of every sample
+            img: the path of every sample
+        '''
+        assert self.centroids is not None, "needs to train the index before adding samples"
+        n = len(self)
+        for start in range(0, len(X), add_batch):
+            part = np.asarray(X[start:start + add_batch], dtype=np.float32)
+            assign = self._assign(part)
+            order = np.argsort(assign, kind='stable')
+            bounds = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=self.n_list))])
+            for l in np.flatnonzero(np.diff(bounds)):
+                rows = order[bounds[l]:bounds[l + 1]]
+                self._append(l, part[rows], n + start + rows)
+        self.cls.extend(cls)
+        self.img.extend(img)
+        return self
+
+    def add_samples(self, samples):
+        ''' add samples as made by the extractors, see evaluate.infer() '''
+        return self.add(features(samples), [s['cls'] for s in samples], [s['img'] for s in samples])
+
+    def search(self, queries, depth=10, nprobe=None):
+        ''' approximate nearest samples of every query
+
+          return
+            dists: a numpy array with size Q * depth, sorted ascending, padded with inf
+            ids  : a numpy array with size Q * depth, positions in the order of add(), padded with -1
+        '''
+        nprobe = min(nprobe or self.nprobe, self.n_list)
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        coarse = distance_matrix(queries, self.centroids, d_type=self.d_type)
+        probes = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+        dists = np.full((len(queries), depth), np.inf)
+        ids = np.full((len(queries), depth), -1, dtype=np.int64)
+        for q, lists in enumerate(probes):
+            lists = [l for l in lists if self.sizes[l]]
+            if not lists:
+                continue
+            rows = np.concatenate([self.ids[l][:self.sizes[l]] for l in lists])
+            X = np.concatenate([self.vectors[l][:self.sizes[l]] for l in lists])  # upcast by distance_matrix
+            d = distance_matrix(queries[q:q + 1], X, d_type=self.d_type)[0]
+            k = min(depth, len(rows))
+            top = np.argpartition(d, k - 1)[:k]
+            top = top[np.argsort(d[top], kind='stable')]
+            dists[q, :k] = d[top]
+            ids[q, :k] = rows[top]
+        return dists, ids
+
+    def infer(self, query, depth=10, nprobe=None):
+        ''' infer a query as evaluate.infer() does, the query image itself is left out of the results
+
+          return
+            ap, results as a list of {'dis': <distance>, 'cls': <sample's class>}
+        '''
+        dists, ids = self.search(query['hist'][None], depth=depth + 1, nprobe=nprobe)
+        results = [{'dis': d, 'cls': self.cls[i]} for d, i in zip(dists[0], ids[0])
+                   if i >= 0 and self.img[i] != query['img']][:depth]
+        return AP(query['cls'], results, sort=False), results
+
+    def save(self, path):
+        state = dict(self.__dict__)
+        for name in ['vectors', 'ids']:  # drop the spare capacity
+            state[name] = [a[:size] for a, size in zip(state[name], self.sizes)]
+        with open(path, "wb") as f:
+            cPickle.dump(state, f)
+
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        with open(path, "rb") as f:
+            index.__dict__.update(cPickle.load(f))
+        return index
+
+
+def exact_search(queries, X, depth=10, d_type='d1'):
+    ''' the exact nearest samples of every query, by a linear scan, see IVFIndex.search() '''
+    d = distance_matrix(queries, X, d_type=d_type)
+    k = min(depth, X.shape[0])
+    top = np.argpartition(d, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(top, np.argsort(np.take_along_axis(d, top, axis=1), axis=1, kind='stable'), axis=1)
+    return np.take_along_axis(d, top, axis=1), top
+
+
+def recall_report(samples, n_list=None, nprobes=(1, 2, 4, 8, 16, 32), depth=10, n_query=200, d_type='d1', name=''):
+    ''' recall@depth and per-query latency of IVFIndex against exact search, for every nprobe
+
+      arguments
+        samples: samples as made by the extractors, the index is built on all of them
+        n_list : number of lists, defaults to about sqrt(len(samples))
+        n_query: number of samples used as queries
+    '''
+    X = features(samples)
+    n_list = n_list or max(1, int(np.sqrt(len(X))))
+    index = IVFIndex(n_list=n_list, d_type=d_type)
+    start = time.time()
+    index.train(X)
+    index.add(X, [s['cls'] for s in samples], [s['img'] for s in samples])
+    print("{}: {} samples, {} lists, built in {:.2f}s".format(name, len(X), n_list, time.time() - start))
+
+    queries = X[np.random.RandomState(0).choice(len(X), min(n_query, len(X)), replace=False)]
+    start = time.time()
+    _, exact = exact_search(queries, X, depth=depth, d_type=d_type)
+    t_exact = (time.time() - start) / len(queries)
+    print("{}, exact: {:.3f}ms/query".format(name, t_exact * 1000))
+    report = []
+    for nprobe in nprobes:
+        if nprobe > n_list:
+            break
+        start = time.time()
+        _, ids = index.search(queries, depth=depth, nprobe=nprobe)
+        t = (time.time() - start) / len(queries)
+        recall = np.mean([len(set(a) & set(b)) / float(len(b)) for a, b in zip(ids, exact)])
+        print("{}, nprobe {}: recall@{} {:.3f}, {:.3f}ms/query".format(name, nprobe, depth, recall, t * 1000))
+        report.append((nprobe, recall, t))
+    return report
+
+
+if __name__ == "__main__":
+    from DB import Database
+    from color import Color
+    from resnet import ResNetFeat
+
+    db = Database(DB_dir="CorelDBDataSet/train", DB_csv="CorelDBDataSetTrain.csv")
+
+    # recall vs latency on the ResNet avg feature and the Color region histogram
+    recall_report(ResNetFeat(pick_layer='avg').make_samples(db, verbose=False), name='resnet avg')
+    recall_report(Color().make_samples(db, verbose=False), name='color region')
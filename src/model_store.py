@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import contextlib
+import os
+import sys
+
+import torch
+import torch.utils.model_zoo as model_zoo
+
+
+''' a local store of backbone weights, so the extractors start without network access
+
+      <store_dir>/<model>.pt        : the state_dict of a pretrained model, loaded memory-mapped
+      <store_dir>/<model>-trunk.pt  : its convolution trunk, traced and frozen with TorchScript (optional)
+
+    Fill the store on a machine with network access and copy it to the extraction nodes
+      python model_store.py resnet152 vgg19
+
+    A model missing in the store fails fast, set allow_download to fetch it from the network instead.
+'''
+store_dir      = 'models'
+allow_download = False  # fetch weights missing in the store from the network, and keep them in the store
+
+
+def weights_path(model):
+  return os.path.join(store_dir, '%s.pt' % model)
+
+
+def trunk_path(model):
+  return os.path.join(store_dir, '%s-trunk.pt' % model)
+
+
+def _atomic_save(save_fn, path):
+  if not os.path.exists(store_dir):
+    os.makedirs(store_dir)
+  tmp = '%s.tmp%d' % (path, os.getpid())
+  try:
+    save_fn(tmp)
+    os.replace(tmp, path)
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+
+def save_weights(model, state_dict):
+  ''' write the state_dict of a model into the store '''
+  _atomic_save(lambda path: torch.save(state_dict, path), weights_path(model))
+
+
+def fetch(model, url):
+  ''' download the weights of a model from url into the store '''
+  save_weights(model, model_zoo.load_url(url, map_location='cpu'))
+
+
+def has_weights(model):
+  return os.path.exists(weights_path(model))
+
+
+def load_weights(model, url=None):
+  ''' the state_dict of a model, with its tensors memory-mapped from the store
+
+    Pages of the file are read when a tensor is first used, so unused layers cost nothing.
+    A model missing in the store is fetched from url if allow_download is set.
+  '''
+  if not has_weights(model):
+    if not (allow_download and url):
+      raise IOError("%s is not in the model store %s, fill it with `python model_store.py %s`" % (
+        model, os.path.abspath(store_dir), model))
+    fetch(model, url)
+  return torch.load(weights_path(model), map_location='cpu', mmap=True, weights_only=True)
+
+
+def init_device(pretrained):
+  ''' a context building the layers of a model without allocating and initializing their weights
+
+    Parameters are created on the meta device when they will be replaced by stored weights anyway,
+    load them with load_state_dict(..., assign=True).
+  '''
+  if pretrained:
+    return torch.device('meta')
+  return contextlib.nullcontext()
+
+
+def save_trunk(model, net, example=None):
+  ''' trace and freeze the convolution trunk of net, see ResidualNet.trunk(), and write it into the store
+
+    The trunk only holds convolutions and poolings of fixed size, so the traced module accepts any input size.
+  '''
+  if example is None:
+    example = torch.zeros(1, 3, 224, 224)
+  net.eval()
+  with torch.no_grad():
+    trunk = torch.jit.freeze(torch.jit.trace(net.trunk().eval(), example))
+  _atomic_save(lambda path: torch.jit.save(trunk, path), trunk_path(model))
+
+
+def load_trunk(model):
+  ''' the frozen trunk of a model, or None if it is not in the store '''
+  if not os.path.exists(trunk_path(model)):
+    return None
+  return torch.jit.load(trunk_path(model), map_location='cpu')
+
+
+if __name__ == "__main__":
+  # fetch models into the store, and freeze their trunks
+  import model_store  # the module the extractors import, not __main__
+  import resnet
+  import vggnet
+  model_store.allow_download = True  # filling the store is the one place that goes to the network
+  for model in sys.argv[1:]:
+    if model in resnet.model_urls:
+      net = resnet.ResidualNet(model=model)
+    elif model in vggnet.model_urls:
+      net = vggnet.VGGNet(model=model)
+    else:
+      raise ValueError("unknown model %s" % model)
+    save_trunk(model, net)
+    print("stored %s in %s" % (model, os.path.abspath(store_dir)))
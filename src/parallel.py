@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import batching
+
+try:
+  from threadpoolctl import threadpool_limits
+except ImportError:  # the environment variables still cap the BLAS of a spawned worker
+  threadpool_limits = None
+
+# configs of the extraction pool
+n_worker     = multiprocessing.cpu_count()  # processes of the pool, 1 extracts in the main process
+chunk_size   = 8  # images sent to a worker at once
+blas_threads = 1  # BLAS / OpenMP threads of every worker, n_worker * blas_threads should not exceed the cores
+
+thread_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+               'NUMEXPR_NUM_THREADS']
+
+
+def cap_threads(n_threads=blas_threads):
+  ''' cap the BLAS, OpenMP and torch threads of this process, called by the pool workers
+
+      n_worker processes each running a BLAS with one thread per core would oversubscribe the cores
+  '''
+  global worker_limits
+  for var in thread_vars:
+    os.environ[var] = str(n_threads)
+  if threadpool_limits is not None:  # the BLAS of a forked worker is already loaded
+    worker_limits = threadpool_limits(n_threads)  # kept for the life of the worker
+  if 'torch' in sys.modules:
+    sys.modules['torch'].set_num_threads(n_threads)
+
+
+def _init_worker(f, kwargs, n_threads):
+  global worker_f, worker_kwargs
+  cap_threads(n_threads)
+  batching.image_cache.max_bytes = 0  # a run reads every image once, a LRU per worker would only pin memory
+  worker_f, worker_kwargs = f, kwargs  # sent once, lives as long as the worker
+
+
+def _try_histogram(f, path, kwargs):
+  ''' (histogram, None), or (None, error) if the image fails '''
+  try:
+    return f.histogram(path, **kwargs), None
+  except Exception as e:
+    return None, e
+
+
+def _histogram_chunk(paths):
+  return [_try_histogram(worker_f, path, worker_kwargs) for path in paths]
+
+
+class HistogramPool(object):
+  ''' the pool of processes of an extraction run, started on first use and kept until close(),
+      so the checkpoints of a run reuse the same workers
+
+    with HistogramPool(f, type=h_type) as pool:
+      for path, hist, error in pool.imap(paths):
+        ...
+  '''
+
+  def __init__(self, f, n_worker=n_worker, chunk_size=chunk_size, blas_threads=blas_threads, **kwargs):
+    '''
+      arguments
+        f         : an extractor with a histogram(path) method, pickled once to every worker
+        n_worker  : processes of the pool, 1 computes in this process
+        chunk_size: images sent to a worker at once
+        kwargs    : arguments of f.histogram()
+    '''
+    self.f            = f
+    self.n_worker     = n_worker
+    self.chunk_size   = chunk_size
+    self.blas_threads = blas_threads
+    self.kwargs       = kwargs
+    self.pool         = None
+
+  def get_pool(self):
+    if self.pool is None:  # the workers decode without image_cache, see _init_worker()
+      self.pool = multiprocessing.Pool(processes=self.n_worker, initializer=_init_worker,
+                                       initargs=(self.f, self.kwargs, self.blas_threads))
+    return self.pool
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    if exc[0] is not None and self.pool is not None:  # do not wait for the chunks of a failed run
+      self.pool.terminate()
+    self.close()
+
+  def imap(self, paths):
+    ''' f.histogram(path, **kwargs) of many images, chunks of images are spread over the pool
+
+      yields
+        (path, histogram, None), or (path, None, error) if the image fails, in the order of paths
+        and as soon as the chunk of the image is done
+    '''
+    if self.n_worker <= 1 or (self.pool is None and len(paths) <= self.chunk_size):
+      for path in paths:
+        yield (path,) + _try_histogram(self.f, path, self.kwargs)
+      return
+
+    chunks = [paths[i:i+self.chunk_size] for i in range(0, len(paths), self.chunk_size)]
+    for chunk, results in zip(chunks, self.get_pool().imap(_histogram_chunk, chunks)):  # imap keeps the order
+      for path, (hist, error) in zip(chunk, results):
+        yield path, hist, error
+
+
+def imap_histograms(f, paths, n_worker=n_worker, chunk_size=chunk_size, blas_threads=blas_threads, pool=None,
+                    **kwargs):
+  ''' f.histogram(path, **kwargs) of many images over a pool of processes, see HistogramPool.imap()
+
+    arguments
+      f         : an extractor with a histogram(path) method, pickled once to every worker
+      paths     : a list of paths to images
+      n_worker  : processes of the pool, 1 computes in this process
+      chunk_size: images sent to a worker at once
+      pool      : the HistogramPool of f of the extraction run, a pool is started for this call if None
+
+    yields
+      (path, histogram, None), or (path, None, error) if the image fails, in the order of paths
+  '''
+  if pool is not None:
+    for item in pool.imap(paths):
+      yield item
+    return
+  with HistogramPool(f, n_worker=n_worker, chunk_size=chunk_size, blas_threads=blas_threads, **kwargs) as pool:
+    for item in pool.imap(paths):
+      yield item
+
+
+def extract_histograms(f, data, normalize=True, verbose=True, **kwargs):
+  ''' histograms of the images of a part of db.get_data() over a pool, the compute() of SegmentedStore.update()
+
+    arguments
+      f        : an extractor with a histogram(path) method
+      data     : a part of db.get_data()
+      normalize: divide every histogram by its sum
+      kwargs   : arguments of imap_histograms(), pool among them, and of f.histogram()
+
+    return
+      the paths of the images computed, {'hist': a numpy array with size len(paths) * D},
+      and the images that failed as a list of (path, error)
+  '''
+  start = time.time()
+  d_imgs, d_hists, failed = [], [], []
+  for d_img, d_hist, error in imap_histograms(f, list(data.img), **kwargs):
+    if error is not None:
+      failed.append((d_img, error))
+      continue
+    d_imgs.append(d_img)
+    d_hists.append(d_hist / np.sum(d_hist) if normalize else d_hist)
+  f.throughput = len(data) / max(time.time() - start, 1e-9)
+  if verbose:
+    print("%d images in %.1fs, %.2f images/s, %d failed" % (
+      len(data), time.time() - start, f.throughput, len(failed)))
+  return d_imgs, {'hist': np.array(d_hists)}, failed
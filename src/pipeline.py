@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from DB import Database
+from batching import Decoded
+from retriever import extractors, make_extractor
+import parallel
+import store
+
+import numpy as np
+import time
+
+# configs of the pipeline
+cnn_methods = ('resnet', 'vgg')  # methods whose features come from a CNN model
+cnn_batch   = 64  # decoded images held for the CNN extractors between two runs of their models
+
+
+class Fanout(object):
+    ''' the classical extractors of a pipeline, pickled once to every worker of its parallel.HistogramPool
+
+        histogram((path, methods, scales)) decodes the image once and computes the feature
+        of every method from the shared intermediates, see batching.Decoded
+    '''
+
+    def __init__(self, methods):
+        self.extractors = {method: make_extractor(method) for method in methods}
+
+    def histogram(self, item):
+        '''
+          arguments
+            item: (path, the methods to compute, the decode scales of the CNNs that need the image)
+
+          return
+            {method: (feature, None), or (None, error) if the extractor fails},
+            and the Decoded sent back for the CNNs, at their scales, or None
+        '''
+        path, methods, scales = item
+        decoded = Decoded(path)  # a image that can not be read fails for every method
+        hists = {}
+        for method in methods:
+            try:
+                hists[method] = self.extractors[method].feature(decoded), None
+            except Exception as e:
+                hists[method] = None, e
+        for scale in scales:
+            decoded.at(scale)  # decoded here, in the worker
+        return hists, decoded if scales else None
+
+
+class Pipeline(object):
+    ''' make the samples of several extractors in one pass over the database
+
+        Every image new or changed for any extractor is decoded once. Its RGB image, grayscale image
+        and CNN input are computed once and fed to all the extractors that need it, the classical ones
+        over a pool of processes, the CNN ones in batches. The stores of all the extractors are
+        flushed together every store.checkpoint images, see SegmentedStore.update().
+
+        pipeline = Pipeline(['color', 'daisy', 'resnet'])
+        samples = pipeline.make_samples(db)  # {method: samples}
+    '''
+
+    def __init__(self, methods=None, n_worker=parallel.n_worker):
+        '''
+          arguments
+            methods : some of retriever.extractors, all of them if None
+            n_worker: processes computing the classical extractors
+        '''
+        methods = list(methods or sorted(extractors))
+        for method in methods:
+            assert method in extractors, "method should be one of %s" % sorted(extractors)
+        self.methods  = methods
+        self.n_worker = n_worker
+        self.f = {method: make_extractor(method) for method in methods}
+
+    def make_samples(self, db, verbose=True):
+        '''
+          return
+            {method: the samples of the method, as its make_samples() returns them}
+        '''
+        stores, todo, changes = {}, {}, {}
+        for method in self.methods:
+            stores[method] = self.f[method].sample_store()
+            rows, changes[method] = stores[method].plan(db)
+            todo[method] = set(rows)
+        rows = sorted(set().union(*todo.values()))
+        if verbose:
+            print("Counting features..., methods=%s, %d images" % (",".join(self.methods), len(rows)))
+
+        start, models = time.time(), {}
+        classical = [method for method in self.methods if method not in cnn_methods]
+        with parallel.HistogramPool(Fanout(classical), n_worker=self.n_worker) as pool:  # for all the checkpoints
+            for begin in range(0, len(rows), store.checkpoint):
+                part = rows[begin:begin + store.checkpoint]
+                done = self._compute(db, part, todo, models, pool)
+                for method in self.methods:
+                    imgs, columns, failed = done[method]
+                    stores[method].add(db, [row for row in part if row in todo[method]], imgs, columns, failed)
+                    changes[method]['failed'] += len(failed)
+        self.throughput = len(rows) / max(time.time() - start, 1e-9)
+        if rows and verbose:
+            print("%d images in %.1fs, %.2f images/s" % (len(rows), time.time() - start, self.throughput))
+
+        samples = {}
+        for method in self.methods:
+            stores[method].finish()
+            changes[method]['quarantined'] = len(stores[method].quarantine)
+            if verbose:
+                print("Using cache..., config=%s, %d added, %d changed, %d removed, %d quarantined" % (
+                    stores[method].path, changes[method]['added'], changes[method]['changed'],
+                    changes[method]['removed'], changes[method]['quarantined']))
+            column = self.f[method].pick_layer if method in cnn_methods else 'hist'
+            samples[method] = stores[method].samples(db, column)
+        return samples
+
+    def _compute(self, db, rows, todo, models, pool):
+        ''' the features of the images at positions rows of db.get_data(), a checkpoint of make_samples(),
+            the classical extractors run over pool, the HistogramPool of a Fanout
+
+          return
+            {method: (paths, columns, failed) as the compute() of SegmentedStore.update() returns them}
+        '''
+        data = db.get_data()
+        classical = [method for method in self.methods if method not in cnn_methods]
+        cnns = [method for method in self.methods if method in cnn_methods]
+        items = [(data.img.iloc[row],
+                  tuple(m for m in classical if row in todo[m]),
+                  tuple(sorted(set(extractors[m].decode_scale for m in cnns if row in todo[m])))) for row in rows]
+
+        hists = {method: ([], []) for method in classical}
+        feats = {method: ([], {}) for method in cnns}
+        failed = {method: [] for method in self.methods}
+        pending = []  # (row, Decoded) waiting for the CNN extractors
+        results = pool.imap(items)
+        for row, (_, out, error) in zip(rows, results):
+            if error is not None:  # the image could not be decoded
+                for method in self.methods:
+                    if row in todo[method]:
+                        failed[method].append((data.img.iloc[row], error))
+                continue
+            path = data.img.iloc[row]
+            for method, (hist, e) in out[0].items():
+                if e is not None:
+                    failed[method].append((path, e))
+                else:
+                    hists[method][0].append(path)
+                    hists[method][1].append(hist)
+            if out[1] is not None:
+                pending.append((row, out[1]))
+            if len(pending) >= cnn_batch:
+                self._run_cnns(db, pending, todo, models, feats, failed)
+                pending = []
+        self._run_cnns(db, pending, todo, models, feats, failed)
+
+        done = {method: (paths, {'hist': np.array(h)}, failed[method]) for method, (paths, h) in hists.items()}
+        for method in cnns:
+            f, (paths, columns) = self.f[method], feats[method]
+            done[method] = (paths, {head: np.array(columns.get(head, [])) for head in f.heads}, failed[method])
+        return done
+
+    def _run_cnns(self, db, pending, todo, models, feats, failed):
+        ''' run the model of every CNN extractor on the decoded images it needs, their CNN input is shared '''
+        for method in self.methods:
+            if method not in cnn_methods:
+                continue
+            mine = [(row, decoded) for row, decoded in pending if row in todo[method]]
+            if not mine:
+                continue
+            f = self.f[method]
+            if method not in models:  # built once for all the checkpoints
+                models[method] = f.build_model(db)
+            part = db.get_data().iloc[[row for row, _ in mine]]
+            samples = f.extract(models[method], part, verbose=False, decoded=[decoded for _, decoded in mine])
+            paths, columns = feats[method]
+            for sample in samples:
+                paths.append(sample['img'])
+                for head in f.heads:
+                    columns.setdefault(head, []).append(sample['feats'][head])
+            failed[method] += [(part.img.iloc[idx], e) for idx, _, e in f.failed]
+
+
+if __name__ == "__main__":
+    db = Database(DB_dir="CorelDBDataSet/train", DB_csv="CorelDBDataSetTrain.csv")
+    samples = Pipeline().make_samples(db)
+    for method in sorted(samples):
+        print(method, len(samples[method]))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import warnings
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from batching import BatchLoader
+
+
+''' inference precisions of the CNN extractors on CPU
+      fp32        : the model as is
+      bf16        : bfloat16 autocast, needs a CPU with bf16 support (AVX512-BF16 / AMX), see resolve()
+      int8-dynamic: linear layers quantized to int8, activations are quantized on the fly
+      int8-static : convolution trunk quantized to int8 with activation ranges calibrated on images,
+                    linear layers as in int8-dynamic
+'''
+precisions = ('fp32', 'bf16', 'int8-dynamic', 'int8-static')
+
+
+class Autocast(nn.Module):
+  ''' run a model under CPU autocast, outputs are returned in fp32 '''
+
+  def __init__(self, model, dtype=torch.bfloat16):
+    super().__init__()
+    self.model = model
+    self.dtype = dtype
+
+  def forward(self, x):
+    with torch.autocast('cpu', dtype=self.dtype):
+      output = self.model(x)
+    return {k: v.float() for k, v in output.items()}
+
+
+def bf16_supported():
+  try:
+    return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+  except (AttributeError, RuntimeError):
+    return False
+
+
+def resolve(precision):
+  ''' the precision the extractors run and name their cache by: fp32, with a warning, for bf16 on a CPU
+      without bf16 support, so fp32 features are never cached as bf16 ones '''
+  assert precision in precisions, "precision should be one of %s" % (precisions,)
+  if precision == 'bf16' and not bf16_supported():
+    warnings.warn("bf16 is not supported by this CPU, running fp32", RuntimeWarning)
+    return 'fp32'
+  return precision
+
+
+def _linears(model):
+  ''' the linear layers quantize_dynamic may replace, a model restricts them by quantizable_linears '''
+  return getattr(model, 'quantizable_linears', {nn.Linear})
+
+
+def calibration_batches(db, load_fn, n_calib=64, batch_size=16):
+  ''' batches of n_calib images spread over the database
+
+    arguments
+      db        : an instance of class Database
+      load_fn   : a function reading a path into a numpy array with size C * H * W
+      n_calib   : number of images
+      batch_size: max number of images in a batch
+  '''
+  data = db.get_data()
+  paths = list(data.img[::max(1, len(data) // n_calib)][:n_calib])
+  return [torch.from_numpy(batch).float() for _, batch in BatchLoader(paths, load_fn, batch_size=batch_size)]
+
+
+def prepare_model(model, precision, calib, verbose=False):
+  ''' convert a ResidualNet or VGGNet in eval mode for inference in precision
+
+    arguments
+      model    : the model, it exposes its convolution trunk through trunk() and set_trunk()
+      precision: one of precisions
+      calib    : a list of input batches, observes activation ranges for int8-static
+      verbose  : print the max relative error to fp32 of every head, on the first batch of calib
+
+    return
+      the model to call for inference
+  '''
+  assert precision in precisions, "precision should be one of %s" % (precisions,)
+  if verbose:
+    with torch.no_grad():
+      reference = model(calib[0])
+
+  if precision == 'bf16':
+    if not bf16_supported():
+      raise RuntimeError("bf16 is not supported by this CPU, see resolve()")
+    model = Autocast(model)
+
+  elif precision == 'int8-static':
+    trunk = prepare_fx(model.trunk(), get_default_qconfig_mapping('x86'), example_inputs=(calib[0],))
+    with torch.no_grad():
+      for x in calib:  # observe activation ranges
+        trunk(x)
+    model.set_trunk(convert_fx(trunk))
+    model = quantize_dynamic(model, _linears(model), dtype=torch.qint8)
+
+  elif precision == 'int8-dynamic':
+    model = quantize_dynamic(model, _linears(model), dtype=torch.qint8)
+
+  if verbose:
+    with torch.no_grad():
+      output = model(calib[0])
+    for head in sorted(reference):
+      err = (output[head] - reference[head]).abs().max() / reference[head].abs().max()
+      print("%s, head %s, max relative error to fp32 %.4f" % (precision, head, float(err)))
+
+  return model
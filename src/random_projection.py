@@ -2,7 +2,7 @@
 
 from __future__ import print_function
 
-from evaluate import evaluate_class
+from evaluate import evaluate_class, evaluate_depths
 from DB import Database
 
 from color import Color
@@ -12,6 +12,7 @@ from gabor import Gabor
 from HOG   import HOG
 from vggnet import VGGNetFeat
 from resnet import ResNetFeat
+from pipeline import Pipeline
 
 from sklearn.random_projection import johnson_lindenstrauss_min_dim
 from sklearn import random_projection
@@ -46,9 +47,7 @@ class RandomProjection(object):
       print("Use features {}, {} RandomProject, keep {}".format(" & ".join(self.features), self.project_type, self.keep_rate))
 
     if self.samples == None:
-      feats = []
-      for f_class in self.features:
-        feats.append(self._get_feat(db, f_class))
+      feats = self._get_feats(db, self.features)
       samples = self._concat_feat(db, feats)
       samples, _ = self._rp(samples)
       self.samples = samples  # cache the result
@@ -61,30 +60,17 @@ class RandomProjection(object):
          a boolean
     '''
     if self.samples == None:
-      feats = []
-      for f_class in self.features:
-        feats.append(self._get_feat(db, f_class))
+      feats = self._get_feats(db, self.features)
       samples = self._concat_feat(db, feats)
       samples, flag = self._rp(samples)
       self.samples = samples  # cache the result
     return True if flag else False
 
-  def _get_feat(self, db, f_class):
-    if f_class == 'color':
-      f_c = Color()
-    elif f_class == 'daisy':
-      f_c = Daisy()
-    elif f_class == 'edge':
-      f_c = Edge()
-    elif f_class == 'gabor':
-      f_c = Gabor()
-    elif f_class == 'hog':
-      f_c = HOG()
-    elif f_class == 'vgg':
-      f_c = VGGNetFeat()
-    elif f_class == 'res':
-      f_c = ResNetFeat()
-    return f_c.make_samples(db, verbose=False)
+  def _get_feats(self, db, f_classes):
+    ''' the samples of every feature, made in one pass over the database, see Pipeline '''
+    methods = [{'res': 'resnet'}.get(f_class, f_class) for f_class in f_classes]
+    samples = Pipeline(methods).make_samples(db, verbose=False)
+    return [samples[method] for method in methods]
 
   def _concat_feat(self, db, feats):
     samples = feats[0]
@@ -153,8 +139,9 @@ def evaluate_feats(db, N, feat_pools=feat_pools, keep_rate=keep_rate, project_ty
   for combination in combinations:
     fusion = RandomProjection(features=list(combination), keep_rate=keep_rate, project_type=project_type)
     if fusion.check_random_projection():
+      depth_APs = evaluate_depths(db, f_instance=fusion, d_type=d_type, depths=depths)
       for d in depths:
-        APs = evaluate_class(db, f_instance=fusion, d_type=d_type, depth=d)
+        APs = depth_APs[d]
         cls_MAPs = []
         for cls, cls_APs in APs.items():
           MAP = np.mean(cls_APs)
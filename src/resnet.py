@@ -7,18 +7,21 @@ import torch.nn as nn
 from torch.autograd import Variable
 from torchvision import models
 from torchvision.models.resnet import Bottleneck, BasicBlock, ResNet
-import torch.utils.model_zoo as model_zoo
 
-from six.moves import cPickle
 import numpy as np
-import scipy.misc
+import time
 import os
 
 from evaluate import evaluate_class
 from DB import Database
+from batching import BatchLoader, load_bgr, scaled_cache
+from precision import calibration_batches, prepare_model, resolve
+from store import SegmentedStore
+import model_store
 
 
 '''
+  weights are read from the model store, see model_store.py
   downloading problem in mac OSX should refer to this answer:
     https://stackoverflow.com/a/42334357
 '''
@@ -26,6 +29,7 @@ from DB import Database
 # configs for histogram
 RES_model  = 'resnet152'  # model type
 pick_layer = 'avg'        # extract feature of this layer
+grids      = (2, 3)       # layer4 is also average pooled on these grids, e.g. 2 gives the head 'avg2x2'
 d_type     = 'd1'         # distance type
 
 depth = 3  # retrieved depth, set to None will count the ap for whole database
@@ -52,6 +56,14 @@ depth = 3  # retrieved depth, set to None will count the ap for whole database
       resnet152,fc,d1, MMAP 0.70010267663
 '''
 
+batch_size = 16  # images per forward pass, images of a batch share their size
+n_worker   = 4   # image decoding threads
+prefetch   = 64  # images decoded ahead of the forward passes
+precision  = 'fp32'  # inference precision, see precision.precisions
+decode_scale = 1     # images are decoded at 1/decode_scale of their size, see batching.read_rgb()
+n_calib    = 64      # database images used to calibrate a reduced precision
+frozen_trunk = True  # run the traced and frozen trunk of the model store if there is one, fp32 only
+
 use_gpu = torch.cuda.is_available()
 means = np.array([103.939, 116.779, 123.68]) / 255. # mean of three channels in the order of BGR
 
@@ -71,37 +83,46 @@ model_urls = {
 }
 
 class ResidualNet(ResNet):
-  def __init__(self, model=RES_model, pretrained=True):
-    if model == "resnet18":
-        super().__init__(BasicBlock, [2, 2, 2, 2], 1000)
-        if pretrained:
-            self.load_state_dict(model_zoo.load_url(model_urls['resnet18']))
-    elif model == "resnet34":
-        super().__init__(BasicBlock, [3, 4, 6, 3], 1000)
-        if pretrained:
-            self.load_state_dict(model_zoo.load_url(model_urls['resnet34']))
-    elif model == "resnet50":
-        super().__init__(Bottleneck, [3, 4, 6, 3], 1000)
-        if pretrained:
-            self.load_state_dict(model_zoo.load_url(model_urls['resnet50']))
-    elif model == "resnet101":
-        super().__init__(Bottleneck, [3, 4, 23, 3], 1000)
-        if pretrained:
-            self.load_state_dict(model_zoo.load_url(model_urls['resnet101']))
-    elif model == "resnet152":
-        super().__init__(Bottleneck, [3, 8, 36, 3], 1000)
-        if pretrained:
-            self.load_state_dict(model_zoo.load_url(model_urls['resnet152']))
+  def __init__(self, model=RES_model, pretrained=True, grids=()):
+    with model_store.init_device(pretrained):  # the stored weights replace the initialization
+      if model == "resnet18":
+          super().__init__(BasicBlock, [2, 2, 2, 2], 1000)
+      elif model == "resnet34":
+          super().__init__(BasicBlock, [3, 4, 6, 3], 1000)
+      elif model == "resnet50":
+          super().__init__(Bottleneck, [3, 4, 6, 3], 1000)
+      elif model == "resnet101":
+          super().__init__(Bottleneck, [3, 4, 23, 3], 1000)
+      elif model == "resnet152":
+          super().__init__(Bottleneck, [3, 8, 36, 3], 1000)
+    if pretrained:
+      self.load_state_dict(model_store.load_weights(model, model_urls[model]), assign=True)
+    self.grids = grids
+    self.quant_trunk = None
+
+  def trunk(self):
+    ''' the convolution layers up to layer4, as one module '''
+    if self.quant_trunk is not None:
+      return self.quant_trunk
+    return nn.Sequential(self.conv1, self.bn1, self.relu, self.maxpool,
+                         self.layer1, self.layer2, self.layer3, self.layer4)
+
+  def set_trunk(self, trunk):
+    ''' replace the convolution layers, e.g. by their quantized version '''
+    self.quant_trunk = trunk
 
   def forward(self, x):
-    x = self.conv1(x)
-    x = self.bn1(x)
-    x = self.relu(x)
-    x = self.maxpool(x)
-    x = self.layer1(x)
-    x = self.layer2(x)
-    x = self.layer3(x)
-    x = self.layer4(x)  # x after layer4, shape = N * 512 * H/32 * W/32
+    if self.quant_trunk is not None:
+      x = self.quant_trunk(x)
+    else:
+      x = self.conv1(x)
+      x = self.bn1(x)
+      x = self.relu(x)
+      x = self.maxpool(x)
+      x = self.layer1(x)
+      x = self.layer2(x)
+      x = self.layer3(x)
+      x = self.layer4(x)  # x after layer4, shape = N * 512 * H/32 * W/32
     max_pool = torch.nn.MaxPool2d((x.size(-2),x.size(-1)), stride=(x.size(-2),x.size(-1)), padding=0, ceil_mode=False)
     Max = max_pool(x)  # avg.size = N * 512 * 1 * 1
     Max = Max.view(Max.size(0), -1)  # avg.size = N * 512
@@ -114,58 +135,133 @@ class ResidualNet(ResNet):
         'avg': avg,
         'fc' : fc
     }
+    for g in self.grids:
+      grid = nn.functional.adaptive_avg_pool2d(x, g)  # grid.size = N * 512 * g * g
+      output['avg%dx%d' % (g, g)] = grid.reshape(grid.size(0), -1)
     return output
 
 
 class ResNetFeat(object):
 
+  def __init__(self, pick_layer=pick_layer, precision=precision):
+    self.pick_layer = pick_layer
+    self.precision  = resolve(precision)  # fp32 for bf16 on a CPU without it
+    self.heads = ['max', 'avg', 'fc'] + ['avg%dx%d' % (g, g) for g in grids]
+
+  def sample_store(self):
+    ''' the store of the samples, with the configs of the module '''
+    sample_cache = '{}-{}-{}'.format(RES_model, self.precision, '-'.join(self.heads))
+    config = {'extractor': 'resnet', 'model': RES_model, 'precision': self.precision, 'heads': self.heads}
+    sample_cache, config = scaled_cache(sample_cache, config, decode_scale)
+    return SegmentedStore(os.path.join(cache_dir, sample_cache), config)
+
   def make_samples(self, db, verbose=True):
-    sample_cache = '{}-{}'.format(RES_model, pick_layer)
-  
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
+    assert self.pick_layer in self.heads, "layer %s is not extracted, see grids" % self.pick_layer
+    return self.make_feats(db, verbose=verbose).samples(db, self.pick_layer)
+
+  def make_feats(self, db, verbose=True):
+    ''' features of every head, from one forward pass and cached together
+
+      return
+        a SegmentedStore with one column per head
+    '''
+    cache = self.sample_store()
+    sample_cache = os.path.basename(cache.path)
+
+    model = []
+
+    def compute(data):
       if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-  
-      res_model = ResidualNet(model=RES_model)
-      res_model.eval()
-      if use_gpu:
-        res_model = res_model.cuda()
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        img = scipy.misc.imread(d_img, mode="RGB")
-        img = img[:, :, ::-1]  # switch to BGR
-        img = np.transpose(img, (2, 0, 1)) / 255.
-        img[0] -= means[0]  # reduce B's mean
-        img[1] -= means[1]  # reduce G's mean
-        img[2] -= means[2]  # reduce R's mean
-        img = np.expand_dims(img, axis=0)
-        try:
-          if use_gpu:
-            inputs = torch.autograd.Variable(torch.from_numpy(img).cuda().float())
-          else:
-            inputs = torch.autograd.Variable(torch.from_numpy(img).float())
-          d_hist = res_model(inputs)[pick_layer]
-          d_hist = d_hist.data.cpu().numpy().flatten()
-          d_hist /= np.sum(d_hist)  # normalize
-          samples.append({
-                          'img':  d_img, 
-                          'cls':  d_cls, 
-                          'hist': d_hist
-                         })
-        except:
-          pass
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
+        print("Counting histogram..., config=%s, layer=%s, distance=%s, depth=%s, %d images" % (
+          sample_cache, self.pick_layer, d_type, depth, len(data)))
+      if not model:  # built once, update() calls compute() once per checkpoint
+        model.append(self.build_model(db))
+      samples = self.extract(model[0], data, verbose=verbose)
+      return ([sample['img'] for sample in samples],
+              {head: np.array([sample['feats'][head] for sample in samples]) for head in self.heads},
+              [(path, e) for _, path, e in self.failed])
+
+    changes = cache.update(db, compute)
+    if verbose:
+      print("Using cache..., config=%s, layer=%s, distance=%s, depth=%s, %d added, %d changed, %d removed, %d quarantined" % (
+        sample_cache, self.pick_layer, d_type, depth, changes['added'], changes['changed'], changes['removed'],
+          changes['quarantined']))
+    return cache
+
+  def build_model(self, db):
+    ''' the model in eval mode, converted to the precision of this instance '''
+    res_model = ResidualNet(model=RES_model, grids=grids)
+    res_model.eval()
+    trunk = model_store.load_trunk(RES_model) if frozen_trunk and self.precision == 'fp32' else None
+    if trunk is not None:
+      res_model.set_trunk(trunk)
+    if use_gpu:
+      res_model = res_model.cuda()
+    if self.precision != 'fp32':
+      calib = calibration_batches(db, lambda path: load_bgr(path, means, decode_scale), n_calib=n_calib, batch_size=batch_size)
+      res_model = prepare_model(res_model, self.precision, calib)
+    return res_model
+
+  def extract(self, res_model, data, verbose=True, decoded=None):
+    ''' features of every head for the images of data, see make_feats()
+
+      arguments
+        decoded: the images of data as Decoded, read from data.img if None
+    '''
+    samples = [None] * len(data)
+    loader = BatchLoader(list(data.img) if decoded is None else decoded, lambda input: load_bgr(input, means, decode_scale),
+                         batch_size=batch_size, n_worker=n_worker, prefetch=prefetch)
+    start = time.time()
+    with torch.no_grad():
+      for idxs, batch in loader:  # batches of same-shaped images, see BatchLoader
+        inputs = torch.from_numpy(batch).float()
+        if use_gpu:
+          inputs = inputs.cuda()
+        output = res_model(inputs)
+        d_feats = {}
+        for head in self.heads:
+          d_feats[head] = output[head].data.cpu().numpy().reshape(len(idxs), -1)
+          d_feats[head] /= np.sum(d_feats[head], axis=1, keepdims=True)  # normalize
+        for i, idx in enumerate(idxs):
+          d = data.iloc[idx]
+          samples[idx] = {
+                          'img':   d.img, 
+                          'cls':   d.cls, 
+                          'feats': {head: d_feats[head][i] for head in self.heads}
+                         }
+    samples = [sample for sample in samples if sample is not None]
+    self.throughput = len(samples) / (time.time() - start)
+    self.failed = loader.failed
+    if verbose:
+      print("%d images in %.1fs, %.2f images/s, %d failed" % (
+        len(samples), time.time() - start, self.throughput, len(loader.failed)))
     return samples
 
+  def embed(self, res_model, images):
+    ''' normalized pick_layer features of query images, with a model from build_model()
+
+      arguments
+        images: a list of paths to images or of RGB images as numpy arrays
+
+      return
+        a numpy array with size len(images) * D
+    '''
+    feats = [None] * len(images)
+    loader = BatchLoader(list(images), lambda input: load_bgr(input, means, decode_scale),
+                         batch_size=batch_size, n_worker=n_worker, prefetch=prefetch)
+    with torch.no_grad():
+      for idxs, batch in loader:
+        inputs = torch.from_numpy(batch).float()
+        if use_gpu:
+          inputs = inputs.cuda()
+        feat = res_model(inputs)[self.pick_layer].data.cpu().numpy().reshape(len(idxs), -1)
+        feat /= np.sum(feat, axis=1, keepdims=True)  # normalize
+        for i, idx in enumerate(idxs):
+          feats[idx] = feat[i]
+    if loader.failed:
+      raise IOError("can not read %s: %s" % loader.failed[0][1:])
+    return np.stack(feats)
+
 
 if __name__ == "__main__":
   # evaluate database
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import numpy as np
+import time
+
+from evaluate import distance_matrix, features, rank
+
+import color
+import daisy
+import edge
+import gabor
+import HOG
+import resnet
+import vggnet
+
+# extractor name -> its module, features are computed with the module configs as make_samples() does
+extractors = {
+    'color':  color,
+    'daisy':  daisy,
+    'edge':   edge,
+    'gabor':  gabor,
+    'hog':    HOG,
+    'vgg':    vggnet,
+    'resnet': resnet,
+}
+
+
+def make_extractor(method):
+    ''' an instance of the extractor of a method, see extractors '''
+    assert method in extractors, "method should be one of %s" % sorted(extractors)
+    if method == 'resnet':
+        return resnet.ResNetFeat()
+    elif method == 'vgg':
+        return vggnet.VGGNetFeat()
+    elif method == 'gabor':
+        return gabor.Gabor(n_worker=1)  # images are filtered in this process
+    return {'color': color.Color, 'daisy': daisy.Daisy, 'edge': edge.Edge, 'hog': HOG.HOG}[method]()
+
+
+class Retriever(object):
+    ''' answer queries on a database with one extractor, kept in memory between queries
+
+        The samples of the database are loaded once into a contiguous matrix, the extractor
+        and its CNN model, if any, are built once. Query images do not need to be in the database.
+
+        retriever = Retriever(db, 'resnet')
+        results = retriever.query('query.jpg', depth=5)
+    '''
+
+    def __init__(self, db, method='color', d_type=None, depth=5):
+        '''
+          arguments
+            db    : an instance of class Database
+            method: one of extractors
+            d_type: distance type, defaults to the d_type of the extractor module
+            depth : retrieved depth, the default of query()
+        '''
+        self.f      = make_extractor(method)
+        self.method = method
+        self.d_type = d_type or extractors[method].d_type
+        self.depth  = depth
+
+        samples = self.f.make_samples(db, verbose=False)
+        self.X   = np.ascontiguousarray(features(samples))
+        self.cls = np.array([s['cls'] for s in samples], dtype=object)
+        self.img = np.array([s['img'] for s in samples], dtype=object)
+
+        self.model = self.f.build_model(db) if method in ('resnet', 'vgg') else None
+
+    def features(self, images):
+        ''' features of query images, as the database samples were made
+
+          arguments
+            images: a list of paths to images, of RGB images as numpy arrays or of Decoded
+
+          return
+            a numpy array with size len(images) * D
+        '''
+        if self.model is not None:
+            return self.f.embed(self.model, images)
+        return np.stack([self.f.feature(i) for i in images])
+
+    def query(self, images, depth=None):
+        ''' the closest database samples of query images
+
+          arguments
+            images: a path to a image, a RGB image as a numpy array, or a list of them
+            depth : retrieved depth
+
+          return
+            for every query a list of {'img': <path_to_img>, 'cls': <img class>, 'dis': <distance>},
+            sorted by distance, a query given by the path of a database image is left out of its results.
+            A single query gives a single list.
+        '''
+        single = isinstance(images, str) or (isinstance(images, np.ndarray) and images.ndim == 3)
+        if single:
+            images = [images]
+        results = [self.search(q, depth=depth, exclude=i if isinstance(i, str) else None)
+                   for q, i in zip(self.features(images), images)]
+        return results[0] if single else results
+
+    def search(self, feature, depth=None, exclude=None):
+        ''' the closest database samples of a feature, see query() '''
+        depth = min(depth or self.depth, len(self.X))
+        dists = distance_matrix(feature[None], self.X, d_type=self.d_type)[0]
+        if exclude is not None:
+            dists[self.img == exclude] = np.inf
+        top = rank(dists, depth)  # partial selection, only the top is sorted
+        return [{'img': self.img[i], 'cls': self.cls[i], 'dis': dists[i]} for i in top if np.isfinite(dists[i])]
+
+
+def latency_report(db, query_images, methods=None, depth=5):
+    ''' time to build a Retriever and end-to-end latency of single-image queries, for every extractor '''
+    for method in methods or list(extractors):
+        start = time.time()
+        retriever = Retriever(db, method, depth=depth)
+        t_build = time.time() - start
+        retriever.query(query_images[0])  # warm up
+        latencies = []
+        for image in query_images:
+            start = time.time()
+            retriever.query(image)
+            latencies.append(time.time() - start)
+        print("{}: {} samples, ready in {:.2f}s, query {:.1f}ms (median of {}), d_type {}".format(
+            method, len(retriever.X), t_build, np.median(latencies) * 1000, len(latencies), retriever.d_type))
+
+
+if __name__ == "__main__":
+    from DB import Database
+
+    db = Database(DB_dir="CorelDBDataSet/train", DB_csv="CorelDBDataSetTrain.csv")
+    dbTest = Database(DB_dir="CorelDBDataSet/test", DB_csv="CorelDBDataSetTest.csv")
+
+    # queries from the test split are not in the database
+    latency_report(db, list(dbTest.get_data().img[:20]))
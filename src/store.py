@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import contextlib
+import json
+import os
+import struct
+import uuid
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # no advisory locks, jobs updating the same cache must then not run at once
+    fcntl = None
+
+
+''' columnar feature store, the on-disk cache of the samples of an extractor
+
+      magic (8 bytes) | header length (uint64) | header (JSON) | data
+
+    The header holds the format version, the extractor config, the class table and where
+    every column is in the data. Columns start on 64-byte boundaries:
+      one float32 matrix N * D per feature column, e.g. 'hist', or one per head for the CNNs
+      class codes  : int32, index in the class table
+      path offsets : int64, N + 1 offsets into the path bytes
+      path bytes   : utf-8
+      stamps       : int64 N * 2, size and mtime of every image when its features were made, optional
+    Opening a store maps the file, features are read from the page cache without a copy.
+'''
+MAGIC   = b'CBIRFST\x00'
+VERSION = 1
+ALIGN   = 64
+
+# the segmented caches, see SegmentedStore
+max_segments = 8     # segments kept before they are merged into one
+max_dead     = 0.25  # fraction of dead rows, of removed or changed images, kept before compaction
+checkpoint   = 1000  # images computed by update() between two flushes of a segment and the manifest
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+@contextlib.contextmanager
+def _locked(path, shared=False):
+    ''' hold the lock file of a manifest, shared to open its segments, exclusive to change it '''
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FeatureStore(object):
+    ''' a store opened read-only, see write_store() '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, header_len = f.read(len(MAGIC)), struct.unpack('<Q', f.read(8))[0]
+            if magic != MAGIC:
+                raise IOError("%s is not a feature store" % path)
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        if header['version'] != VERSION:
+            raise IOError("%s has version %s, expected %s" % (path, header['version'], VERSION))
+        self.path    = path
+        self.config  = header['config']
+        self.classes = header['classes']
+        self.n       = header['n']
+
+        buf = np.asarray(np.memmap(path, dtype=np.uint8, mode='r'))  # plain ndarray views are cheaper to slice
+        start = header['data']
+
+        def column(offset, dtype, shape):
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            return buf[start + offset:start + offset + size].view(dtype).reshape(shape)
+
+        self.columns = {name: column(offset, np.float32, (self.n, dim))
+                        for name, (offset, dim) in header['columns'].items()}
+        self.codes = column(header['codes'], np.int32, (self.n,))
+        self._path_offsets = column(header['path_offsets'], np.int64, (self.n + 1,))
+        self._path_bytes = column(header['path_bytes'], np.uint8, (int(self._path_offsets[-1]),))
+        self.stamps = column(header['stamps'], np.int64, (self.n, 2)) if 'stamps' in header \
+            else np.zeros((self.n, 2), dtype=np.int64)
+        self._paths = None
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            data, offsets = self._path_bytes.tobytes(), self._path_offsets.tolist()
+            self._paths = [data[s:e].decode('utf-8') for s, e in zip(offsets[:-1], offsets[1:])]
+        return self._paths
+
+    @property
+    def cls(self):
+        return [self.classes[c] for c in self.codes.tolist()]
+
+    def features(self, column='hist'):
+        ''' the feature matrix of a column, a read-only view of the file with size N * D '''
+        return self.columns[column]
+
+    def samples(self, column='hist'):
+        ''' the samples as the extractors make them, every 'hist' is a row of the mapped matrix
+
+          return
+            a list of {
+                        'img':  <path_to_img>,
+                        'cls':  <img class>,
+                        'hist': <feature of column>
+                      }
+        '''
+        return [{'img': img, 'cls': cls, 'hist': hist} for img, cls, hist in zip(self.paths, self.cls, self.features(column))]
+
+
+def write_store(path, columns, paths, cls, config=None, stamps=None):
+    ''' write a store, atomically: it goes to a temporary file renamed over path,
+        readers see either the former store or the complete new one
+
+      arguments
+        path   : file of the store
+        columns: {column name: a numpy array with size N * D}
+        paths  : the path of every image
+        cls    : the class of every image
+        config : a JSON-serializable dict, the extractor config the features were made with
+        stamps : the (size, mtime) of every image, see Database.stamps()
+    '''
+    paths = list(paths)
+    n = len(paths)
+    classes, codes = np.unique(np.asarray(list(cls)), return_inverse=True) if n else (np.array([]), np.zeros(0))
+    encoded = [p.encode('utf-8') for p in paths]
+    path_offsets = np.concatenate([[0], np.cumsum([len(p) for p in encoded])]).astype(np.int64)
+
+    blobs, layout, offset = [], {}, 0
+
+    def add(array):
+        nonlocal offset
+        array = np.ascontiguousarray(array)
+        blobs.append((offset, array))
+        ret = offset
+        offset = _align(offset + array.nbytes)
+        return ret
+
+    layout['columns'] = {}
+    for name, X in columns.items():
+        X = np.asarray(X, dtype=np.float32).reshape(n, -1) if n else np.zeros((0, 0), dtype=np.float32)
+        layout['columns'][name] = [add(X), X.shape[1]]
+    layout['codes'] = add(codes.astype(np.int32))
+    layout['path_offsets'] = add(path_offsets)
+    layout['path_bytes'] = add(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    if stamps is not None:
+        layout['stamps'] = add(np.asarray(stamps, dtype=np.int64).reshape(n, 2))
+
+    header = dict(layout, version=VERSION, config=config or {}, classes=classes.tolist(), n=n)
+    header_len = len(json.dumps(header).encode('utf-8'))
+    header['data'] = _align(len(MAGIC) + 8 + header_len + 32)  # room for the digits of 'data' itself
+    header_bytes = json.dumps(header).encode('utf-8')
+    assert len(MAGIC) + 8 + len(header_bytes) <= header['data']
+
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+            for offset, array in blobs:
+                f.seek(header['data'] + offset)
+                f.write(array.tobytes())
+            f.truncate(header['data'] + _align(max([o + a.nbytes for o, a in blobs])))
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def save_samples(path, samples, config=None):
+    ''' write samples as made by the extractors into a store '''
+    write_store(path, {'hist': np.array([s['hist'] for s in samples])},
+                [s['img'] for s in samples], [s['cls'] for s in samples], config=config)
+
+
+def load_samples(path, config=None, column='hist'):
+    ''' the samples of a store, raises IOError if there is none or if it was made with another config '''
+    fs = FeatureStore(path)
+    if config is not None and fs.config != json.loads(json.dumps(config)):  # as stored, e.g. tuples are lists
+        raise IOError("%s was made with config %s, expected %s" % (path, fs.config, config))
+    return fs.samples(column)
+
+
+class SegmentedStore(object):
+    ''' the cache of an extractor, kept up to date with a database without rebuilding it
+
+        path is a manifest (JSON) of segments, every segment is a store with the stamp of its images.
+        update() computes the features of the images new or changed since their stamp into a new
+        segment. The rows of changed or removed images become tombstones, the dead rows of their
+        segment in the manifest, until too many of them or too many segments trigger a compaction,
+        which rewrites the live rows into a single segment.
+
+        update() flushes a segment every checkpoint images, an interrupted run restarted with the
+        same config only computes the images that were not flushed. Images that fail are listed in
+        the quarantine of the manifest with their error, and retried only once they change.
+
+        Jobs may update the same cache at once: segment files have unique names, and the manifest is
+        merged with the one on disk under a lock file, see _save().
+
+        cache = SegmentedStore('cache/histogram_cache-region-n_bin12-n_slice3', config)
+        cache.update(db, compute)
+        samples = cache.samples(db)
+    '''
+
+    def __init__(self, path, config=None):
+        self.path       = path
+        self.config     = json.loads(json.dumps(config or {}))  # as stored, e.g. tuples are lists
+        self.segments   = []  # [{'file': <segment file, next to path>, 'dead': [<dead rows>]}]
+        self.quarantine = {}  # {path: [stamp, error]} of the images that failed
+        self._unused    = []  # segment files to remove once the manifest no longer lists them
+        self._created   = set()  # segment files written since the manifest was last saved
+        self._dirty     = False  # changed since the manifest was read, see plan()
+        with _locked(path, shared=True):  # the segments are not removed while they are opened
+            manifest = self._read()
+            if manifest is not None and manifest['config'] == self.config:
+                self.segments = manifest['segments']
+                self.quarantine = manifest.get('quarantine', {})
+            elif manifest is not None:
+                self._unused = [s['file'] for s in manifest['segments']]
+            try:
+                self.stores = [FeatureStore(self._file(s['file'])) for s in self.segments]
+            except (IOError, OSError, ValueError, KeyError):
+                self._unused += [s['file'] for s in self.segments]
+                self.segments, self.stores = [], []
+
+    def _read(self):
+        ''' the manifest on disk, None if there is no cache yet or a cache of the former format '''
+        try:
+            with open(self.path, 'rb') as f:
+                manifest = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(manifest, dict) or 'config' not in manifest or 'segments' not in manifest:
+            return None
+        return manifest
+
+    def _file(self, name):
+        return os.path.join(os.path.dirname(self.path), name)
+
+    def __len__(self):
+        return sum(fs.n - len(s['dead']) for s, fs in zip(self.segments, self.stores))
+
+    def _live(self):
+        ''' {path: (segment, row)} of the live rows '''
+        live = {}
+        for k, (segment, fs) in enumerate(zip(self.segments, self.stores)):
+            dead = set(segment['dead'])
+            for row, img in enumerate(fs.paths):
+                if row not in dead:
+                    live[img] = (k, row)
+        return live
+
+    def update(self, db, compute, every=None):
+        ''' bring the cache up to date with a database, only new or changed images are computed
+
+          arguments
+            db        : an instance of class Database
+            compute   : a function of a part of db.get_data(), returns the paths of the images it could
+                        compute, {column: a numpy array with size len(paths) * D} and the images that
+                        failed as a list of (path, error)
+            every     : images computed between two flushes, checkpoint if None
+
+          return
+            {'added': <new images>, 'changed': <changed images>, 'removed': <removed images>,
+             'failed': <images that failed in this update>, 'quarantined': <images in quarantine>}
+        '''
+        every = every or checkpoint
+        todo, changes = self.plan(db)
+        for start in range(0, len(todo), every):
+            rows = todo[start:start + every]
+            imgs, columns, failed = compute(db.get_data().iloc[rows])
+            self.add(db, rows, imgs, columns, failed)
+            changes['failed'] += len(failed)
+        changes['quarantined'] = len(self.quarantine)
+        self.finish()
+        return changes
+
+    def plan(self, db):
+        ''' the first step of update(): mark the rows of changed or removed images dead
+            and drop them from the quarantine, then add() the computed images and finish()
+
+          return
+            the positions in db.get_data() of the images to compute, and the changes, see update()
+        '''
+        data, stamps = db.get_data(), db.stamps()
+        live, stored = self._live(), [fs.stamps.tolist() for fs in self.stores]
+        todo, dead, n_changed, in_db = [], [], 0, set(data.img)
+        quarantine = {}
+        for i, (img, stamp) in enumerate(zip(data.img, stamps.tolist())):
+            if img in self.quarantine and self.quarantine[img][0] == stamp:
+                quarantine[img] = self.quarantine[img]
+            elif img not in live:
+                todo.append(i)
+            elif stored[live[img][0]][live[img][1]] != stamp:
+                todo.append(i)
+                dead.append(live[img])
+                n_changed += 1
+        dead += [loc for img, loc in live.items() if img not in in_db]
+        changes = {'added': len(todo) - n_changed, 'changed': n_changed, 'removed': len(dead) - n_changed,
+                   'failed': 0, 'quarantined': len(quarantine)}
+
+        self._dirty = bool(todo or dead or quarantine != self.quarantine)
+        self.quarantine = quarantine  # without the images removed or changed since they failed
+        for k, row in dead:
+            self.segments[k]['dead'].append(row)
+        return todo, changes
+
+    def add(self, db, rows, imgs, columns, failed):
+        ''' flush the features of images computed after plan() into a new segment, a checkpoint:
+            the images flushed are not computed again by an update() that restarts
+
+          arguments
+            rows   : positions in db.get_data() of the images computed
+            imgs, columns, failed: as compute() of update() returns them
+        '''
+        part = db.get_data().iloc[rows]
+        stamp_of = dict(zip(part.img, db.stamps()[rows].tolist()))
+        cls_of = dict(zip(part.img, part.cls))
+        if imgs:
+            self._add_segment(columns, imgs, [cls_of[img] for img in imgs], [stamp_of[img] for img in imgs])
+        for img, error in failed:
+            self.quarantine[img] = [stamp_of[img], str(error)]
+        self._save()
+
+    def finish(self):
+        ''' the last step of update(): save the changes of plan(), compact if needed '''
+        if not self._dirty:
+            return
+        n_dead = sum(len(s['dead']) for s in self.segments)
+        if len(self.segments) > max_segments or n_dead > max_dead * sum(fs.n for fs in self.stores):
+            self.compact()
+        else:
+            self._save()
+
+    def _add_segment(self, columns, paths, cls, stamps):
+        name = '%s.seg-%s' % (os.path.basename(self.path), uuid.uuid4().hex)  # unique across jobs
+        self._created.add(name)
+        write_store(self._file(name), columns, paths, cls, self.config, stamps)
+        self.segments.append({'file': name, 'dead': []})
+        self.stores.append(FeatureStore(self._file(name)))
+
+    def write(self, db, columns, paths):
+        ''' replace the cache with features computed outside of update(), e.g. by a parameter sweep
+
+          arguments
+            db     : an instance of class Database, gives the class and stamp of the images
+            columns: {column: a numpy array with size len(paths) * D}
+            paths  : the paths of the computed images, in db
+        '''
+        data = db.get_data()
+        row_of = dict(zip(data.img, range(len(data))))
+        rows = [row_of[img] for img in paths]
+        self._unused += [s['file'] for s in self.segments]
+        self.segments, self.stores = [], []
+        self._add_segment(columns, paths, list(data.cls.iloc[rows]), db.stamps()[rows])
+        self._save()
+
+    def compact(self):
+        ''' rewrite the live rows into a single segment, removing the tombstones
+            and the older rows of images computed by several jobs
+        '''
+        alives = [np.zeros(fs.n, dtype=bool) for fs in self.stores]
+        for k, row in self._live().values():
+            alives[k][row] = True
+        keep = [(fs, alive) for fs, alive in zip(self.stores, alives) if alive.any()]
+        columns = {name: np.concatenate([fs.columns[name][alive] for fs, alive in keep])
+                   for name in (keep[0][0].columns if keep else [])}
+        paths = [img for fs, alive in keep for img, a in zip(fs.paths, alive) if a]
+        cls = [c for fs, alive in keep for c, a in zip(fs.cls, alive) if a]
+        stamps = np.concatenate([fs.stamps[alive] for fs, alive in keep]) if keep else np.zeros((0, 2))
+        self._unused += [s['file'] for s in self.segments]
+        self.segments, self.stores = [], []
+        self._add_segment(columns, paths, cls, stamps)
+        self._save()
+
+    def _save(self):
+        ''' merge the manifest with the one on disk and write it atomically, then remove the segment
+            files it no longer lists, all under the lock file
+
+            Segments added by another job since the manifest was read are kept, segments another job
+            removed are dropped, and dead rows marked by either are dead. Segments written by this
+            instance come last, so their rows win over the rows of the same images, which are dead.
+        '''
+        with _locked(self.path):
+            disk, unused = self._read(), set(self._unused)
+            if disk is not None and disk['config'] == self.config:
+                on_disk = {s['file']: s for s in disk['segments']}
+                mine = set(s['file'] for s in self.segments)
+                old, new = [], []
+                for segment, fs in zip(self.segments, self.stores):
+                    if segment['file'] in self._created:
+                        new.append((segment, fs))
+                    elif segment['file'] in on_disk:
+                        segment['dead'] = sorted(set(segment['dead']) | set(on_disk[segment['file']]['dead']))
+                        old.append((segment, fs))
+                others = [(s, FeatureStore(self._file(s['file']))) for s in disk['segments']
+                          if s['file'] not in mine and s['file'] not in unused]
+                merged = old + others + new
+                self.segments, self.stores = [s for s, _ in merged], [fs for _, fs in merged]
+                if others:  # images computed by several jobs, the older rows are dead
+                    live = set(self._live().values())
+                    for k, (segment, fs) in enumerate(merged):
+                        dead = set(segment['dead'])
+                        segment['dead'] += [row for row in range(fs.n) if row not in dead and (k, row) not in live]
+                quarantine = disk.get('quarantine', {})
+                quarantine.update(self.quarantine)
+                self.quarantine = quarantine
+            elif disk is not None:  # a cache of another config is replaced
+                unused |= set(s['file'] for s in disk['segments'])
+
+            manifest = {'version': VERSION, 'config': self.config, 'segments': self.segments,
+                        'quarantine': self.quarantine}
+            tmp = '%s.tmp%d' % (self.path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(json.dumps(manifest).encode('utf-8'))
+            os.replace(tmp, self.path)
+            listed = set(s['file'] for s in self.segments)
+            for name in unused:
+                if name not in listed and os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+        self._unused, self._created = [], set()
+
+    def samples(self, db=None, column='hist'):
+        ''' the samples of the live rows, see FeatureStore.samples()
+
+          arguments
+            db    : an instance of class Database, gives the order of the samples, the order of the segments if None
+            column: the feature column given as 'hist'
+        '''
+        live, cls = self._live(), [fs.cls for fs in self.stores]
+        paths = list(db.get_data().img) if db is not None else list(live)
+        samples = []
+        for img in paths:
+            if img not in live:
+                continue  # the image could not be computed
+            k, row = live[img]
+            samples.append({'img': img, 'cls': cls[k][row], 'hist': self.stores[k].columns[column][row]})
+        return samples
@@ -4,19 +4,22 @@ from __future__ import print_function
 
 import torch
 import torch.nn as nn
-from torchvision import models
 from torchvision.models.vgg import VGG
 
-from six.moves import cPickle
 import numpy as np
-import scipy.misc
+import time
 import os
 
 from evaluate import evaluate_class
 from DB import Database
+from batching import BatchLoader, load_bgr, scaled_cache
+from precision import calibration_batches, prepare_model, resolve
+from store import SegmentedStore
+import model_store
 
 
 '''
+  weights are read from the model store, see model_store.py
   downloading problem in mac OSX should refer to this answer:
     https://stackoverflow.com/a/42334357
 '''
@@ -24,6 +27,9 @@ from DB import Database
 # configs for histogram
 VGG_model  = 'vgg19'  # model type
 pick_layer = 'avg'    # extract feature of this layer
+grids      = (2, 3)   # features are also average pooled on these grids, e.g. 2 gives the head 'avg2x2'
+heads      = None     # heads extracted and cached together, None for all of them and the grids,
+                      # an explicit list, e.g. ['avg'], builds the classifier only up to its last fc head
 d_type     = 'd1'     # distance type
 
 depth      = 3        # retrieved depth, set to None will count the ap for whole database
@@ -49,6 +55,14 @@ depth      = 3        # retrieved depth, set to None will count the ap for whole
       vgg19,avg,co, MMAP 0.674217021273
 '''
 
+batch_size = 16  # images per forward pass, images of a batch share their size
+n_worker   = 4   # image decoding threads
+prefetch   = 64  # images decoded ahead of the forward passes
+precision  = 'fp32'  # inference precision, see precision.precisions
+decode_scale = 1     # images are decoded at 1/decode_scale of their size, see batching.read_rgb()
+n_calib    = 64      # database images used to calibrate a reduced precision
+frozen_trunk = True  # run the traced and frozen trunk of the model store if there is one, fp32 only
+
 use_gpu = torch.cuda.is_available()
 means = np.array([103.939, 116.779, 123.68]) / 255. # mean of three channels in the order of BGR
 
@@ -58,54 +72,122 @@ if not os.path.exists(cache_dir):
   os.makedirs(cache_dir)
 
 
+# from https://github.com/pytorch/vision/blob/master/torchvision/models/vgg.py
+model_urls = {
+  'vgg11': 'https://download.pytorch.org/models/vgg11-8a719046.pth',
+  'vgg13': 'https://download.pytorch.org/models/vgg13-19584684.pth',
+  'vgg16': 'https://download.pytorch.org/models/vgg16-397923af.pth',
+  'vgg19': 'https://download.pytorch.org/models/vgg19-dcbb9e9d.pth',
+}
+
+
 class VGGNet(VGG):
-  def __init__(self, pretrained=True, model='vgg16', requires_grad=False, remove_fc=False, show_params=False):
-    super().__init__(make_layers(cfg[model]))
+  # classifier[0] is sliced by its weight for inputs other than 224x224, it stays in fp32 when quantizing
+  quantizable_linears = {'classifier.3', 'classifier.6'}
+
+  def __init__(self, pretrained=True, model='vgg16', requires_grad=False, remove_fc=False, show_params=False, grids=(), heads=None):
+    '''
+      heads: the outputs forward() returns, None for all of them.
+             Layers only needed by other outputs are neither built nor loaded, e.g. ['avg'] keeps no classifier
+    '''
+    with torch.device('meta'):  # nothing is allocated before the layers not needed are dropped
+      super().__init__(make_layers(cfg[model]), init_weights=False)
     self.ranges = ranges[model]
+    self.grids = grids
     self.fc_ranges = ((0, 2), (2, 5), (5, 7))
+    self.heads = heads
+
+    self.n_fc = len(self.fc_ranges)  # fully-connected outputs computed by forward()
+    if heads is not None:
+      self.n_fc = max([int(head[2:]) for head in heads if head.startswith('fc')] or [0])
+    if remove_fc:  # delete redundant fully-connected layer params, can save memory
+      self.n_fc = 0
+    if self.n_fc == 0:
+      del self.classifier
+    else:
+      self.classifier = self.classifier[:self.fc_ranges[self.n_fc - 1][1]]
 
-    if pretrained:
-      exec("self.load_state_dict(models.%s(pretrained=True).state_dict())" % model)
+    if pretrained:  # the stored weights replace the meta parameters
+      keep = self.state_dict().keys()
+      state_dict = model_store.load_weights(model, model_urls[model])
+      self.load_state_dict({k: v for k, v in state_dict.items() if k in keep}, assign=True)
+    else:
+      self.to_empty(device='cpu')
+      self._init_weights()
 
     if not requires_grad:
       for param in super().parameters():
         param.requires_grad = False
 
-    if remove_fc:  # delete redundant fully-connected layer params, can save memory
-      del self.classifier
-
     if show_params:
       for name, param in self.named_parameters():
         print(name, param.size())
 
+  def _init_weights(self):
+    ''' the initialization of torchvision's VGG, of the layers kept '''
+    for m in self.modules():
+      if isinstance(m, nn.Conv2d):
+        nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+        if m.bias is not None:
+          nn.init.constant_(m.bias, 0)
+      elif isinstance(m, nn.BatchNorm2d):
+        nn.init.constant_(m.weight, 1)
+        nn.init.constant_(m.bias, 0)
+      elif isinstance(m, nn.Linear):
+        nn.init.normal_(m.weight, 0, 0.01)
+        nn.init.constant_(m.bias, 0)
+
+  def _wants(self, head):
+    return self.heads is None or head in self.heads
+
+  def trunk(self):
+    ''' the convolution layers, as one module '''
+    return self.features
+
+  def set_trunk(self, trunk):
+    ''' replace the convolution layers, e.g. by their quantized version '''
+    self.features = trunk
+
   def forward(self, x):
     output = {}
 
     x = self.features(x)
 
-    avg_pool = torch.nn.AvgPool2d((x.size(-2), x.size(-1)), stride=(x.size(-2), x.size(-1)), padding=0, ceil_mode=False, count_include_pad=True)
-    avg = avg_pool(x)  # avg.size = N * 512 * 1 * 1
-    avg = avg.view(avg.size(0), -1)  # avg.size = N * 512
-    output['avg'] = avg
+    if self._wants('avg'):
+      avg_pool = torch.nn.AvgPool2d((x.size(-2), x.size(-1)), stride=(x.size(-2), x.size(-1)), padding=0, ceil_mode=False, count_include_pad=True)
+      avg = avg_pool(x)  # avg.size = N * 512 * 1 * 1
+      avg = avg.view(avg.size(0), -1)  # avg.size = N * 512
+      output['avg'] = avg
+
+    for g in self.grids:
+      if self._wants('avg%dx%d' % (g, g)):
+        grid = nn.functional.adaptive_avg_pool2d(x, g)  # grid.size = N * 512 * g * g
+        output['avg%dx%d' % (g, g)] = grid.reshape(grid.size(0), -1)
+
+    if self.n_fc == 0:  # stop after the last requested output
+      return output
 
-    x = x.view(x.size(0), -1)  # flatten()
+    x = x.reshape(x.size(0), -1)  # flatten()
     dims = x.size(1)
     if dims >= 25088:
       x = x[:, :25088]
-      for idx in range(len(self.fc_ranges)):
+      for idx in range(self.n_fc):
         for layer in range(self.fc_ranges[idx][0], self.fc_ranges[idx][1]):
           x = self.classifier[layer](x)
-        output["fc%d"%(idx+1)] = x
+        if self._wants("fc%d"%(idx+1)):
+          output["fc%d"%(idx+1)] = x
     else:
       w = self.classifier[0].weight[:, :dims]
       b = self.classifier[0].bias
       x = torch.matmul(x, w.t()) + b
       x = self.classifier[1](x)
-      output["fc1"] = x
-      for idx in range(1, len(self.fc_ranges)):
+      if self._wants("fc1"):
+        output["fc1"] = x
+      for idx in range(1, self.n_fc):
         for layer in range(self.fc_ranges[idx][0], self.fc_ranges[idx][1]):
           x = self.classifier[layer](x)
-        output["fc%d"%(idx+1)] = x
+        if self._wants("fc%d"%(idx+1)):
+          output["fc%d"%(idx+1)] = x
 
     return output
 
@@ -143,54 +225,127 @@ def make_layers(cfg, batch_norm=False):
 
 class VGGNetFeat(object):
 
+  def __init__(self, pick_layer=pick_layer, precision=precision, heads=heads):
+    self.pick_layer = pick_layer
+    self.precision  = resolve(precision)  # fp32 for bf16 on a CPU without it
+    valid = ['avg', 'fc1', 'fc2', 'fc3'] + ['avg%dx%d' % (g, g) for g in grids]
+    self.heads = list(heads) if heads else valid  # the classifier is built up to the last fc head
+    assert all(head in valid for head in self.heads), "heads should be some of %s, see grids" % valid
+
+  def sample_store(self):
+    ''' the store of the samples, with the configs of the module '''
+    sample_cache = '{}-{}-{}'.format(VGG_model, self.precision, '-'.join(self.heads))
+    config = {'extractor': 'vgg', 'model': VGG_model, 'precision': self.precision, 'heads': self.heads}
+    sample_cache, config = scaled_cache(sample_cache, config, decode_scale)
+    return SegmentedStore(os.path.join(cache_dir, sample_cache), config)
+
   def make_samples(self, db, verbose=True):
-    sample_cache = '{}-{}'.format(VGG_model, pick_layer)
-  
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
+    assert self.pick_layer in self.heads, "layer %s is not extracted, see heads" % self.pick_layer
+    return self.make_feats(db, verbose=verbose).samples(db, self.pick_layer)
+
+  def make_feats(self, db, verbose=True):
+    ''' features of every head, from one forward pass and cached together
+
+      return
+        a SegmentedStore with one column per head
+    '''
+    cache = self.sample_store()
+    sample_cache = os.path.basename(cache.path)
+
+    model = []
+
+    def compute(data):
       if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-  
-      vgg_model = VGGNet(requires_grad=False, model=VGG_model)
-      vgg_model.eval()
-      if use_gpu:
-        vgg_model = vgg_model.cuda()
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        img = scipy.misc.imread(d_img, mode="RGB")
-        img = img[:, :, ::-1]  # switch to BGR
-        img = np.transpose(img, (2, 0, 1)) / 255.
-        img[0] -= means[0]  # reduce B's mean
-        img[1] -= means[1]  # reduce G's mean
-        img[2] -= means[2]  # reduce R's mean
-        img = np.expand_dims(img, axis=0)
-        try:
-          if use_gpu:
-            inputs = torch.autograd.Variable(torch.from_numpy(img).cuda().float())
-          else:
-            inputs = torch.autograd.Variable(torch.from_numpy(img).float())
-          d_hist = vgg_model(inputs)[pick_layer]
-          d_hist = np.sum(d_hist.data.cpu().numpy(), axis=0)
-          d_hist /= np.sum(d_hist)  # normalize
-          samples.append({
-                          'img':  d_img, 
-                          'cls':  d_cls, 
-                          'hist': d_hist
-                         })
-        except:
-          pass
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
+        print("Counting histogram..., config=%s, layer=%s, distance=%s, depth=%s, %d images" % (
+          sample_cache, self.pick_layer, d_type, depth, len(data)))
+      if not model:  # built once, update() calls compute() once per checkpoint
+        model.append(self.build_model(db))
+      samples = self.extract(model[0], data, verbose=verbose)
+      return ([sample['img'] for sample in samples],
+              {head: np.array([sample['feats'][head] for sample in samples]) for head in self.heads},
+              [(path, e) for _, path, e in self.failed])
+
+    changes = cache.update(db, compute)
+    if verbose:
+      print("Using cache..., config=%s, layer=%s, distance=%s, depth=%s, %d added, %d changed, %d removed, %d quarantined" % (
+        sample_cache, self.pick_layer, d_type, depth, changes['added'], changes['changed'], changes['removed'],
+          changes['quarantined']))
+    return cache
+
+  def build_model(self, db):
+    ''' the model in eval mode, converted to the precision of this instance '''
+    vgg_model = VGGNet(requires_grad=False, model=VGG_model, grids=grids, heads=self.heads)
+    vgg_model.eval()
+    trunk = model_store.load_trunk(VGG_model) if frozen_trunk and self.precision == 'fp32' else None
+    if trunk is not None:
+      vgg_model.set_trunk(trunk)
+    if use_gpu:
+      vgg_model = vgg_model.cuda()
+    if self.precision != 'fp32':
+      calib = calibration_batches(db, lambda path: load_bgr(path, means, decode_scale), n_calib=n_calib, batch_size=batch_size)
+      vgg_model = prepare_model(vgg_model, self.precision, calib)
+    return vgg_model
+
+  def extract(self, vgg_model, data, verbose=True, decoded=None):
+    ''' features of every head for the images of data, see make_feats()
+
+      arguments
+        decoded: the images of data as Decoded, read from data.img if None
+    '''
+    samples = [None] * len(data)
+    loader = BatchLoader(list(data.img) if decoded is None else decoded, lambda input: load_bgr(input, means, decode_scale),
+                         batch_size=batch_size, n_worker=n_worker, prefetch=prefetch)
+    start = time.time()
+    with torch.no_grad():
+      for idxs, batch in loader:  # batches of same-shaped images, see BatchLoader
+        inputs = torch.from_numpy(batch).float()
+        if use_gpu:
+          inputs = inputs.cuda()
+        output = vgg_model(inputs)
+        d_feats = {}
+        for head in self.heads:
+          d_feats[head] = output[head].data.cpu().numpy().reshape(len(idxs), -1)
+          d_feats[head] /= np.sum(d_feats[head], axis=1, keepdims=True)  # normalize
+        for i, idx in enumerate(idxs):
+          d = data.iloc[idx]
+          samples[idx] = {
+                          'img':   d.img, 
+                          'cls':   d.cls, 
+                          'feats': {head: d_feats[head][i] for head in self.heads}
+                         }
+    samples = [sample for sample in samples if sample is not None]
+    self.throughput = len(samples) / (time.time() - start)
+    self.failed = loader.failed
+    if verbose:
+      print("%d images in %.1fs, %.2f images/s, %d failed" % (
+        len(samples), time.time() - start, self.throughput, len(loader.failed)))
     return samples
 
+  def embed(self, vgg_model, images):
+    ''' normalized pick_layer features of query images, with a model from build_model()
+
+      arguments
+        images: a list of paths to images or of RGB images as numpy arrays
+
+      return
+        a numpy array with size len(images) * D
+    '''
+    feats = [None] * len(images)
+    loader = BatchLoader(list(images), lambda input: load_bgr(input, means, decode_scale),
+                         batch_size=batch_size, n_worker=n_worker, prefetch=prefetch)
+    with torch.no_grad():
+      for idxs, batch in loader:
+        inputs = torch.from_numpy(batch).float()
+        if use_gpu:
+          inputs = inputs.cuda()
+        feat = vgg_model(inputs)[self.pick_layer].data.cpu().numpy().reshape(len(idxs), -1)
+        feat /= np.sum(feat, axis=1, keepdims=True)  # normalize
+        for i, idx in enumerate(idxs):
+          feats[idx] = feat[i]
+    if loader.failed:
+      raise IOError("can not read %s: %s" % loader.failed[0][1:])
+    return np.stack(feats)
+
 
 if __name__ == "__main__":
   # evaluate database